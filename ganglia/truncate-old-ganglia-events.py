@@ -1,67 +1,1033 @@
 #!/bin/env python2.6
-# 
+#
 # Description:
 #   Reads a Ganglia events.json file, and truncates it to the most recent 2-weeks
 #   of events, archiving all older events in an archive file.
 #
+#   With -s/--stream, the events file is read one event at a time and split into
+#   the archive and the kept events as it's read, so memory use stays flat no matter
+#   how big events.json has grown. (kept events stay in their original order)
+#
+#   With -S/--segments, archived events are appended to weekly segment files in an
+#   archive directory instead of a new archive file per run, and can be fetched by
+#   time range with the 'query' subcommand, i.e.:
+#       truncate-old-ganglia-events.py -S query --from 2013-08-01 --to 2013-08-15
+#
+#   With -c/--codec, archives are compressed with gzip, bz2 or xz as they're written,
+#   and decompressed transparently when queried. The 'codecs' subcommand measures the
+#   ratio and throughput of each codec & level on a sample of the events file.
+#
+#   With -A/--atomic, events.json is only locked long enough to copy it, and later to
+#   rename the new file into place (after picking up any events gweb appended in the
+#   meantime), rather than for the whole run, and readers never see a half-written file.
+#   Events gweb writes to the old file just after it's replaced are added back too,
+#   but one writing more than a second after that is lost (see strayEvents).
+#
+#   How long events are kept is set with -m/--max-age, and can be varied per gmetad,
+#   cluster or host with a -r/--retention-rules file (see RetentionPolicy). The 'batch'
+#   subcommand truncates many events files at once, in parallel, i.e.:
+#       truncate-old-ganglia-events.py -s -A -S -r retention.json batch /var/lib/ganglia*/conf/events.json
+#
 # Author: Devin Cherry <youshoulduseunix@gmail.com>
 #################################################################################
-import sys, fcntl, traceback, time
-import json
+import sys, os, fcntl, traceback, time, re, shutil, bisect, calendar, stat, fnmatch
+import json, zlib, gzip, bz2, multiprocessing
+from itertools import izip, islice, chain, imap
+from optparse import OptionParser
+
+# the xz codec needs lzma, which is only in the standard library from python 3.3
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 gangliaEventsFile = '/var/lib/ganglia/conf/events.json'
 
+# events older than this many seconds are archived, unless -m/--max-age or a retention
+# rule says otherwise
+maxEventAge = 1209600
+
+# units for ages given with a suffix, i.e. '14d'
+ageUnits = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# read & write buffer size for streaming
+bufferSize = 1048576
+
+# when streaming, an event that still can't be decoded after this many bytes is
+# treated as corrupt, rather than reading the rest of the file looking for its end
+maxEventSize = 16777216
+
+# archive segments each hold a week of events, starting on monday 00:00 UTC
+# (the epoch was a thursday, hence the offset)
+segmentSeconds = 604800
+segmentOffset = 345600
+
+# with -A/--atomic, how long to wait after renaming the new events file into place
+# before checking whether gweb wrote to the replaced one (see strayEvents)
+renameGraceSeconds = 1
+
+# max events covered by each entry in a segment's index
+blockEvents = 1024
+
+# archive codecs: name -> (archive file suffix, default level, (min level, max level), magic bytes)
+archiveCodecs = {
+    'none':     ('', None, None, None),
+    'gzip':     ('.gz', 6, (0, 9), '\x1f\x8b'),
+    'bz2':      ('.bz2', 9, (1, 9), 'BZh'),
+    'xz':       ('.xz', 6, (0, 9), '\xfd7zXZ\x00'),
+}
+
+
+# exits with an error if 'codec' can't be used here
+def checkCodec(codec):
+    if codec == 'xz' and lzma is None:
+        sys.stderr.write("ERROR: The xz codec needs the lzma module (backports.lzma on python 2).\n")
+        sys.exit(1)
+
+# compresses a whole block of data into a standalone gzip/bz2/xz stream
+def compressData(data, codec, level):
+    if codec == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if codec == 'bz2':
+        return bz2.compress(data, level)
+    if codec == 'xz':
+        return lzma.compress(data, preset=level)
+    return data
+
+def decompressData(data, codec):
+    if codec == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if codec == 'bz2':
+        return bz2.decompress(data)
+    if codec == 'xz':
+        checkCodec(codec)
+        return lzma.decompress(data)
+    return data
+
+# opens an archive file for writing, compressed with 'codec'
+def openArchiveWriter(path, codec, level):
+    if codec == 'gzip':
+        return gzip.GzipFile(path, 'wb', level)
+    if codec == 'bz2':
+        return bz2.BZ2File(path, 'w', 0, level)
+    if codec == 'xz':
+        return lzma.LZMAFile(path, 'w', preset=level)
+    return open(path, 'w', bufferSize)
+
+# opens an archive file for reading, decompressing it if it starts with the magic
+# bytes of one of the codecs
+def openArchiveReader(path):
+    archiveFile = open(path, 'rb')
+    magic = archiveFile.read(6)
+    archiveFile.close()
+    if magic.startswith(archiveCodecs['gzip'][3]):
+        return gzip.GzipFile(path, 'rb')
+    if magic.startswith(archiveCodecs['bz2'][3]):
+        return bz2.BZ2File(path, 'r')
+    if magic.startswith(archiveCodecs['xz'][3]):
+        checkCodec('xz')
+        return lzma.LZMAFile(path, 'r')
+    return open(path, 'r', bufferSize)
+
+# newlines can only be whitespace between json tokens (strings can't hold them
+# unescaped), so flattening them puts an event on one line
+def flattenEvent(rawJson):
+    if '\n' in rawJson or '\r' in rawJson:
+        return rawJson.replace('\n', ' ').replace('\r', ' ')
+    return rawJson
+
+
+# writes a json array to a file one already-encoded element at a time, formatted
+# like json.dumps() would. output is collected into large writes, since compressed
+# files compress each write separately.
+#
+# with a 'count', the writer adds to an array of that many elements which is already
+# in the file, minus its closing ']'.
+class JsonArrayWriter:
+    def __init__(self, fileObj, name, count=None):
+        self.name = name
+        self.file = fileObj
+        # uncompressed bytes written, and bytes stored on disk once closed
+        self.bytes = 0
+        self.stored_bytes = 0
+        if count is None:
+            self.count = 0
+            self.pending = ['[']
+            self.pending_size = 1
+        else:
+            self.count = count
+            self.pending = []
+            self.pending_size = 0
+
+    # 'startTime' is unused; it's accepted so this can stand in for a SegmentArchive
+    def write(self, rawJson, startTime=None):
+        if self.count > 0:
+            self.pending.append(', ')
+        self.pending.append(rawJson)
+        self.pending_size = self.pending_size + len(rawJson) + 2
+        self.count = self.count + 1
+        if self.pending_size >= bufferSize:
+            self._flush()
+
+    def _flush(self):
+        data = ''.join(self.pending)
+        self.file.write(data)
+        self.bytes = self.bytes + len(data)
+        self.pending = []
+        self.pending_size = 0
+
+    def close(self):
+        self.pending.append(']')
+        self._flush()
+        self.file.close()
+        self.stored_bytes = os.path.getsize(self.name)
+
+    # removes the file, i.e. when the events it archived couldn't be removed from the
+    # events file, and will be archived again next run
+    def rollback(self):
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+# Archives events into segment files in 'archiveDir', one per week. each segment
+# (events.YYYYMMDD.json) holds one event per line, and is appended to in blocks of up
+# to 'blockEvents' events. its sidecar index (events.YYYYMMDD.idx) gets a json line
+# per block with the block's byte offset, length, event count, and min/max start_time,
+# so a query only reads the segments, and the blocks within them, which overlap its
+# time range.
+#
+# with a codec, each block is compressed as a standalone stream (so it can still be
+# seeked to), and its index line names the codec. a segment written with one codec
+# is also a valid multi-stream .gz/.bz2/.xz file for zcat & co.
+class SegmentArchive:
+    segment_name = re.compile(r'^events\.(\d{8})\.json$')
+
+    def __init__(self, archiveDir, codec='none', level=None, maxPending=64):
+        self.name = archiveDir
+        self.codec = codec
+        self.level = level
+        self.max_pending = maxPending
+        self.count = 0
+        self.writes = 0
+        # uncompressed bytes archived, and bytes written to segments
+        self.bytes = 0
+        self.stored_bytes = 0
+        # blocks still being filled, by segment start time
+        self.blocks = {}
+        # the size of each file before this archive first wrote to it (None if it was
+        # created), for rollback()
+        self.original_sizes = {}
+
+    # the start time of the segment an event belongs in
+    def bucket(self, startTime):
+        return int((startTime - segmentOffset) // segmentSeconds) * segmentSeconds + segmentOffset
+
+    # returns a tuple of (segment path, index path) for the segment starting at 'bucket'
+    def paths(self, bucket):
+        base = os.path.join(self.name, 'events.' + time.strftime('%Y%m%d', time.gmtime(bucket)))
+        return (base + '.json', base + '.idx')
+
+    # returns a sorted list of (start time, segment path, index path) for each segment
+    def segments(self):
+        found = []
+        for fileName in os.listdir(self.name):
+            match = self.segment_name.match(fileName)
+            if match:
+                bucket = calendar.timegm(time.strptime(match.group(1), '%Y%m%d'))
+                found.append((bucket,) + self.paths(bucket))
+        return sorted(found)
+
+    def write(self, rawJson, startTime):
+        bucket = self.bucket(startTime)
+        block = self.blocks.get(bucket)
+        if block is None:
+            block = self._newBlock(bucket)
+        block['lines'].append(flattenEvent(rawJson) + '\n')
+        if block['count'] == 0 or startTime < block['min']:
+            block['min'] = startTime
+        if block['count'] == 0 or startTime > block['max']:
+            block['max'] = startTime
+        block['count'] = block['count'] + 1
+        self.count = self.count + 1
+        self.writes = self.writes + 1
+        block['last_write'] = self.writes
+        if block['count'] >= blockEvents:
+            self._writeBlock(block)
+
+    # starts a new block for a segment. if too many are being filled already, the
+    # least recently written one is written out first; its segment just gets another
+    # block if it's written to again.
+    def _newBlock(self, bucket):
+        if len(self.blocks) >= self.max_pending:
+            self._writeBlock(min(self.blocks.values(), key=lambda b: b['last_write']))
+        block = {'bucket': bucket, 'lines': [], 'count': 0, 'min': None, 'max': None, 'last_write': 0}
+        self.blocks[bucket] = block
+        return block
+
+    # compresses a block and appends it to its segment, then adds the block to the
+    # segment's index. (a block whose index line never got written is simply never
+    # queried.)
+    def _writeBlock(self, block):
+        del self.blocks[block['bucket']]
+        (segmentPath, indexPath) = self.paths(block['bucket'])
+        data = ''.join(block['lines'])
+        stored = compressData(data, self.codec, self.level)
+        if not os.path.isdir(self.name):
+            os.makedirs(self.name)
+        for path in (segmentPath, indexPath):
+            if path not in self.original_sizes:
+                if os.path.exists(path):
+                    self.original_sizes[path] = os.path.getsize(path)
+                else:
+                    self.original_sizes[path] = None
+        segmentFile = open(segmentPath, 'ab')
+        segmentFile.seek(0, 2)
+        offset = segmentFile.tell()
+        segmentFile.write(stored)
+        segmentFile.close()
+
+        entry = {'offset': offset, 'length': len(stored), 'count': block['count'],
+                 'min_start_time': block['min'], 'max_start_time': block['max']}
+        if self.codec != 'none':
+            entry['codec'] = self.codec
+        indexFile = open(indexPath, 'a')
+        indexFile.write(json.dumps(entry) + '\n')
+        indexFile.close()
+        self.bytes = self.bytes + len(data)
+        self.stored_bytes = self.stored_bytes + len(stored)
+
+    def close(self):
+        for block in self.blocks.values():
+            self._writeBlock(block)
+
+    # truncates the segments & indexes back to how they were before this archive wrote
+    # to them, i.e. when the events it archived couldn't be removed from the events
+    # file, and will be archived again next run
+    def rollback(self):
+        self.blocks = {}
+        for (path, size) in self.original_sizes.items():
+            if size is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                segmentFile = open(path, 'r+b')
+                segmentFile.truncate(size)
+                segmentFile.close()
+        self.original_sizes = {}
+
+    # yields the raw json of each archived event which started in [start, end).
+    # events are only decoded in blocks which straddle either end of the range.
+    def query(self, start, end):
+        for (bucket, segmentPath, indexPath) in self.segments():
+            if bucket >= end or bucket + segmentSeconds <= start or not os.path.exists(indexPath):
+                continue
+            segmentFile = open(segmentPath, 'rb')
+            for line in open(indexPath):
+                block = json.loads(line)
+                if block['min_start_time'] >= end or block['max_start_time'] < start:
+                    continue
+                inRange = start <= block['min_start_time'] and block['max_start_time'] < end
+                segmentFile.seek(block['offset'])
+                data = decompressData(segmentFile.read(block['length']), block.get('codec', 'none'))
+                for rawJson in data.split('\n'):
+                    if rawJson == '':
+                        continue
+                    if inRange or start <= float(json.loads(rawJson)['start_time']) < end:
+                        yield rawJson
+            segmentFile.close()
+
+
+# parses an age, given in seconds or with an s/m/h/d/w suffix
+def parseAge(value):
+    value = str(value).strip()
+    try:
+        if value[-1:] in ageUnits:
+            return float(value[:-1]) * ageUnits[value[-1]]
+        return float(value)
+    except ValueError:
+        raise ValueError("Unable to parse age %s" % repr(value))
+
+
+# Decides how long events are kept, from an ordered list of retention rules. each rule
+# is a dict with a 'max_age' (as parseAge() takes), and any of:
+#   events_file:    a glob the events file's path must match
+#   cluster:        the event's cluster
+#   host_regex:     a regex, searched for in the event's host_regex
+# an event is kept for the max_age of the first rule it matches, or 'defaultAge' if it
+# matches none. i.e. with the rules
+#   [{"cluster": "hadoop", "max_age": "90d"},
+#    {"events_file": "/var/lib/ganglia-dev/*", "max_age": "3d"}]
+# hadoop events are kept for 90 days, the dev gmetad's other events for 3, and
+# everything else for 'defaultAge'.
+class RetentionPolicy:
+    rule_keys = set(['events_file', 'cluster', 'host_regex', 'max_age'])
+
+    def __init__(self, rules, defaultAge):
+        self.rules = []
+        for rule in rules:
+            if not isinstance(rule, dict) or 'max_age' not in rule:
+                raise ValueError("Retention rule %s has no max_age" % json.dumps(rule))
+            if len(set(rule.keys()) - self.rule_keys) > 0:
+                raise ValueError("Retention rule %s has unknown keys: %s"
+                                 % (json.dumps(rule), ', '.join(sorted(set(rule.keys()) - self.rule_keys))))
+            hostRegex = None
+            if rule.get('host_regex') is not None:
+                hostRegex = re.compile(rule['host_regex'])
+            self.rules.append((rule.get('events_file'), rule.get('cluster'), hostRegex, parseAge(rule['max_age'])))
+        self.rules.append((None, None, None, defaultAge))
+
+    # the rules which apply to one events file, as a Retention with cutoffs relative to
+    # 'now'
+    def forFile(self, eventsFileName, now):
+        rules = []
+        for (pattern, cluster, hostRegex, maxAge) in self.rules:
+            if pattern is not None and not (fnmatch.fnmatch(os.path.abspath(eventsFileName), pattern)
+                                            or fnmatch.fnmatch(eventsFileName, pattern)):
+                continue
+            rules.append((cluster, hostRegex, now - maxAge))
+            # this rule matches every event in the file, so none after it ever apply
+            if cluster is None and hostRegex is None:
+                break
+        return Retention(rules)
+
+
+# The retention rules for the events in one events file, each a tuple of (cluster,
+# host regex, cutoff). an event is archived if it started before the cutoff of the
+# first rule it matches. events which started before the 'oldest' cutoff, or after the
+# 'newest', are archived or kept whichever rule they match, so only the events between
+# them need their cluster & host checked (and with a single rule, none do).
+class Retention:
+    def __init__(self, rules):
+        self.rules = rules
+        cutoffs = [cutoff for (cluster, hostRegex, cutoff) in rules]
+        self.oldest = min(cutoffs)
+        self.newest = max(cutoffs)
+
+    # true if 'event' (a decoded event) is to be archived
+    def archives(self, startTime, event):
+        for (cluster, hostRegex, cutoff) in self.rules:
+            if cluster is not None and event.get('cluster') != cluster:
+                continue
+            if hostRegex is not None and not hostRegex.search(event.get('host_regex') or ''):
+                continue
+            return startTime < cutoff
+        return False
+
+
+# raised when the events file is changed, other than by appending events, while it's
+# being truncated with --atomic
+class EventsChanged(Exception):
+    pass
+
 
 #################################################################
 #                             BEGIN                             #
 #################################################################
 
-# deal with the mixed encoding issue in the ganglia-generated json 
+# deal with the mixed encoding issue in the ganglia-generated json
 def encode_object_as_ascii(pyObj):
     ascii_encoded = lambda x: str(x).encode('ascii')
     return dict(map(ascii_encoded, pair) for pair in pyObj.items())
 
 
-try:
-    eventsFile = open(gangliaEventsFile, 'rw+')
-    fcntl.lockf(eventsFile, fcntl.LOCK_SH)
-    data = eventsFile.read()
+# incrementally tokenizes a json array of events from 'fileObj', reading 'chunkSize'
+# bytes at a time. yields a tuple of (start_time, raw json text) for each event, so
+# only the current chunk and event are ever held in memory, and events can be written
+# back out without re-encoding them.
+def readEvents(fileObj, chunkSize=bufferSize):
+    whitespace = re.compile(r'[ \t\n\r]*')
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    state = 'start'             # expecting '[', then 'first' element or ']', then 'separator' or 'value'
+    while True:
+        pos = whitespace.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = fileObj.read(chunkSize)
+            if chunk == '':
+                raise ValueError("Unexpected end of events file (expecting %s)" % state)
+            (buf, pos) = (chunk, 0)
+            continue
 
-    # decode the json as python nested objects (this turns into a list of dictionaries in this case),
-    # and sort the list by nested value 'start_time'
-    eventsList = json.loads(data, object_hook=encode_object_as_ascii)
-    sortedEventsList = sorted(eventsList, key=lambda event: event['start_time'])
+        if state == 'start':
+            if buf[pos] != '[':
+                raise ValueError("Events file isn't a json array (found %s)" % repr(buf[pos:pos + 20]))
+            pos = pos + 1
+            state = 'first'
+        elif state == 'separator':
+            if buf[pos] == ']':
+                return
+            if buf[pos] != ',':
+                raise ValueError("Expected ',' or ']' in events file (found %s)" % repr(buf[pos:pos + 20]))
+            pos = pos + 1
+            state = 'value'
+        elif state == 'first' and buf[pos] == ']':
+            return
+        else:
+            try:
+                (event, end) = decoder.raw_decode(buf, idx=pos)
+            except ValueError, e:
+                # most likely the event is split across chunks, so read more and retry
+                chunk = fileObj.read(chunkSize)
+                if chunk == '' or len(buf) - pos > maxEventSize:
+                    raise e
+                (buf, pos) = (buf[pos:] + chunk, 0)
+                continue
+            yield (float(event['start_time']), buf[pos:end])
+            pos = end
+            state = 'separator'
 
-    # get the index of the most recent event from two weeks ago
-    index = -1
-    for event in sortedEventsList[::-1]:
-        if (time.time() - float(event['start_time'])) > 1209600:
-            break
-        index = index - 1
 
-    # get the truncated list, including everything from last two weeks
-    archiveEvents = sortedEventsList[0:index]
-    recentEvents = sortedEventsList[index:]
+# splits the events read from 'eventsFile' into archived events (per 'retention', a
+# Retention) and kept events, writing each to its writer as it's read. returns a tuple
+# of (archived count, kept count)
+def splitEventsStream(eventsFile, retention, archive, keep):
+    for (startTime, rawEvent) in readEvents(eventsFile):
+        if startTime < retention.oldest or \
+                (startTime < retention.newest and retention.archives(startTime, json.loads(rawEvent))):
+            archive.write(rawEvent, startTime)
+        else:
+            keep.write(rawEvent)
+    archive.close()
+    keep.close()
+    return (archive.count, keep.count)
+
 
-    # archive old events
-    archiveFileName = gangliaEventsFile + '.archived.' + str(time.time()).split('.')[0]
-    newFile = open(archiveFileName, 'w')
-    newFile.write(json.dumps(archiveEvents))
-    newFile.close()
+# splits the events file into the archive and a temp file of kept events with
+# 'split' (splitEventsStream or splitEventsInMemory), then copies the kept events back
+# over the events file. returns a tuple of (archived count, kept count)
+def truncateInPlace(eventsFile, archive, retention, split):
+    tempFileName = eventsFile.name + '.tmp'
+    (archived, kept) = split(eventsFile, retention, archive,
+                             JsonArrayWriter(open(tempFileName, 'w', bufferSize), tempFileName))
 
     # truncate events file, rewriting only recent events to it
+    tempFile = open(tempFileName, 'r', bufferSize)
     eventsFile.seek(0)
     eventsFile.truncate()
-    eventsFile.write(json.dumps(recentEvents))
+    shutil.copyfileobj(tempFile, eventsFile, bufferSize)
+    tempFile.close()
+    os.remove(tempFileName)
+    return (archived, kept)
+
+
+# true if the list is in ascending order, checked in a single pass
+def isSorted(values):
+    for (a, b) in izip(values, islice(values, 1, None)):
+        if a > b:
+            return False
+    return True
+
+
+# loads and splits the whole events file in memory, sorted by start time, writing the
+# archived & kept events to their writers. returns a tuple of (archived count, kept
+# count)
+def splitEventsInMemory(eventsFile, retention, archive, keep):
+    data = eventsFile.read()
+
+    # decode the json as python nested objects (this turns into a list of dictionaries in this case)
+    eventsList = json.loads(data, object_hook=encode_object_as_ascii)
+    startTimes = [float(event['start_time']) for event in eventsList]
+
+    # ganglia appends new events, so the file is usually already in order; only sort
+    # when it isn't. (python's sort merges any already-sorted runs it finds, so a
+    # mostly-sorted file is still cheap.)
+    if not isSorted(startTimes):
+        order = sorted(xrange(len(eventsList)), key=startTimes.__getitem__)
+        eventsList = [eventsList[i] for i in order]
+        startTimes = [startTimes[i] for i in order]
+
+    # everything before the oldest cutoff is archived, and everything from the newest
+    # on is kept. (with a single retention rule, they're the same.)
+    low = bisect.bisect_left(startTimes, retention.oldest)
+    high = bisect.bisect_left(startTimes, retention.newest, low)
+    for i in xrange(low):
+        archive.write(json.dumps(eventsList[i]), startTimes[i])
+    for i in xrange(low, high):
+        if retention.archives(startTimes[i], eventsList[i]):
+            archive.write(json.dumps(eventsList[i]), startTimes[i])
+        else:
+            keep.write(json.dumps(eventsList[i]))
+    for i in xrange(high, len(eventsList)):
+        keep.write(json.dumps(eventsList[i]))
+    archive.close()
+    keep.close()
+    return (archive.count, keep.count)
+
+
+# locks the events file exclusively. php's flock() (i.e. gweb's file_put_contents()
+# with LOCK_EX) doesn't see lockf() locks on linux, so both kinds are taken.
+def lockEventsFile(eventsFile):
+    fcntl.lockf(eventsFile, fcntl.LOCK_EX)
+    fcntl.flock(eventsFile, fcntl.LOCK_EX)
+
+def unlockEventsFile(eventsFile):
+    fcntl.flock(eventsFile, fcntl.LOCK_UN)
     fcntl.lockf(eventsFile, fcntl.LOCK_UN)
-    eventsFile.close()
 
-    print "Archived all but most recent %d events into file [%s]." % (len(recentEvents), archiveFileName)
 
+# what identifies a version of a file's contents, given its stat
+def fileVersion(fileStat):
+    return (fileStat.st_ino, fileStat.st_size, fileStat.st_mtime)
+
+
+# copies the events file to 'snapshotName' with the events file locked, so the copy is
+# consistent. returns a tuple of (the events file's stat, seconds the lock was held)
+def snapshotEventsFile(eventsFileName, snapshotName):
+    snapshot = open(snapshotName, 'w', bufferSize)
+    eventsFile = open(eventsFileName, 'r+')
+    lockEventsFile(eventsFile)
+    lockTime = time.time()
+    try:
+        shutil.copyfileobj(eventsFile, snapshot, bufferSize)
+        snapshot.close()
+        return (os.fstat(eventsFile.fileno()), time.time() - lockTime)
+    finally:
+        unlockEventsFile(eventsFile)
+        eventsFile.close()
+
+
+# renames the temp file over the events file, if the events file is still the version
+# that was snapshotted (per its stat, 'expected'). if it's been changed, it's
+# snapshotted again to 'snapshotName' instead. returns a tuple of (None if the temp
+# file was renamed, otherwise the events file's new stat; the replaced events file,
+# still open but unlocked, if the temp file was renamed, otherwise None; seconds the
+# lock was held)
+def replaceEventsFile(eventsFileName, tempFileName, snapshotName, expected):
+    # the new file has to keep the old one's owner & mode, so gweb can still write it
+    os.chmod(tempFileName, stat.S_IMODE(expected.st_mode))
+    tempStat = os.stat(tempFileName)
+    if (tempStat.st_uid, tempStat.st_gid) != (expected.st_uid, expected.st_gid):
+        os.chown(tempFileName, expected.st_uid, expected.st_gid)
+
+    eventsFile = open(eventsFileName, 'r+')
+    lockEventsFile(eventsFile)
+    lockTime = time.time()
+    renamed = False
+    try:
+        current = os.fstat(eventsFile.fileno())
+        if fileVersion(current) == fileVersion(expected):
+            os.rename(tempFileName, eventsFileName)
+            renamed = True
+            return (None, eventsFile, time.time() - lockTime)
+        snapshot = open(snapshotName, 'w', bufferSize)
+        shutil.copyfileobj(eventsFile, snapshot, bufferSize)
+        snapshot.close()
+        return (current, None, time.time() - lockTime)
+    finally:
+        unlockEventsFile(eventsFile)
+        if not renamed:
+            eventsFile.close()
+
+
+# returns the raw json of any events gweb wrote to the events file after it was
+# replaced. a writer that opened events.json before the rename and was waiting on its
+# lock writes to the replaced (unlinked) file once it's unlocked, so after
+# renameGraceSeconds the replaced file is locked again through 'replacedFile', the fd
+# still open on it, and compared with the snapshot it was replaced as (per its stat,
+# 'expected', and 'snapshotName'). this closes 'replacedFile'.
+# a writer that only gets the lock after this check still writes to the replaced file,
+# and its event is lost; that window can only be closed by gweb re-opening & re-stat'ing
+# events.json once it has the lock.
+def strayEvents(replacedFile, expected, snapshotName, strayName):
+    time.sleep(renameGraceSeconds)
+    lockEventsFile(replacedFile)
+    try:
+        if fileVersion(os.fstat(replacedFile.fileno())) == fileVersion(expected):
+            return []
+        replacedFile.seek(0)
+        stray = open(strayName, 'w', bufferSize)
+        shutil.copyfileobj(replacedFile, stray, bufferSize)
+        stray.close()
+    finally:
+        unlockEventsFile(replacedFile)
+        replacedFile.close()
+    try:
+        return list(appendedEvents(snapshotName, strayName))
+    except EventsChanged, e:
+        sys.stderr.write("WARNING: events file [%s] was changed after it was replaced (%s); those changes are lost.\n"
+                         % (replacedFile.name, e))
+        return []
+
+
+# yields the raw json of each event appended to the events file between two snapshots
+# of it. raises EventsChanged (before yielding anything) if the newer snapshot isn't
+# just the older one with events added to the end.
+def appendedEvents(olderName, newerName):
+    newer = readEvents(open(newerName, 'r', bufferSize))
+    for (startTime, rawJson) in readEvents(open(olderName, 'r', bufferSize)):
+        try:
+            (newStartTime, newRawJson) = newer.next()
+        except StopIteration:
+            raise EventsChanged("events were removed")
+        # gweb rewrites the whole file when it adds an event, so unchanged events can
+        # still be formatted differently
+        if newRawJson != rawJson and json.loads(newRawJson) != json.loads(rawJson):
+            raise EventsChanged("events were changed or removed")
+    for (startTime, rawJson) in newer:
+        yield rawJson
+
+
+# truncates the events file without holding its lock while it's split:
+#   1. with the events file locked, copy it to a snapshot
+#   2. unlocked, split the snapshot into the archive & a temp file of kept events
+#   3. with the events file locked again, if it hasn't changed, rename the temp file
+#      over it. otherwise snapshot it again, and (unlocked) add whatever events were
+#      appended since the last snapshot to the temp file, and retry.
+#   4. if gweb wrote events to the replaced file (see strayEvents), snapshot the new
+#      events file, add them to a copy of it, and go back to 3.
+# if the events file is changed other than by appending events, or keeps changing,
+# before it's been replaced, the archive is rolled back and EventsChanged is raised.
+# returns a tuple of (archived count, kept count, total seconds the events file was
+# locked)
+def truncateAtomic(eventsFileName, archive, retention, split, maxAttempts=5):
+    snapshotName = eventsFileName + '.snapshot'
+    newerSnapshotName = eventsFileName + '.snapshot.new'
+    tempFileName = eventsFileName + '.tmp'
+    replaced = False
+    try:
+        (expected, lockTime) = snapshotEventsFile(eventsFileName, snapshotName)
+        (archived, kept) = split(open(snapshotName, 'r', bufferSize), retention, archive,
+                                 JsonArrayWriter(open(tempFileName, 'w', bufferSize), tempFileName))
+        for attempt in range(maxAttempts):
+            (current, replacedFile, held) = replaceEventsFile(eventsFileName, tempFileName, newerSnapshotName, expected)
+            lockTime = lockTime + held
+            if current is None:
+                replaced = True
+                stray = strayEvents(replacedFile, expected, snapshotName, newerSnapshotName)
+                if len(stray) == 0:
+                    return (archived, kept, lockTime)
+
+                # the events file has already been truncated, so from here on the
+                # archive has to be kept, even if the stray events can't be added back
+                (expected, held) = snapshotEventsFile(eventsFileName, snapshotName)
+                lockTime = lockTime + held
+                keep = JsonArrayWriter(open(tempFileName, 'w', bufferSize), tempFileName)
+                for (startTime, rawJson) in readEvents(open(snapshotName, 'r', bufferSize)):
+                    keep.write(rawJson)
+                for rawJson in stray:
+                    keep.write(rawJson)
+                keep.close()
+                kept = keep.count
+                continue
+
+            # events added since the split are recent, so they're all kept
+            tempFile = open(tempFileName, 'r+')
+            tempFile.seek(-1, 2)
+            tempFile.truncate()
+            keep = JsonArrayWriter(tempFile, tempFileName, kept)
+            for rawJson in appendedEvents(snapshotName, newerSnapshotName):
+                keep.write(rawJson)
+            keep.close()
+            kept = keep.count
+            os.rename(newerSnapshotName, snapshotName)
+            expected = current
+        if replaced:
+            sys.stderr.write("WARNING: events written to [%s] while it was replaced couldn't be added back after %d attempts; they're lost.\n"
+                             % (eventsFileName, maxAttempts))
+            return (archived, kept, lockTime)
+        raise EventsChanged("it was still changing after %d attempts" % maxAttempts)
+    except:
+        if not replaced:
+            archive.rollback()
+        raise
+    finally:
+        for path in (snapshotName, newerSnapshotName, tempFileName):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# truncates one events file, archiving into 'archiveDir' with -S/--segments, and
+# returns a summary of it as a dict
+def truncateEventsFile(eventsFileName, archiveDir, retention, now):
+    startTime = time.time()
+    if options.segments:
+        archive = SegmentArchive(archiveDir, options.codec, options.level)
+    else:
+        archiveFileName = eventsFileName + '.archived.' + str(now).split('.')[0] + archiveCodecs[options.codec][0]
+        archive = JsonArrayWriter(openArchiveWriter(archiveFileName, options.codec, options.level), archiveFileName)
+    split = splitEventsInMemory
+    if options.stream:
+        split = splitEventsStream
+
+    lockTime = None
+    if options.atomic:
+        (archived, kept, lockTime) = truncateAtomic(eventsFileName, archive, retention, split)
+    else:
+        eventsFile = open(eventsFileName, 'r+')
+        fcntl.lockf(eventsFile, fcntl.LOCK_SH)
+        (archived, kept) = truncateInPlace(eventsFile, archive, retention, split)
+        fcntl.lockf(eventsFile, fcntl.LOCK_UN)
+        eventsFile.close()
+    return {'events_file': eventsFileName, 'archive': archive.name, 'archived': archived, 'kept': kept,
+            'bytes': archive.bytes, 'stored_bytes': archive.stored_bytes, 'lock_time': lockTime,
+            'seconds': time.time() - startTime}
+
+
+# truncates one events file of a batch, in a pool worker. errors are returned in the
+# summary, so one bad file doesn't stop the rest of the batch.
+def truncateBatchFile(args):
+    (eventsFileName, now) = args
+    startTime = time.time()
+    try:
+        return truncateEventsFile(eventsFileName, eventsFileName + '.archive', policy.forFile(eventsFileName, now), now)
+    except EventsChanged, e:
+        error = "changed while it was being truncated (%s), so it was left as it was" % e
+    except Exception, e:
+        error = traceback.format_exc().strip().split('\n')[-1]
+    return {'events_file': eventsFileName, 'error': error, 'seconds': time.time() - startTime}
+
+
+# truncates many events files, 'jobs' at a time, each with the same 'now' so they all
+# get the same cutoffs. prints a summary line per file as each finishes, then totals.
+# returns the number of files which failed.
+def truncateBatch(eventsFiles, jobs, now):
+    startTime = time.time()
+    work = [(eventsFileName, now) for eventsFileName in eventsFiles]
+    pool = None
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        results = pool.imap_unordered(truncateBatchFile, work)
+    else:
+        results = imap(truncateBatchFile, work)
+
+    print "%-48s %10s %10s %14s %9s %9s" % ('events file', 'archived', 'kept', 'stored bytes', 'seconds', 'lock ms')
+    (failed, archived, kept, storedBytes, busyTime) = (0, 0, 0, 0, 0.0)
+    for summary in results:
+        busyTime = busyTime + summary['seconds']
+        if 'error' in summary:
+            failed = failed + 1
+            print "%-48s ERROR: %s" % (summary['events_file'], summary['error'])
+        else:
+            lockTime = '-'
+            if summary['lock_time'] is not None:
+                lockTime = "%.1f" % (summary['lock_time'] * 1000)
+            print "%-48s %10d %10d %14d %9.2f %9s" % (summary['events_file'], summary['archived'], summary['kept'],
+                                                      summary['stored_bytes'], summary['seconds'], lockTime)
+            archived = archived + summary['archived']
+            kept = kept + summary['kept']
+            storedBytes = storedBytes + summary['stored_bytes']
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print "Truncated %d of %d events files in %.2f seconds (%.2f seconds of work), archiving %d events (%d bytes) \
+and keeping %d." % (len(work) - failed, len(work), time.time() - startTime, busyTime, archived, storedBytes, kept)
+    return failed
+
+
+# parses a --from/--to time, given as epoch seconds or a local 'YYYY-MM-DD[ HH:MM[:SS]]'
+def parseTime(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for timeFormat in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, timeFormat))
+        except ValueError:
+            pass
+    raise ValueError("Unable to parse time %s" % repr(value))
+
+
+# lists the per-run archive files (<events file>.archived.<epoch>[.gz|.bz2|.xz])
+def archiveFiles(eventsFileName):
+    (directory, prefix) = os.path.split(os.path.abspath(eventsFileName))
+    prefix = prefix + '.archived.'
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.startswith(prefix)]
+
+
+# yields the raw json of each event in a per-run archive file which started in
+# [start, end). these have no index, so the whole file is read.
+def queryArchiveFile(path, start, end):
+    archiveFile = openArchiveReader(path)
+    for (startTime, rawJson) in readEvents(archiveFile):
+        if start <= startTime < end:
+            yield flattenEvent(rawJson)
+    archiveFile.close()
+
+
+# prints the archived events which started in [start, end), one json event per line
+def queryArchive(events):
+    count = 0
+    for rawEvent in events:
+        sys.stdout.write(rawEvent)
+        sys.stdout.write('\n')
+        count = count + 1
+    sys.stderr.write("Found %d archived events.\n" % count)
+
+
+# compresses a sample of the events file, in the same size blocks as the archive
+# segments, with each codec and a few levels, and prints the compression ratio and
+# throughput of each.
+def benchmarkCodecs(eventsFile, sampleBytes):
+    blocks = []
+    lines = []
+    size = 0
+    for (startTime, rawJson) in readEvents(eventsFile):
+        lines.append(flattenEvent(rawJson) + '\n')
+        size = size + len(rawJson) + 1
+        if len(lines) == blockEvents or size >= sampleBytes:
+            blocks.append(''.join(lines))
+            lines = []
+        if size >= sampleBytes:
+            break
+    if len(lines) > 0:
+        blocks.append(''.join(lines))
+
+    levels = {'gzip': (1, 6, 9), 'bz2': (1, 9), 'xz': (0, 6, 9)}
+    megabytes = size / 1048576.0
+    print "Sample: %d events in %d blocks, %.1f MB." % (sum([b.count('\n') for b in blocks]), len(blocks), megabytes)
+    print "%-6s %5s %12s %8s %16s %16s" % ('codec', 'level', 'bytes', 'ratio', 'compress MB/s', 'decompress MB/s')
+    for codec in ('gzip', 'bz2', 'xz'):
+        if codec == 'xz' and lzma is None:
+            print "%-6s (skipped; needs the lzma module)" % codec
+            continue
+        for level in levels[codec]:
+            startTime = time.time()
+            stored = [compressData(block, codec, level) for block in blocks]
+            compressTime = time.time() - startTime
+            startTime = time.time()
+            for block in stored:
+                decompressData(block, codec)
+            decompressTime = time.time() - startTime
+            storedBytes = sum([len(block) for block in stored])
+            print "%-6s %5d %12d %7.1f%% %16.1f %16.1f" % (codec, level, storedBytes, 100.0 * storedBytes / max(size, 1),
+                                                          megabytes / max(compressTime, 1e-9),
+                                                          megabytes / max(decompressTime, 1e-9))
+
+
+parser = OptionParser(usage="%prog [options]\n       %prog [options] batch EVENTS_FILE...\n\
+       %prog [options] query --from TIME [--to TIME]\n       %prog [options] codecs [--sample-size MB]",
+                      description="Truncates a Ganglia events.json file to the most recent 2-weeks (or --max-age) \
+of events, archiving all older events in an archive file.")
+parser.add_option("-f", "--events-file", type='string', dest='events_file', default=gangliaEventsFile,
+                  help="The Ganglia events file to truncate. (default=%s)" % gangliaEventsFile)
+parser.add_option("-m", "--max-age", type='string', dest='max_age', default=str(maxEventAge),
+                  help="Archive events older than this, in seconds or with an s/m/h/d/w suffix, unless a retention \
+rule matches them. (default=%d)" % maxEventAge)
+parser.add_option("-r", "--retention-rules", type='string', dest='retention_rules', default=None,
+                  help="A json file of a list of retention rules, each with a max_age, and any of an events_file \
+glob, a cluster, and a host_regex. Events are kept for the max_age of the first rule they match.")
+parser.add_option("-j", "--jobs", type='int', dest='jobs', default=multiprocessing.cpu_count(),
+                  help="batch: the number of events files to truncate at once, each in its own process. \
+(default=%d, the number of CPUs)" % multiprocessing.cpu_count())
+parser.add_option("-s", "--stream", action='store_true', dest='stream', default=False,
+                  help="Split the events file while reading it, one event at a time, instead of loading (and \
+sorting) the whole file. Uses a constant amount of memory.")
+parser.add_option("-A", "--atomic", action='store_true', dest='atomic', default=False,
+                  help="Only lock the events file to copy it, and to rename the truncated file into place \
+(keeping any events appended meanwhile), instead of for the whole run.")
+parser.add_option("-S", "--segments", action='store_true', dest='segments', default=False,
+                  help="Append archived events to weekly, indexed segment files in the --archive-dir, instead \
+of a new archive file each run.")
+parser.add_option("-a", "--archive-dir", type='string', dest='archive_dir', default=None,
+                  help="The directory of archive segments. (default=<events file>.archive)")
+parser.add_option("-c", "--codec", type='choice', dest='codec', choices=sorted(archiveCodecs.keys()), default='none',
+                  help="Compress archived events with this codec: bz2, gzip, xz (needs the lzma module), or none. \
+Compressed archives are read transparently. (default=none)")
+parser.add_option("-l", "--level", type='int', dest='level', default=None,
+                  help="The --codec's compression level. Lower is faster, higher is smaller. (default=6 for gzip \
+and xz, 9 for bz2)")
+parser.add_option("--from", type='string', dest='start', default=None,
+                  help="query: the start of the time range, as epoch seconds or a local 'YYYY-MM-DD[ HH:MM[:SS]]'.")
+parser.add_option("--to", type='string', dest='end', default=None,
+                  help="query: the end of the time range (exclusive). (default=now)")
+parser.add_option("--archive-files", action='store_true', dest='archive_files', default=False,
+                  help="query: also search the per-run archive files (<events file>.archived.*), which have \
+no index, so are read in full.")
+parser.add_option("--sample-size", type='int', dest='sample_size', default=16,
+                  help="codecs: the MB of events to benchmark with. (default=16)")
+(options, args) = parser.parse_args()
+
+if options.archive_dir is None:
+    options.archive_dir = options.events_file + '.archive'
+checkCodec(options.codec)
+if options.level is None:
+    options.level = archiveCodecs[options.codec][1]
+elif options.codec != 'none' and not (archiveCodecs[options.codec][2][0] <= options.level <= archiveCodecs[options.codec][2][1]):
+    parser.error("%s levels are %d to %d" % ((options.codec,) + archiveCodecs[options.codec][2]))
+
+try:
+    rules = []
+    if options.retention_rules is not None:
+        rules = json.load(open(options.retention_rules))
+        if not isinstance(rules, list):
+            raise ValueError("Retention rules must be a json list")
+    policy = RetentionPolicy(rules, parseAge(options.max_age))
+except (IOError, ValueError, re.error), e:
+    parser.error("%s: %s" % (options.retention_rules or options.max_age, e))
+
+if args == ['codecs']:
+    benchmarkCodecs(open(options.events_file, 'r'), options.sample_size * 1048576)
+    sys.exit(0)
+
+if len(args) > 0 and args[0] == 'batch':
+    if len(args) < 2:
+        parser.error("batch needs one or more events files")
+    if options.archive_dir != options.events_file + '.archive':
+        parser.error("batch archives each events file to <events file>.archive, so can't take --archive-dir")
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    eventsFiles = []
+    for eventsFileName in args[1:]:
+        if eventsFileName not in eventsFiles:
+            eventsFiles.append(eventsFileName)
+    if truncateBatch(eventsFiles, options.jobs, time.time()) > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+if len(args) > 0:
+    if args != ['query']:
+        parser.error("unknown subcommand: %s" % ' '.join(args))
+    if options.start is None:
+        parser.error("query needs a --from time")
+    try:
+        start = parseTime(options.start)
+        end = time.time()
+        if options.end is not None:
+            end = parseTime(options.end)
+    except ValueError, e:
+        parser.error(str(e))
+
+    sources = []
+    if os.path.isdir(options.archive_dir):
+        sources.append(SegmentArchive(options.archive_dir).query(start, end))
+    if options.archive_files:
+        sources.extend([queryArchiveFile(path, start, end) for path in archiveFiles(options.events_file)])
+    if len(sources) < 1:
+        sys.stderr.write("ERROR: No archive segments found in [%s].\n" % options.archive_dir)
+        sys.exit(1)
+    queryArchive(chain(*sources))
+    sys.exit(0)
+
+try:
+    now = time.time()
+    summary = truncateEventsFile(options.events_file, options.archive_dir, policy.forFile(options.events_file, now), now)
+
+    if options.segments:
+        print "Archived all but most recent %d events into weekly segments in [%s]." % (summary['kept'], summary['archive'])
+    else:
+        print "Archived all but most recent %d events into file [%s]." % (summary['kept'], summary['archive'])
+    if options.codec != 'none':
+        print "Compressed %d bytes of archived events to %d (%.1f%%) with %s level %d." \
+              % (summary['bytes'], summary['stored_bytes'], 100.0 * summary['stored_bytes'] / max(summary['bytes'], 1),
+                 options.codec, options.level)
+    if options.atomic:
+        print "Held the events file's lock for %.1f ms." % (summary['lock_time'] * 1000)
+
+except EventsChanged, e:
+    sys.stderr.write("ERROR: [%s] was changed while it was being truncated (%s), so it was left as it was.\n" \
+                     % (options.events_file, e))
+    sys.exit(1)
 except Exception, e:
     print traceback.format_exc()
     sys.exit(1)
 sys.exit(0)
 
-
@@ -0,0 +1,456 @@
+#!/bin/env python2.6
+#
+# Description:
+#   A stand-in mk-livestatus server, for testing & benchmarking mk-commander without
+#   touching a real Nagios server. It serves synthetic hosts/services tables of any
+#   size over TCP or a UNIX socket, and speaks enough of the livestatus protocol for
+#   mk-commander: Columns, Filter (with And/Or/Negate), Stats, Limit, ColumnHeaders,
+#   OutputFormat csv/json, KeepAlive, ResponseHeader fixed16, and COMMAND.
+#
+#   Latency and failures can be injected, to see how clients cope with a slow or
+#   flaky server.
+#
+# Author: Devin Cherry <youshoulduseunix@gmail.com>
+##
+import sys, os, re, time, json, random, threading, SocketServer
+from optparse import OptionParser, OptionGroup
+
+
+# A synthetic Nagios configuration. Rows are generated from their index on demand,
+# so even a 100k host install doesn't need to be held in memory; only the changes
+# made by COMMANDs are stored.
+class SyntheticNagios:
+    host_columns = ['name', 'address', 'state', 'notifications_enabled', 'scheduled_downtime_depth',
+                    'in_notification_period', 'groups']
+    service_columns = ['host_name', 'host_address', 'description', 'state', 'acknowledged',
+                       'scheduled_downtime_depth', 'host_scheduled_downtime_depth', 'notifications_enabled',
+                       'in_notification_period', 'plugin_output']
+    log_columns = ['time', 'type', 'host_name', 'service_description', 'message']
+    status_columns = ['program_start', 'program_version', 'num_hosts', 'num_services']
+
+    def __init__(self, hosts=1000, servicesPerHost=10, problemPercent=5, hostgroups=10):
+        self.hosts = hosts
+        self.services_per_host = servicesPerHost
+        self.problem_percent = problemPercent
+        self.hostgroups = hostgroups
+        self.program_start = int(time.time())
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.disabled_hosts = {}
+        self.disabled_host_services = {}
+        self.acknowledged = {}
+        self.commands_received = 0
+
+    # a cheap, deterministic pseudo-random number in [0, 100) for a row
+    def _roll(self, i, salt):
+        return ((i * 2654435761 + salt * 40503) % 4294967296) % 100
+
+    def hostName(self, i):
+        return "host%06d" % i
+
+    def hostAddress(self, i):
+        return "10.%d.%d.%d" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+    def hostIndex(self, name):
+        try:
+            i = int(name[4:])
+        except ValueError:
+            return None
+        if name.startswith('host') and 0 <= i < self.hosts:
+            return i
+        return None
+
+    def hostRows(self):
+        for i in xrange(self.hosts):
+            name = self.hostName(i)
+            yield (name, self.hostAddress(i), int(self._roll(i, 1) < 1),
+                   int(not self.disabled_hosts.has_key(name)), int(self._roll(i, 2) < 2), 1,
+                   ['group%d' % (i % self.hostgroups)])
+
+    def serviceRows(self):
+        for i in xrange(self.hosts):
+            name = self.hostName(i)
+            address = self.hostAddress(i)
+            hostDowntime = int(self._roll(i, 2) < 2)
+            notifications = int(not self.disabled_host_services.has_key(name))
+            for j in xrange(self.services_per_host):
+                n = i * self.services_per_host + j
+                description = "svc%02d" % j
+                state = 0
+                if self._roll(n, 3) < self.problem_percent:
+                    state = 1 + self._roll(n, 4) % 3
+                acked = int(self.acknowledged.has_key((name, description)))
+                yield (name, address, description, state, acked, int(self._roll(n, 5) < 1), hostDowntime,
+                       notifications, 1, "CHECK %d; load=%d;%d;%d" % (state, n % 7, n % 5, n % 3))
+
+    def servicesByHostgroupRows(self):
+        for row in self.serviceRows():
+            yield row + ('group%d' % (self.hostIndex(row[0]) % self.hostgroups),)
+
+    def logRows(self):
+        for i in xrange(self.hosts):
+            yield (self.program_start - i, 'SERVICE ALERT', self.hostName(i), 'svc00',
+                   "SERVICE ALERT: %s;svc00;CRITICAL;HARD;1;synthetic; line %d" % (self.hostName(i), i))
+
+    def statusRows(self):
+        yield (self.program_start, 'livestatus-mock', self.hosts, self.hosts * self.services_per_host)
+
+    # returns (columns, row generator), or None for an unknown table
+    def table(self, name):
+        tables = {
+            'hosts':                (self.host_columns, self.hostRows),
+            'services':             (self.service_columns, self.serviceRows),
+            'servicesbyhostgroup':  (self.service_columns + ['hostgroup_name'], self.servicesByHostgroupRows),
+            'log':                  (self.log_columns, self.logRows),
+            'status':               (self.status_columns, self.statusRows),
+        }
+        for empty in ['timeperiods', 'contacts', 'contactgroups', 'columns', 'hostgroups', 'servicegroups',
+                      'servicesbygroup', 'hostsbygroup', 'commands', 'downtimes', 'comments']:
+            tables[empty] = (['name'], lambda: iter([]))
+        return tables.get(name)
+
+    # applies an external command. returns True if it changed any table data.
+    def command(self, line):
+        m = re.match(r'^COMMAND \[[0-9.]+\] ([A-Z_]+);?(.*)$', line)
+        self.lock.acquire()
+        try:
+            self.commands_received = self.commands_received + 1
+            if not m:
+                return False
+            (name, args) = (m.group(1), m.group(2).split(';'))
+            if name == 'DISABLE_HOST_NOTIFICATIONS':
+                self.disabled_hosts[args[0]] = True
+            elif name == 'ENABLE_HOST_NOTIFICATIONS':
+                self.disabled_hosts.pop(args[0], None)
+            elif name == 'DISABLE_HOST_SVC_NOTIFICATIONS':
+                self.disabled_host_services[args[0]] = True
+            elif name == 'ENABLE_HOST_SVC_NOTIFICATIONS':
+                self.disabled_host_services.pop(args[0], None)
+            elif name == 'ACKNOWLEDGE_SVC_PROBLEM' and len(args) > 1:
+                self.acknowledged[(args[0], args[1])] = True
+            else:
+                return False
+            self.generation = self.generation + 1
+            return True
+        finally:
+            self.lock.release()
+
+
+# An error which is reported to the client with a livestatus status code
+class QueryError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+# Runs one GET request against the synthetic tables
+class Query:
+    operators = {
+        '=':    lambda a, b: a == b,
+        '!=':   lambda a, b: a != b,
+        '<':    lambda a, b: a < b,
+        '>':    lambda a, b: a > b,
+        '<=':   lambda a, b: a <= b,
+        '>=':   lambda a, b: a >= b,
+        '~':    lambda a, b: re.search(b, str(a)) is not None,
+        '~~':   lambda a, b: re.search(b, str(a), re.IGNORECASE) is not None,
+        '=~':   lambda a, b: str(a).lower() == str(b).lower(),
+    }
+
+    def __init__(self, nagios, tableName, headers):
+        table = nagios.table(tableName)
+        if table is None:
+            raise QueryError(404, "Invalid GET request, no such table '%s'" % tableName)
+        (self.all_columns, self.rows) = table
+        self.table_name = tableName
+        self.columns = None
+        self.filters = []
+        self.stats = []
+        self.limit = None
+        self.column_headers = False
+        self.output_format = 'csv'
+
+        for (key, value) in headers:
+            if key == 'Columns':
+                self.columns = value.split()
+            elif key == 'Filter':
+                self.filters.append(self._parseFilter(value))
+            elif key == 'Stats':
+                self.stats.append(self._parseFilter(value))
+            elif key in ('Or', 'And', 'StatsOr', 'StatsAnd'):
+                stack = self.filters
+                if key.startswith('Stats'):
+                    stack = self.stats
+                count = int(value)
+                if count > len(stack):
+                    raise QueryError(400, "%s: %d, but only %d filters on the stack" % (key, count, len(stack)))
+                operands = stack[len(stack) - count:]
+                del stack[len(stack) - count:]
+                if key.endswith('Or'):
+                    stack.append(lambda row, operands=operands: any([f(row) for f in operands]))
+                else:
+                    stack.append(lambda row, operands=operands: all([f(row) for f in operands]))
+            elif key == 'Negate':
+                f = self.filters.pop()
+                self.filters.append(lambda row, f=f: not f(row))
+            elif key == 'Limit':
+                self.limit = int(value)
+            elif key == 'ColumnHeaders':
+                self.column_headers = (value == 'on')
+            elif key == 'OutputFormat':
+                self.output_format = value
+
+        if self.columns is None:
+            if len(self.stats) > 0:
+                self.columns = []
+            else:
+                self.columns = list(self.all_columns)
+        self.indexes = [self._columnIndex(c) for c in self.columns]
+
+    # finds a column, allowing the 'host_'/'service_' prefixes livestatus accepts
+    def _columnIndex(self, name):
+        candidates = [name]
+        for prefix in ('host_', 'service_'):
+            if name.startswith(prefix):
+                candidates.append(name[len(prefix):])
+        for candidate in candidates:
+            if candidate in self.all_columns:
+                return self.all_columns.index(candidate)
+        raise QueryError(400, "Table '%s' has no column '%s'" % (self.table_name, name))
+
+    def _parseFilter(self, spec):
+        parts = spec.split(None, 2)
+        if len(parts) < 2 or not self.operators.has_key(parts[1]):
+            raise QueryError(400, "invalid filter '%s'" % spec)
+        index = self._columnIndex(parts[0])
+        op = self.operators[parts[1]]
+        value = ''
+        if len(parts) > 2:
+            value = parts[2]
+        typedValues = {}
+
+        def match(row):
+            actual = row[index]
+            if isinstance(actual, list):
+                return value in actual
+            # compare numbers as numbers, converting the filter value just once
+            if not typedValues.has_key(type(actual)):
+                try:
+                    typedValues[type(actual)] = type(actual)(value)
+                except ValueError:
+                    typedValues[type(actual)] = value
+            return op(actual, typedValues[type(actual)])
+        return match
+
+    # returns the result rows, each a list of values
+    def run(self):
+        results = []
+        if len(self.stats) > 0:
+            groups = {}
+            order = []
+            for row in self.rows():
+                if not all([f(row) for f in self.filters]):
+                    continue
+                key = tuple([row[i] for i in self.indexes])
+                if not groups.has_key(key):
+                    groups[key] = [0] * len(self.stats)
+                    order.append(key)
+                counts = groups[key]
+                for n in range(len(self.stats)):
+                    if self.stats[n](row):
+                        counts[n] = counts[n] + 1
+            if len(order) < 1 and len(self.indexes) < 1:
+                order.append(())
+                groups[()] = [0] * len(self.stats)
+            for key in order:
+                results.append(list(key) + groups[key])
+        else:
+            for row in self.rows():
+                if self.limit is not None and len(results) >= self.limit:
+                    break
+                if all([f(row) for f in self.filters]):
+                    results.append([row[i] for i in self.indexes])
+
+        if self.column_headers:
+            header = list(self.columns)
+            for n in range(len(self.stats)):
+                header.append("stats_%d" % (n + 1))
+            results.insert(0, header)
+        return results
+
+    def format(self, rows):
+        if self.output_format == 'json':
+            return "[" + ",\n".join([json.dumps(row) for row in rows]) + "]\n"
+        if self.output_format == 'python':
+            return "[" + ",\n".join([repr(row) for row in rows]) + "]\n"
+        lines = []
+        for row in rows:
+            values = []
+            for value in row:
+                if isinstance(value, list):
+                    values.append(','.join([str(v) for v in value]))
+                else:
+                    values.append(str(value))
+            lines.append(';'.join(values))
+        return ''.join([line + "\n" for line in lines])
+
+
+# Handles one client connection, which may carry many requests with KeepAlive
+class LivestatusHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        config = self.server.config
+        while True:
+            request = []
+            line = self.rfile.readline()
+            while line not in ('', '\n'):
+                request.append(line.rstrip('\n'))
+                line = self.rfile.readline()
+            if len(request) < 1:
+                if line == '':
+                    return
+                continue
+
+            if config.latency > 0:
+                time.sleep(config.latency)
+            if config.fail_rate > 0 and random.random() < config.fail_rate:
+                # drop the connection without a response, like a crashed/restarted server
+                return
+
+            if request[0].startswith('COMMAND'):
+                # several commands may arrive in one request; none get a response
+                changed = False
+                for c in request:
+                    if c.startswith('COMMAND') and self.server.nagios.command(c):
+                        changed = True
+                if changed:
+                    self.server.clearCache()
+                if line == '':
+                    return
+                continue
+
+            headers = []
+            for h in request[1:]:
+                if ':' in h:
+                    (key, value) = h.split(':', 1)
+                    headers.append((key.strip(), value.strip()))
+            options = dict(headers)
+            keepalive = options.get('KeepAlive') == 'on'
+            fixed16 = options.get('ResponseHeader') == 'fixed16'
+
+            (status, body) = self.server.answer(request[0], headers)
+            # header and body go out in one sendall(), like livestatus does. wfile
+            # would split them into 8k writes, and nagle holds back the last short
+            # segment until the client's delayed ack, adding ~40ms to each request.
+            if fixed16:
+                body = "%3d %11d\n" % (status, len(body)) + body
+            self.request.sendall(body)
+            if not keepalive or line == '':
+                return
+
+
+# Answers queries, caching each distinct response until a COMMAND changes the data,
+# so a benchmark measures the client rather than this script.
+class MockServerMixin:
+    def configure(self, nagios, config):
+        self.nagios = nagios
+        self.config = config
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+    def clearCache(self):
+        self.cache_lock.acquire()
+        self.cache = {}
+        self.cache_lock.release()
+
+    # returns (status, body) for a GET request line and its headers
+    def answer(self, requestLine, headers):
+        key = (requestLine, tuple([h for h in headers if h[0] not in ('KeepAlive', 'ResponseHeader')]))
+        self.cache_lock.acquire()
+        cached = self.cache.get(key)
+        self.cache_lock.release()
+        if cached is not None:
+            return cached
+
+        try:
+            if not requestLine.startswith('GET '):
+                raise QueryError(400, "Invalid request method")
+            query = Query(self.nagios, requestLine[4:].strip(), headers)
+            result = (200, query.format(query.run()))
+        except QueryError, e:
+            result = (e.status, str(e) + "\n")
+
+        self.cache_lock.acquire()
+        if len(self.cache) > 64:
+            self.cache = {}
+        self.cache[key] = result
+        self.cache_lock.release()
+        return result
+
+
+class TcpMockServer(MockServerMixin, SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixMockServer(MockServerMixin, SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+# builds a (not yet running) mock server from parsed options
+def createServer(options):
+    nagios = SyntheticNagios(hosts=options.hosts, servicesPerHost=options.services_per_host,
+                             problemPercent=options.problem_percent)
+    if options.unix_socket != '':
+        if os.path.exists(options.unix_socket):
+            os.remove(options.unix_socket)
+        server = UnixMockServer(options.unix_socket, LivestatusHandler)
+    else:
+        server = TcpMockServer((options.address, options.port), LivestatusHandler)
+    server.configure(nagios, options)
+    return server
+
+
+def createParser():
+    parser = OptionParser(description="A stand-in mk-livestatus server with synthetic data, for testing and "
+                                      + "benchmarking livestatus clients.")
+    optGroup = OptionGroup(parser, "Listener Options")
+    optGroup.add_option("-a", "--address", type='string', dest='address', default='127.0.0.1',
+                        help="The address to listen on. (default=127.0.0.1)")
+    optGroup.add_option("-p", "--port", type='int', dest='port', default=6557,
+                        help="The TCP port to listen on. (default=6557)")
+    optGroup.add_option("-u", "--unix-socket", type='string', dest='unix_socket', default='',
+                        help="Listen on this UNIX socket path instead of TCP.")
+    parser.add_option_group(optGroup)
+
+    optGroup = OptionGroup(parser, "Data Options")
+    optGroup.add_option("-n", "--hosts", type='int', dest='hosts', default=1000,
+                        help="Number of synthetic hosts. (default=1000)")
+    optGroup.add_option("-s", "--services-per-host", type='int', dest='services_per_host', default=10,
+                        help="Number of services on each host. (default=10)")
+    optGroup.add_option("--problem-percent", type='int', dest='problem_percent', default=5,
+                        help="Percentage of services in a non-OK state. (default=5)")
+    parser.add_option_group(optGroup)
+
+    optGroup = OptionGroup(parser, "Fault Injection")
+    optGroup.add_option("-l", "--latency", type='float', dest='latency', default=0.0,
+                        help="Seconds to wait before answering each request. (default=0)")
+    optGroup.add_option("-f", "--fail-rate", type='float', dest='fail_rate', default=0.0,
+                        help="Fraction (0-1) of requests answered by dropping the connection. (default=0)")
+    parser.add_option_group(optGroup)
+    return parser
+
+
+if __name__ == "__main__":
+    (options, args) = createParser().parse_args()
+    server = createServer(options)
+    if options.unix_socket != '':
+        print "Serving %d hosts on %s" % (options.hosts, options.unix_socket)
+    else:
+        print "Serving %d hosts on %s:%d" % (options.hosts, options.address, options.port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    if options.unix_socket != '':
+        os.remove(options.unix_socket)
@@ -0,0 +1,214 @@
+#!/bin/env python2.6
+#
+# Description:
+#   Load benchmarks for mk-commander's NagiosServer, run against livestatus-mock.py
+#   so no production Nagios server is involved. For each install size, a mock server
+#   is started in a separate process, and the following are timed:
+#       - send_command:         many small 'GET status' queries
+#       - fetch_remote_targets: downloading & indexing the whole host table
+#       - validate_targets:     checking a few targets with the filtered fast path
+#       - get_current_problems: fetching the current service problems
+#       - bulk_disable/enable:  the -d/-e quick commands for many targets
+#   each with the connection modes that apply (a connection per request, pooled
+#   keep-alive connections, and batches). With --unix, the mocks listen on a UNIX
+#   socket rather than TCP, to compare the two transports.
+#
+# Author: Devin Cherry <youshoulduseunix@gmail.com>
+##
+import sys, os, time, imp, select, subprocess, json
+from optparse import OptionParser
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+
+# mk-commander.py is a script, which runs as soon as it's loaded, so only its
+# definitions (everything above its BEGIN MAIN banner) are loaded, as a module.
+def loadCommander():
+    path = os.path.join(scriptDir, 'mk-commander.py')
+    source = open(path).read()
+    banner = source.find('#           BEGIN MAIN')
+    if banner < 0:
+        sys.stderr.write("ERROR: no BEGIN MAIN banner in %s.\n" % path)
+        sys.exit(1)
+    module = imp.new_module('mk_commander')
+    module.__file__ = path
+    exec compile(source[:banner], path, 'exec') in module.__dict__
+    return module
+
+mk = loadCommander()
+
+
+# starts livestatus-mock.py in its own process, so it doesn't compete with the
+# client for the interpreter lock, and waits for it to say it's listening. a mock
+# which exits instead (i.e. because the port's taken) is an error; just waiting
+# for the port to accept connections would benchmark whatever else is there.
+# 'endpoint' is an (address, port) tuple, as mk-commander's NagiosServer takes.
+def startMock(options, hosts, endpoint):
+    (address, port) = endpoint
+    cmd = [sys.executable, os.path.join(scriptDir, 'livestatus-mock.py'), '-n', str(hosts),
+           '-s', str(options.services_per_host), '-l', str(options.latency), '-f', str(options.fail_rate)]
+    if address.startswith('unix:'):
+        cmd.extend(['-u', address[len('unix:'):]])
+        sockAddress = address[len('unix:'):]
+    else:
+        cmd.extend(['-a', address, '-p', str(port)])
+        sockAddress = (address, port)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    # the mock prints "Serving ..." once it's listening, and nothing else
+    (readable, w, x) = select.select([proc.stdout], [], [], 30)
+    if len(readable) > 0:
+        line = proc.stdout.readline()
+        if line.startswith('Serving'):
+            return proc
+        if line == '':
+            # end of output: the mock has exited
+            proc.wait()
+    if proc.poll() is not None:
+        sys.stderr.write("ERROR: livestatus mock on %s exited with status %d.\n" % (repr(sockAddress), proc.returncode))
+        sys.exit(1)
+    proc.kill()
+    sys.stderr.write("ERROR: livestatus mock on %s didn't start.\n" % repr(sockAddress))
+    sys.exit(1)
+
+
+def newServer(endpoint, keepalive, timeout):
+    return mk.NagiosServer(address=endpoint[0], port=endpoint[1], keepalive=keepalive, poolSize=4,
+                           timeout=timeout)
+
+
+# runs func once untimed (so the mock has the response cached), then 'repeat' more
+# times. returns a tuple of (best, mean) seconds.
+def timeIt(func, repeat):
+    func()
+    times = []
+    for i in range(repeat):
+        startTime = time.time()
+        func()
+        times.append(time.time() - startTime)
+    return (min(times), sum(times) / len(times))
+
+
+def benchSendCommand(endpoint, keepalive, timeout, ops):
+    server = newServer(endpoint, keepalive, timeout)
+    def run():
+        for i in xrange(ops):
+            server.sendCommand(server.commands['get_status'])
+    return run
+
+def benchFetchRemoteTargets(endpoint, keepalive, timeout):
+    def run():
+        newServer(endpoint, keepalive, timeout)._fetchRemoteTargets()
+    return run
+
+def benchValidateTargets(endpoint, keepalive, timeout, targets):
+    def run():
+        newServer(endpoint, keepalive, timeout).validateTargets(targets)
+    return run
+
+def benchGetCurrentProblems(endpoint, keepalive, timeout):
+    server = newServer(endpoint, keepalive, timeout)
+    def run():
+        server.getCurrentProblems()
+    return run
+
+# the -d/-e quick commands, either a sendCommand() per command like the original
+# loop, or as a batch over 'connections' connections
+def benchBulk(endpoint, keepalive, timeout, targets, enable, connections):
+    server = newServer(endpoint, keepalive, timeout)
+    def run():
+        if connections > 0:
+            cmds = {}
+            for target in targets:
+                cmds[target] = [server.buildCommand(c) for c in mk.notificationCommands(target, enable)]
+            results = server.sendCommandBatch(cmds, connections)
+            if len([ok for ok in results.values() if ok]) != len(targets):
+                sys.stderr.write("WARNING: batch failed for some targets.\n")
+        else:
+            for target in targets:
+                for c in mk.notificationCommands(target, enable):
+                    server.sendCommand(server.buildCommand(c))
+    return run
+
+
+def report(options, size, name, mode, ops, result):
+    (best, mean) = result
+    if options.json:
+        print json.dumps({'hosts': size, 'benchmark': name, 'mode': mode, 'ops': ops,
+                          'best': best, 'mean': mean, 'ops_per_sec': ops / max(best, 1e-9)})
+    else:
+        print "%-8d %-22s %-12s %7d %10.4f %10.4f %12.1f" % (size, name, mode, ops, best, mean, ops / max(best, 1e-9))
+    sys.stdout.flush()
+
+
+def runBenchmarks(options, size, endpoint):
+    targets = ["host%06d" % i for i in range(0, size, max(1, size / options.targets))]
+    targets = targets[:options.targets]
+    fewTargets = targets[:5]
+    modes = [('connect', False), ('keepalive', True)]
+
+    for (mode, keepalive) in modes:
+        report(options, size, 'send_command', mode, options.ops,
+               timeIt(benchSendCommand(endpoint, keepalive, options.timeout, options.ops), options.repeat))
+    for (mode, keepalive) in modes:
+        report(options, size, 'fetch_remote_targets', mode, 1,
+               timeIt(benchFetchRemoteTargets(endpoint, keepalive, options.timeout), options.repeat))
+    for (mode, keepalive) in modes:
+        report(options, size, 'validate_targets', mode, len(fewTargets),
+               timeIt(benchValidateTargets(endpoint, keepalive, options.timeout, fewTargets), options.repeat))
+    for (mode, keepalive) in modes:
+        report(options, size, 'get_current_problems', mode, 1,
+               timeIt(benchGetCurrentProblems(endpoint, keepalive, options.timeout), options.repeat))
+
+    for (name, enable) in [('bulk_disable', False), ('bulk_enable', True)]:
+        ops = len(targets) * 3
+        for (mode, keepalive) in modes:
+            report(options, size, name, mode, ops,
+                   timeIt(benchBulk(endpoint, keepalive, options.timeout, targets, enable, 0), options.repeat))
+        for connections in (1, 4):
+            report(options, size, name, 'batch/%d' % connections, ops,
+                   timeIt(benchBulk(endpoint, True, options.timeout, targets, enable, connections), options.repeat))
+
+
+parser = OptionParser(description="Benchmarks mk-commander's livestatus client against a local livestatus mock.")
+parser.add_option("--sizes", type='string', dest='sizes', default='1000,10000,100000',
+                  help="Comma-delimited list of host counts to benchmark. (default=1000,10000,100000)")
+parser.add_option("-s", "--services-per-host", type='int', dest='services_per_host', default=10,
+                  help="Number of services on each mock host. (default=10)")
+parser.add_option("-r", "--repeat", type='int', dest='repeat', default=3,
+                  help="Number of timed runs of each benchmark. (default=3)")
+parser.add_option("-o", "--ops", type='int', dest='ops', default=200,
+                  help="Number of queries in the send_command benchmark. (default=200)")
+parser.add_option("-t", "--targets", type='int', dest='targets', default=200,
+                  help="Number of targets in the bulk -d/-e benchmarks. (default=200)")
+parser.add_option("-l", "--latency", type='float', dest='latency', default=0.0,
+                  help="Seconds of latency the mock adds to each request. (default=0)")
+parser.add_option("-f", "--fail-rate", type='float', dest='fail_rate', default=0.0,
+                  help="Fraction of requests the mock drops. (default=0)")
+parser.add_option("-p", "--port", type='int', dest='port', default=16557,
+                  help="First TCP port for the mock servers. (default=16557)")
+parser.add_option("-u", "--unix", action='store_true', dest='unix', default=False,
+                  help="Run the mock servers on UNIX sockets (in /tmp) instead of TCP.")
+parser.add_option("--timeout", type='int', dest='timeout', default=120,
+                  help="Client socket timeout, in seconds. The mock takes a while to build the big tables. (default=120)")
+parser.add_option("-j", "--json", action='store_true', dest='json', default=False,
+                  help="Print results as json lines.")
+(options, args) = parser.parse_args()
+
+if not options.json:
+    print "%-8s %-22s %-12s %7s %10s %10s %12s" % ('hosts', 'benchmark', 'mode', 'ops', 'best(s)', 'mean(s)', 'ops/sec')
+port = options.port
+for size in [int(s) for s in options.sizes.split(',')]:
+    if options.unix:
+        endpoint = ('unix:/tmp/livestatus-bench.%d.%d' % (os.getpid(), size), port)
+    else:
+        endpoint = ('127.0.0.1', port)
+    proc = startMock(options, size, endpoint)
+    try:
+        runBenchmarks(options, size, endpoint)
+    finally:
+        proc.terminate()
+        proc.wait()
+        if options.unix and os.path.exists(endpoint[0][len('unix:'):]):
+            os.remove(endpoint[0][len('unix:'):])
+    port = port + 1
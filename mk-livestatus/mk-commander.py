@@ -6,17 +6,15 @@
 #
 # Author: Devin Cherry <youshoulduseunix@gmail.com>
 ##
-import socket, sys, time, os, pwd, atexit, commands, math
+import socket, sys, time, os, pwd, atexit, select, errno, threading, re, json, heapq, fcntl, stat, syslog
 from optparse import OptionParser, OptionGroup
-from datetime import timedelta
-from signal import SIGTERM
 
 verbose = False
 
 
-class ServiceProblem:
-    host = ''
-    service = ''
+# __slots__ keeps these small, since there can be tens of thousands of them
+class ServiceProblem(object):
+    __slots__ = ('host', 'service')
     
     def __init__(self, h, s):
         self.host = h
@@ -24,7 +22,8 @@ class ServiceProblem:
 
 
 class NagiosServer:
-    remote_targets = []
+    remote_targets = {}
+    remote_addresses = {}
     address = ''
     port = 6557
     commands = { 
@@ -39,23 +38,70 @@ class NagiosServer:
         'get_services':             'GET services\nColumns: host_name service_description service_state\n' +
                                     'Filter: in_notification_period = 1\n' +
                                     'Filter: notifications_enabled = 1\n', 
+        'get_problems':             'GET services\nColumns: host_name service_description\n' +
+                                    'Filter: in_notification_period = 1\n' +
+                                    'Filter: notifications_enabled = 1\n' +
+                                    'Filter: service_state > 0\n' +
+                                    'Filter: acknowledged = 0\n' +
+                                    'Filter: scheduled_downtime_depth = 0\n' +
+                                    'Filter: host_scheduled_downtime_depth = 0\n', 
     
-    ## These might be useful someday...
-    #    'get_hostgroups':           'GET hostgroups\nOutputFormat: python\n', 
-    #    'get_servicegroups':        'GET servicegroups\nOutputFormat: python\n', 
-    #    'get_servicesbygroup':      'GET servicesbygroup\nOutputFormat: python\n', 
-    #    'get_servicesbyhostgroup':  'GET servicesbyhostgroup\nOutputFormat: python\n', 
-    #    'get_hostsbygroup':         'GET hostsbygroup\nOutputFormat: python\n', 
-    #    'get_commands':             'GET commands\nOutputFormat: python\n', 
-    #    'get_downtimes':            'GET downtimes\n', 
-    #    'get_comments':             'GET comments\nOutputFormat: python\n', 
-    #    'get_status':               'GET status\nOutputFormat: python\n', 
-    #    'get_log':                  'GET log\nOutputFormat: python\n', 
+        # these can be big, so they're streamed rather than buffered
+        'get_hostgroups':           'GET hostgroups\n', 
+        'get_servicegroups':        'GET servicegroups\n', 
+        'get_servicesbygroup':      'GET servicesbygroup\n', 
+        'get_servicesbyhostgroup':  'GET servicesbyhostgroup\n', 
+        'get_hostsbygroup':         'GET hostsbygroup\n', 
+        'get_commands':             'GET commands\n', 
+        'get_downtimes':            'GET downtimes\n', 
+        'get_comments':             'GET comments\n', 
+        'get_status':               'GET status\n', 
+        'get_log':                  'GET log\n', 
+    }
+
+    # cheap query sent after a batch of commands; its reply confirms livestatus has
+    # read every command sent before it on the same connection.
+    sync_query = 'GET status\nColumns: program_start\nKeepAlive: on\nResponseHeader: fixed16\n\n'
+
+    # a batch is sent this many targets at a time, and the sync replies for them are
+    # only read once they've all been sent, so a window's replies (~30 bytes each) have
+    # to fit in the socket buffers, or both ends would block writing.
+    sync_window = 500
+
+    # service state names, in the order their counts come back from a stats query
+    service_states = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+    # the livestatus table and group-by column for each stats grouping
+    stats_groups = {
+        'state':        ('services', None),
+        'host':         ('services', 'host_name'),
+        'hostgroup':    ('servicesbyhostgroup', 'hostgroup_name'),
     }
 
-    def __init__(self, address='', port=6557):
+    def __init__(self, address='', port=6557, keepalive=False, poolSize=2, timeout=10,
+                 cacheDir=None, cacheTtl=0, filterLimit=50):
+        # remote_targets maps host names to addresses, remote_addresses maps them back
+        self.remote_targets = {}
+        self.remote_addresses = {}
+        self.targets_loaded = False
+        self.targets_live = False
+        self.cache_dir = cacheDir
+        self.cache_ttl = cacheTtl
+        self.filter_limit = filterLimit
         self.address = address
         self.port = port
+        # "unix:/path/to/live" addresses talk to livestatus' UNIX socket directly
+        self.socket_path = None
+        if address.startswith('unix:'):
+            self.socket_path = address[len('unix:'):]
+            self.site = address
+        else:
+            self.site = "%s:%d" % (address, port)
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.pool_size = poolSize
+        self.pool = []
+        self.pool_lock = threading.Lock()
 
     # Builds a proper livestatus+nagios command string. example:
     # "COMMAND [1376603554] ADD_HOST_COMMENT;server1.foo.com;1;MrTesty;RogerDodger\n"
@@ -63,17 +109,156 @@ class NagiosServer:
         nag_cmd = self.commands['send_command'] + " [" + repr(date) + "] " + optstring.lstrip().rstrip() + "\n"
         return nag_cmd
 
+    # opens a new connection to the livestatus server, over its UNIX socket for
+    # "unix:" addresses, or else over TCP
+    def _connect(self):
+        if self.socket_path is not None:
+            (family, address) = (socket.AF_UNIX, self.socket_path)
+        else:
+            (family, address) = (socket.AF_INET, (self.address, self.port))
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        s.connect(address)
+        return s
+
+    # an idle keep-alive socket should never be readable; if it is, the server
+    # has closed it (or left junk on it), so it can't be reused.
+    def _isAlive(self, s):
+        try:
+            (readable, w, x) = select.select([s], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return len(readable) == 0
+
+    # takes an idle socket from the pool, or opens a new one if none are usable.
+    # returns a tuple of (socket, reused)
+    def _acquireConnection(self):
+        self.pool_lock.acquire()
+        try:
+            while len(self.pool) > 0:
+                s = self.pool.pop()
+                if self._isAlive(s):
+                    return (s, True)
+                s.close()
+        finally:
+            self.pool_lock.release()
+        return (self._connect(), False)
+
+    # returns a socket to the pool, closing it if the pool is already full
+    def _releaseConnection(self, s):
+        self.pool_lock.acquire()
+        try:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(s)
+                return
+        finally:
+            self.pool_lock.release()
+        s.close()
+
+    # closes all pooled connections
+    def close(self):
+        self.pool_lock.acquire()
+        try:
+            for s in self.pool:
+                s.close()
+            self.pool = []
+        finally:
+            self.pool_lock.release()
+
+    # reads exactly 'length' bytes from the socket
+    def _recvExactly(self, s, length):
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            buf = s.recv(min(remaining, 65536))
+            if not buf:
+                raise socket.error(errno.ECONNRESET, "Connection closed by livestatus server")
+            chunks.append(buf)
+            remaining = remaining - len(buf)
+        return ''.join(chunks)
+
+    # reads a 'ResponseHeader: fixed16' framed response. the header is a 3-digit
+    # status code, a space, the body length padded to 11 chars, and a newline.
+    # returns a tuple of (status, body)
+    def _recvFixed16(self, s):
+        (status, length) = self._recvFixed16Header(s)
+        return (status, self._recvExactly(s, length))
+
+    # reads just the fixed16 header. returns a tuple of (status, body length)
+    def _recvFixed16Header(self, s):
+        header = self._recvExactly(s, 16)
+        try:
+            return (int(header[0:3]), int(header[4:15]))
+        except ValueError:
+            raise socket.error(errno.EPROTO, "Invalid livestatus response header %s" % repr(header))
+
+    # sends a single mk-livestatus command over a pooled keep-alive connection.
+    # queries are framed with a fixed16 response header so the socket can be
+    # reused; nagios commands have no response, so nothing is read back.
+    def _sendPooledCommand(self, cmd):
+        resp = ''
+        retries = 0
+        isQuery = not cmd.startswith(self.commands['send_command'])
+        request = cmd.rstrip('\n') + '\n'
+        if isQuery:
+            request = request + 'KeepAlive: on\nResponseHeader: fixed16\n'
+        request = request + '\n'
+
+        while retries < 3:
+            s = None
+            reused = False
+            try:
+                (s, reused) = self._acquireConnection()
+                if verbose: print "Sending Command: %s" % repr(request)
+                s.sendall(request)
+                if isQuery:
+                    (status, resp) = self._recvFixed16(s)
+                    if status != 200:
+                        # don't trust the connection state after an error response
+                        if verbose: sys.stderr.write("Livestatus returned status %d\n" % status)
+                        s.close()
+                        s = None
+                        break
+                self._releaseConnection(s)
+                s = None
+                if verbose: print "OK"
+                break
+            except socket.timeout, e:
+                sys.stderr.write("Unable to connect to [%s]: %s\n" % (self.site, "Connection Timed Out."))
+                sys.exit(1)
+            except socket.error, e:
+                # the server may drop idle keep-alive connections at any time, so a
+                # failure on a reused socket just means we need a fresh one.
+                if reused:
+                    if verbose: sys.stderr.write("Pooled connection died: reconnecting...\n")
+                    continue
+                sys.stderr.write("Unable to connect to [%s]: %s\n" % (self.site, e.strerror))
+                sys.exit(1)
+            except IOError, e:
+                if verbose: sys.stderr.write("IO Error: retrying...\n")
+                time.sleep(3)
+                retries = retries + 1
+                continue
+            except Exception, e:
+                sys.stderr.write("UNKNOWN ERROR: %s\n" % type(e))
+                sys.exit(1)
+            finally:
+                if s is not None: s.close()
+        return resp
+
     # sends a single mk-livestatus command
     def sendCommand(self, cmd):
+        if self.keepalive:
+            return self._sendPooledCommand(cmd)
+
         resp = ''
         retries = 0
     
         # retry for some types of exceptions
         while retries < 3:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(10)
+            s = None
             try:
-                s.connect((self.address, self.port))
+                s = self._connect()
                 if verbose: print "Sending Command: %s" % repr(cmd)
                 s.sendall(cmd)
                 s.shutdown(socket.SHUT_WR)
@@ -86,10 +271,10 @@ class NagiosServer:
                 if verbose: print "OK"
                 break
             except socket.timeout, e:
-                sys.stderr.write("Unable to connect to [%s:%s]: %s\n" % (self.address, self.port, "Connection Timed Out."))
+                sys.stderr.write("Unable to connect to [%s]: %s\n" % (self.site, "Connection Timed Out."))
                 sys.exit(1)
             except socket.error, e:
-                sys.stderr.write("Unable to connect to [%s:%s]: %s\n" % (self.address, self.port, e.strerror))
+                sys.stderr.write("Unable to connect to [%s]: %s\n" % (self.site, e.strerror))
                 sys.exit(1)
             except IOError, e:
                 if verbose: sys.stderr.write("IO Error: retrying...\n")
@@ -100,85 +285,685 @@ class NagiosServer:
                 sys.stderr.write("UNKNOWN ERROR: %s\n" % type(e))
                 sys.exit(1)
             finally:
-                s.close()
+                if s is not None: s.close()
         return resp
 
+    # connects and sends a query, retrying the same way sendCommand does, but leaves
+    # the response on the socket. returns a tuple of (socket, body length), where the
+    # length is None if the response runs until EOF, or (None, 0) on an error response.
+    def _startQuery(self, cmd):
+        retries = 0
+        while retries < 3:
+            s = None
+            reused = False
+            try:
+                if self.keepalive:
+                    (s, reused) = self._acquireConnection()
+                    request = cmd.rstrip('\n') + '\nKeepAlive: on\nResponseHeader: fixed16\n\n'
+                else:
+                    s = self._connect()
+                    request = cmd
+                if verbose: print "Sending Command: %s" % repr(request)
+                s.sendall(request)
+                if not self.keepalive:
+                    s.shutdown(socket.SHUT_WR)
+                    (conn, s) = (s, None)
+                    return (conn, None)
+
+                (status, length) = self._recvFixed16Header(s)
+                if status != 200:
+                    sys.stderr.write("ERROR: livestatus returned status %d: %s\n" \
+                                     % (status, self._recvExactly(s, length).strip()))
+                    return (None, 0)
+                (conn, s) = (s, None)
+                return (conn, length)
+            except socket.timeout, e:
+                sys.stderr.write("Unable to connect to [%s]: %s\n" % (self.site, "Connection Timed Out."))
+                sys.exit(1)
+            except socket.error, e:
+                if reused:
+                    if verbose: sys.stderr.write("Pooled connection died: reconnecting...\n")
+                    continue
+                sys.stderr.write("Unable to connect to [%s]: %s\n" % (self.site, e.strerror))
+                sys.exit(1)
+            except IOError, e:
+                if verbose: sys.stderr.write("IO Error: retrying...\n")
+                time.sleep(3)
+                retries = retries + 1
+                continue
+            except Exception, e:
+                sys.stderr.write("UNKNOWN ERROR: %s\n" % type(e))
+                sys.exit(1)
+            finally:
+                if s is not None: s.close()
+        return (None, 0)
+
+    # sends a livestatus query, and yields the raw response in chunks as they come
+    # off the socket, rather than buffering the whole response first.
+    def _queryChunks(self, cmd):
+        (s, length) = self._startQuery(cmd)
+        if s is None:
+            return
+
+        finished = False
+        try:
+            while length is None or length > 0:
+                if length is None:
+                    buf = s.recv(65536)
+                else:
+                    buf = s.recv(min(length, 65536))
+                if not buf:
+                    if length is not None:
+                        raise socket.error(errno.ECONNRESET, "Connection closed by livestatus server")
+                    break
+                if length is not None:
+                    length = length - len(buf)
+                yield buf
+            finished = True
+        except socket.timeout, e:
+            sys.stderr.write("Unable to read from [%s]: %s\n" % (self.site, "Connection Timed Out."))
+            sys.exit(1)
+        except socket.error, e:
+            sys.stderr.write("Unable to read from [%s]: %s\n" % (self.site, e.strerror))
+            sys.exit(1)
+        finally:
+            # only a fully-read keep-alive response leaves the socket reusable
+            if finished and self.keepalive:
+                self._releaseConnection(s)
+            else:
+                s.close()
+
+    # sends a livestatus query, and yields the response a line at a time
+    def queryLines(self, cmd):
+        pending = []
+        for buf in self._queryChunks(cmd):
+            if '\n' not in buf:
+                pending.append(buf)
+                continue
+            lines = buf.split('\n')
+            lines[0] = ''.join(pending) + lines[0]
+            pending = [lines.pop()]
+            for line in lines:
+                yield line
+
+        last = ''.join(pending)
+        if last != '':
+            yield last
+
+    # the json module decodes every string as unicode; the rest of this script uses str
+    def _utf8(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [self._utf8(v) for v in value]
+        return value
+
+    # decodes one newline-delimited piece of a livestatus json response, which is
+    # normally a single row. returns a tuple of (complete, rows).
+    def _decodeJsonRows(self, decoder, segment, started):
+        rows = []
+        segment = segment.strip()
+        if not started and segment.startswith('['):
+            segment = segment[1:].lstrip()
+        if segment.startswith(','):
+            segment = segment[1:].lstrip()
+        while segment != '' and segment != ']':
+            try:
+                (row, end) = decoder.raw_decode(segment)
+            except ValueError:
+                return (False, [])
+            rows.append(self._utf8(row))
+            segment = segment[end:].lstrip()
+            if segment.startswith(','):
+                segment = segment[1:].lstrip()
+            elif segment != '' and segment != ']':
+                return (False, [])
+        return (True, rows)
+
+    # runs a GET query against any livestatus table with 'OutputFormat: json', and
+    # yields each row as a list of typed values as soon as it has been read. rows are
+    # newline-delimited on the wire (json escapes any newlines inside values), so the
+    # buffer only ever holds the rows that haven't been completely received yet.
+    def queryRows(self, cmd):
+        decoder = json.JSONDecoder()
+        buf = bytearray()
+        searchFrom = 0
+        started = False
+        for chunk in self._queryChunks(cmd.rstrip('\n') + '\nOutputFormat: json\n'):
+            buf.extend(chunk)
+            pos = 0
+            while True:
+                nl = buf.find('\n', searchFrom)
+                if nl < 0:
+                    break
+                (complete, rows) = self._decodeJsonRows(decoder, str(buf[pos:nl]), started)
+                searchFrom = nl + 1
+                if not complete:
+                    # not a whole row yet; keep reading up to the next newline
+                    continue
+                started = True
+                pos = searchFrom
+                for row in rows:
+                    yield row
+            del buf[:pos]
+            searchFrom = searchFrom - pos
+
+        (complete, rows) = self._decodeJsonRows(decoder, str(buf), started)
+        if not complete:
+            sys.stderr.write("ERROR: invalid json response from [%s]: %s\n" \
+                             % (self.site, repr(str(buf[:200]))))
+        for row in rows:
+            yield row
+
+    # streams every command for the given keys over a single connection, each key's
+    # commands followed by a sync query, sync_window keys per round trip. sets
+    # results[key] to True once livestatus has read all of its commands, or False.
+    # commands such as ADD_HOST_COMMENT aren't idempotent, so nothing which may have
+    # reached livestatus is ever resent. only a window that couldn't be written at all
+    # to a reused connection (i.e. one livestatus has since closed) is retried.
+    def _sendCommandChunk(self, keys, cmdsByKey, results):
+        for key in keys:
+            results[key] = False
+
+        s = None
+        reused = False
+        pos = 0
+        retries = 0
+        try:
+            while pos < len(keys):
+                window = keys[pos:pos + self.sync_window]
+                lines = []
+                for key in window:
+                    for c in cmdsByKey[key]:
+                        lines.append(c.rstrip('\n') + '\n\n')
+                    lines.append(self.sync_query)
+                request = ''.join(lines)
+
+                sent = 0
+                try:
+                    if s is None:
+                        reused = False
+                        (s, reused) = self._acquireConnection()
+                    if verbose: print "Sending %d commands for %d targets" % (len(lines) - len(window), len(window))
+                    # a single send() either writes something or fails having written nothing
+                    sent = s.send(request)
+                    s.sendall(request[sent:])
+                    for key in window:
+                        (status, body) = self._recvFixed16(s)
+                        if status != 200:
+                            sys.stderr.write("ERROR: livestatus returned status %d: %s\n" % (status, body.strip()))
+                            return
+                        results[key] = True
+                except (socket.error, IOError), e:
+                    if s is not None:
+                        s.close()
+                        s = None
+                    if sent == 0 and reused and retries < 2:
+                        if verbose: sys.stderr.write("Pooled connection died: reconnecting...\n")
+                        retries = retries + 1
+                        continue
+                    sys.stderr.write("Unable to send commands to [%s]: %s\n" % (self.site, e))
+                    return
+                pos = pos + len(window)
+                # the next window goes over a connection that's already been used
+                reused = True
+
+            self._releaseConnection(s)
+            s = None
+        finally:
+            if s is not None: s.close()
+
+    # sends many nagios commands in as few round trips as possible. cmdsByKey maps
+    # a key (i.e. a target host) to its list of command strings; each key's commands
+    # are kept together on one of 'connections' parallel connections.
+    # returns a dictionary of {key: success}
+    def sendCommandBatch(self, cmdsByKey, connections=1):
+        results = {}
+        keys = cmdsByKey.keys()
+        if len(keys) < 1:
+            return results
+        connections = max(1, min(connections, len(keys)))
+
+        chunks = [keys[i::connections] for i in range(connections)]
+        if connections == 1:
+            self._sendCommandChunk(chunks[0], cmdsByKey, results)
+            return results
+
+        threads = []
+        for chunk in chunks:
+            t = threading.Thread(target=self._sendCommandChunk, args=(chunk, cmdsByKey, results))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+    # adds "host_name;host_address" lines to the host name & address indexes
+    def _indexTargets(self, lines):
+        for line in lines:
+            lineTokens = line.rstrip('\n').split(';')
+            if lineTokens[0] == '':
+                continue
+            address = ''
+            if len(lineTokens) > 1:
+                address = lineTokens[1]
+            self.remote_targets[lineTokens[0]] = address
+            if address != '':
+                self.remote_addresses[address] = lineTokens[0]
+
+    # the on-disk host inventory cache for this server, or None if caching is disabled
+    def _targetCachePath(self):
+        if self.cache_dir is None or self.cache_ttl <= 0:
+            return None
+        return os.path.join(self.cache_dir, "hosts." + re.sub(r'[^\w.-]', '_', self.site))
+
+    # loads the cached host inventory, if it's younger than the cache TTL
+    def _loadTargetCache(self):
+        path = self._targetCachePath()
+        if path is None:
+            return False
+        try:
+            if (time.time() - os.stat(path).st_mtime) > self.cache_ttl:
+                return False
+            f = open(path, 'r')
+            try:
+                self._indexTargets(f)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return False
+        if verbose: print "Loaded %d hosts from cache [%s]" % (len(self.remote_targets), path)
+        self.targets_loaded = True
+        return True
+
+    # writes the host inventory to the cache, swapping the new file in atomically
+    def _saveTargetCache(self):
+        path = self._targetCachePath()
+        if path is None:
+            return
+        tmpPath = "%s.%d" % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0700)
+            f = open(tmpPath, 'w')
+            try:
+                f.writelines(["%s;%s\n" % (h, a) for (h, a) in self.remote_targets.iteritems()])
+            finally:
+                f.close()
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            if verbose: sys.stderr.write("WARNING: unable to write host cache [%s]: %s\n" % (path, e))
+
     def _fetchRemoteTargets(self):
         # if we don't have a dictionary of valid remote targets yet, build it.
-        if len(self.remote_targets) < 1:
-            hostData = self.sendCommand(self.commands['get_hosts']).split('\n')
-            try:
-                for line in hostData:
-                    lineTokens = line.split(';')
-                    self.remote_targets.append(lineTokens[0])
-            except:
-                pass
+        if self.targets_live:
+            return
+        if not self.targets_loaded and self._loadTargetCache():
+            return
+        hostData = self.sendCommand(self.commands['get_hosts']).split('\n')
+        self._indexTargets(hostData)
+        self.targets_loaded = True
+        self.targets_live = True
+        self._saveTargetCache()
+
+    # asks livestatus about only the given hosts (by name or address), rather than
+    # downloading the whole host table
+    def _fetchFilteredTargets(self, hosts):
+        query = self.commands['get_hosts']
+        for host in hosts:
+            query = query + "Filter: host_name = %s\nFilter: host_address = %s\n" % (host, host)
+        query = query + "Or: %d\n" % (len(hosts) * 2)
+        self._indexTargets(self.sendCommand(query).split('\n'))
+
+    # returns the host name for a target given by host name or address, or None
+    def _resolveTarget(self, target):
+        if self.remote_targets.has_key(target):
+            return target
+        return self.remote_addresses.get(target)
+
+    # checks a list of user-supplied targets (host names or addresses) against the
+    # remote server. returns a dictionary of {target: host_name} for the valid ones.
+    def validateTargets(self, targets):
+        valid = {}
+        missing = []
+        if not self.targets_loaded:
+            self._loadTargetCache()
+
+        for target in targets:
+            # a newline would let a target inject its own livestatus headers
+            if target == '' or '\n' in target:
+                continue
+            name = self._resolveTarget(target)
+            if name is None:
+                missing.append(target)
+            else:
+                valid[target] = name
+
+        # hosts not in a cached inventory may be new, so only a live inventory is final
+        if len(missing) > 0 and not self.targets_live:
+            if len(missing) <= self.filter_limit:
+                self._fetchFilteredTargets(missing)
+            else:
+                self._fetchRemoteTargets()
+            for target in missing:
+                name = self._resolveTarget(target)
+                if name is not None:
+                    valid[target] = name
+        return valid
 
     # checks for existence of user-supplied target hostname on remote server
     def targetIsValid(self, host):
-        if host == '': return False
-        self._fetchRemoteTargets()
-
-        # check the dictionary for the specified host
-        if host in self.remote_targets:
-            return True
-        return False
+        return self.validateTargets([host]).has_key(host)
 
     # print a listing of target servers on the remote nagios host
     def listValidTargets(self):
         self._fetchRemoteTargets()
-        return sorted(self.remote_targets)
+        return sorted(self.remote_targets.keys())
+
+    # builds a query which has livestatus count services in each state, grouped by
+    # one of the stats_groups; with 'Stats:' headers, 'Columns:' is the group-by.
+    def buildStatsQuery(self, groupBy):
+        (table, column) = self.stats_groups[groupBy]
+        query = 'GET %s\n' % table
+        if column is not None:
+            query = query + 'Columns: %s\n' % column
+        for state in range(len(self.service_states)):
+            query = query + 'Stats: state = %d\n' % state
+        return query
 
-    # return a list of current service problems on the nagios host
+    # return a list of current, unacknowledged service problems on the nagios host.
+    # livestatus does the filtering, so only the problems themselves come back.
     def getCurrentProblems(self):
         problems = []
-        hostData = self.sendCommand(self.commands['get_services']).split('\n')
-        for service in hostData:
-            if service.lstrip().rstrip() != '':
-                parts = service.split(';')
-                if int(parts[2]) > 0:
-                    problems = problems + [ServiceProblem(parts[0], parts[1])]
+        for service in self.queryLines(self.commands['get_problems']):
+            # service descriptions may contain semicolons; host names can't
+            parts = service.split(';', 1)
+            if len(parts) == 2:
+                problems.append(ServiceProblem(parts[0], parts[1]))
         return problems
 
 
-class ReenablerDaemon:
-    def __init__(self, bin_name, opts, pidfile):
+# A set of livestatus servers (i.e. one per datacenter) which are queried concurrently.
+class NagiosSites:
+    servers = []
+    deadline = 10
+    abandoned = 0
+
+    def __init__(self, servers, deadline=10):
+        self.servers = servers
+        self.deadline = deadline
+
+    def _run(self, server, func, results):
+        try:
+            results[server.site] = (True, func(server))
+        except SystemExit:
+            # NagiosServer has already reported the error
+            results[server.site] = (False, "request failed")
+        except Exception, e:
+            results[server.site] = (False, str(e))
+
+    # calls func(server) for every site at once, waiting no longer than the deadline.
+    # a site which doesn't answer in time is reported as failed, without holding up
+    # the others. returns a dictionary of {site: (success, result)}
+    def fanOut(self, func):
+        results = {}
+        threads = []
+        for server in self.servers:
+            t = threading.Thread(target=self._run, args=(server, func, results))
+            t.setDaemon(True)
+            t.start()
+            threads.append((server, t))
+
+        stopTime = time.time() + self.deadline
+        for (server, t) in threads:
+            t.join(max(0, stopTime - time.time()))
+            if t.isAlive():
+                self.abandoned = self.abandoned + 1
+                results[server.site] = (False, "no response within %ds" % self.deadline)
+        return results
+
+    # exits the program. if any site was abandoned past its deadline, its thread may
+    # still be blocked in a socket call, so skip the interpreter teardown instead
+    # of waiting on (or tripping over) it.
+    def exit(self, status):
+        if self.abandoned > 0:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+        sys.exit(status)
+
+    # sends a livestatus query to every site, merging the result lines with a leading site column.
+    # returns a tuple of (lines, {site: error})
+    def query(self, cmd):
+        lines = []
+        errors = {}
+        results = self.fanOut(lambda server: server.sendCommand(cmd))
+        for site in sorted(results.keys()):
+            (ok, resp) = results[site]
+            if not ok:
+                errors[site] = resp
+                continue
+            for line in resp.split('\n'):
+                if line.strip() != '':
+                    lines.append(site + ';' + line)
+        return (lines, errors)
+
+    # like query(), but with typed rows from NagiosServer.queryRows, each prefixed with the site
+    def queryRows(self, cmd):
+        rows = []
+        errors = {}
+        results = self.fanOut(lambda server: list(server.queryRows(cmd)))
+        for site in sorted(results.keys()):
+            (ok, siteRows) = results[site]
+            if not ok:
+                errors[site] = siteRows
+                continue
+            for row in siteRows:
+                rows.append([site] + row)
+        return (rows, errors)
+
+
+# A single long-lived process which re-enables notifications once their maintenance
+# windows are over. Pending jobs are kept on a timer heap; new ones are handed over
+# by each -d/-r invocation on a local UNIX socket, and are sent in-process over
+# pooled livestatus connections. The scheduler exits once it has been idle a while.
+#
+# Every job is also recorded in an append-only journal before it's accepted, so
+# pending re-enables survive a reboot; the next scheduler to start replays them.
+# Jobs which keep failing (i.e. for a server that's gone) are dropped after
+# max_attempts tries, ~70 minutes with the backoff, and logged to syslog.
+class ReenablerScheduler:
+    idle_timeout = 60
+    min_backoff = 5
+    max_backoff = 300
+    max_attempts = 20
+    send_deadline = 60
+    compact_threshold = 1000
+
+    def __init__(self, basePath, journalPath=None):
         self.stdin = '/dev/null'
         #self.stdout = '/tmp/daemon.stdout.log'
         #self.stderr = '/tmp/daemon.stderr.log'
         self.stdout = '/dev/null'
         self.stderr = '/dev/null'
-        self.initialTime = timedelta(seconds=time.time())
-        self.pidfile = pidfile + "." + str(self.initialTime.days) + "-" + str(self.initialTime.seconds)
-        self.job_str = "%s -H %s -p %d -e -t \"%s\"" % (bin_name, opts.address, opts.port, opts.target_servers)
-        self.reenable_delta = timedelta(seconds=math.fabs(opts.reenable_after))
+        self.socket_path = basePath + '.sock'
+        self.pidfile = basePath + '.pid'
+        self.jobs = []          # heap of (due, id, job)
+        self.sequence = 0
+        self.servers = {}
+        self.listener = None
+        self.lockfile = None
+        self.journal_path = journalPath
+        self.journal = None
+        self.journal_records = 0
+        self.journal_dirty = False
 
-    def delpid(self):
-        os.remove(self.pidfile)
+    # gives a job the next unused id. jobs are dictionaries of
+    # {id, address, port, targets, due, attempts}
+    def _newJob(self, address, port, targets, due, attempts=0):
+        self.sequence = self.sequence + 1
+        return {'id': self.sequence, 'address': address, 'port': port,
+                'targets': targets, 'due': due, 'attempts': attempts}
 
-    def daemonize(self):
+    # queues a job on the timer heap
+    def addJob(self, job):
+        heapq.heappush(self.jobs, (job['due'], job['id'], job))
+
+    # appends records to the journal. records only need to hit the disk before a job
+    # is acknowledged; anything else can ride along with the next fsync.
+    def _journalAppend(self, records, sync):
+        if self.journal is None or len(records) < 1:
+            return
+        self.journal.write(''.join([json.dumps(record) + '\n' for record in records]))
+        self.journal.flush()
+        self.journal_records = self.journal_records + len(records)
+        if sync:
+            os.fsync(self.journal.fileno())
+            self.journal_dirty = False
+        else:
+            self.journal_dirty = True
+
+    # replays the journal: every job that was added but never marked done is pending
+    def _loadJournal(self):
+        pending = {}
+        try:
+            f = open(self.journal_path, 'r')
+        except IOError:
+            return
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record['op'] == 'add':
+                        pending[record['id']] = record
+                    elif record['op'] == 'done':
+                        pending.pop(record['id'], None)
+                except (ValueError, KeyError, TypeError):
+                    # most likely a record torn by a crash mid-write
+                    continue
+                self.journal_records = self.journal_records + 1
+        finally:
+            f.close()
+
+        for record in pending.values():
+            self.sequence = max(self.sequence, int(record['id']))
+            self.addJob({'id': int(record['id']), 'address': str(record['address']), 'port': int(record['port']),
+                         'targets': [str(t) for t in record['targets']], 'due': float(record['due']),
+                         'attempts': int(record['attempts'])})
+
+    # opens the journal for appending, after replaying whatever's already in it
+    def _openJournal(self):
+        if self.journal_path is None:
+            return
+        journalDir = os.path.dirname(self.journal_path)
+        if journalDir != '' and not os.path.isdir(journalDir):
+            os.makedirs(journalDir, 0700)
+        self._loadJournal()
+        self._compactJournal(force=True)
+
+    # rewrites the journal with just the pending jobs, once it's mostly dead records.
+    # the new journal is synced before it's swapped in, so a crash leaves one or the other.
+    def _compactJournal(self, force=False):
+        if self.journal_path is None:
+            return
+        if not force and self.journal_records < max(self.compact_threshold, 4 * len(self.jobs)):
+            return
+        if self.journal is not None:
+            self.journal.close()
+
+        tmpPath = self.journal_path + '.tmp'
+        f = open(tmpPath, 'w')
+        try:
+            for (due, id, job) in self.jobs:
+                record = dict(job)
+                record['op'] = 'add'
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpPath, self.journal_path)
+        dirFd = os.open(os.path.dirname(os.path.abspath(self.journal_path)), os.O_RDONLY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
+
+        self.journal = open(self.journal_path, 'a')
+        self.journal_records = len(self.jobs)
+        self.journal_dirty = False
+
+    # hands jobs to the running scheduler, starting one first if there isn't one.
+    # returns True once the scheduler has accepted them.
+    def submit(self, jobs):
+        request = ''.join([json.dumps(job) + '\n' for job in jobs])
+        stopTime = time.time() + 10
+        spawned = False
+        while True:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(10)
+            try:
+                s.connect(self.socket_path)
+                s.sendall(request)
+                s.shutdown(socket.SHUT_WR)
+                resp = ''
+                buf = s.recv(4096)
+                while buf:
+                    resp = resp + buf
+                    buf = s.recv(4096)
+                if resp.startswith('OK'):
+                    return True
+                sys.stderr.write("ERROR: re-enabler scheduler rejected jobs: %s\n" % resp.strip())
+                return False
+            except socket.error, e:
+                # no scheduler listening (or one which is just shutting down)
+                if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.ECONNRESET, errno.EPIPE) \
+                   or time.time() > stopTime:
+                    sys.stderr.write("ERROR: unable to reach re-enabler scheduler [%s]: %s\n" \
+                                     % (self.socket_path, e.strerror))
+                    return False
+            finally:
+                s.close()
+
+            if not spawned:
+                self.spawn()
+                spawned = True
+            time.sleep(0.1)
+
+    # forks off the scheduler daemon, and returns in the parent
+    def spawn(self):
         try:
             pid = os.fork()
             if pid > 0:
-                # exit first parent
-                sys.exit(0)
+                # reap the first child, which exits as soon as the daemon is forked off
+                os.waitpid(pid, 0)
+                return
         except OSError, e:
             sys.stderr.write("ERROR: Failed initial fork!\n")
             sys.stderr.write("       errno=%d; strerror=%s\n" % (e.errno, e.strerror))
             sys.exit(1)
 
+        try:
+            self.daemonize()
+            syslog.openlog('mk-commander', syslog.LOG_PID)
+            if self.lock():
+                self.run()
+        finally:
+            os._exit(0)
+
+    def daemonize(self):
         os.chdir("/")
         os.setsid()
-        os.umask(0)
+        os.umask(077)
         try:
             pid = os.fork()
             if pid > 0:
                 # exit second parent
-                sys.exit(0)
+                os._exit(0)
         except OSError, e:
             sys.stderr.write("ERROR: Failed second fork!\n")
             sys.stderr.write("       errno=%d; strerror=%s\n" % (e.errno, e.strerror))
-            sys.exit(1)
+            os._exit(1)
 
         # redirect file descriptors
         sys.stdout.flush()
@@ -190,73 +975,264 @@ class ReenablerDaemon:
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
 
-        atexit.register(self.delpid)
-        pid = str(os.getpid())
-        file(self.pidfile, 'w+').write("%s\n" % pid)
+    # takes the pidfile lock, so only one scheduler runs at a time, then opens the
+    # job socket. a scheduler which is just shutting down gets a moment to let go.
+    # neither the pidfile nor a leftover socket is touched unless it's really ours.
+    def lock(self):
+        try:
+            fd = os.open(self.pidfile, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        except OSError:
+            return False
+        pidStat = os.fstat(fd)
+        if not stat.S_ISREG(pidStat.st_mode) or pidStat.st_uid != os.getuid():
+            os.close(fd)
+            return False
+        self.lockfile = os.fdopen(fd, 'r+')
+        stopTime = time.time() + 10
+        while True:
+            try:
+                fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                if time.time() > stopTime:
+                    return False
+                time.sleep(0.1)
+        self.lockfile.truncate(0)
+        self.lockfile.write("%d\n" % os.getpid())
+        self.lockfile.flush()
 
-    def start(self):
-        # Check for a pidfile to see if the daemon already runs
+        # any socket file left at this point belongs to a dead scheduler
         try:
-            pf = file(self.pidfile,'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
-       
-        if pid:
-            message = "pidfile %s already exist. Daemon already running?\n"
-            sys.stderr.write(message % self.pidfile)
-            sys.exit(1)
-        
-        # Start the daemon
-        self.daemonize()
-        self.run()
- 
-    def stop(self):
-        # Get the pid from the pidfile
+            sockStat = os.lstat(self.socket_path)
+            if not stat.S_ISSOCK(sockStat.st_mode) or sockStat.st_uid != os.getuid():
+                return False
+            os.remove(self.socket_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                return False
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(16)
+        self._openJournal()
+        return True
+
+    # reads newline-delimited json jobs from one client connection
+    def _acceptJobs(self):
+        (conn, addr) = self.listener.accept()
+        conn.settimeout(5)
         try:
-            pf = file(self.pidfile,'r')
-            pid = int(pf.read().strip())
-            pf.close()
-            self.delpid()
-        except IOError:
-            pid = None
-    
-        if not pid:
-            message = "pidfile %s does not exist. Daemon not running?\n"
-            sys.stderr.write(message % self.pidfile)
-            return # not an error in a restart
- 
-        # Try killing the daemon process       
+            try:
+                data = []
+                buf = conn.recv(65536)
+                while buf:
+                    data.append(buf)
+                    buf = conn.recv(65536)
+
+                jobs = []
+                records = []
+                for line in ''.join(data).split('\n'):
+                    if line.strip() == '':
+                        continue
+                    job = json.loads(line)
+                    jobs.append(self._newJob(str(job['address']), int(job['port']),
+                                             [str(t) for t in job['targets']], float(job['due'])))
+                    record = dict(jobs[-1])
+                    record['op'] = 'add'
+                    records.append(record)
+
+                # the whole request is made durable with one fsync, before it's acknowledged
+                self._journalAppend(records, True)
+                for job in jobs:
+                    self.addJob(job)
+                conn.sendall("OK %d\n" % len(jobs))
+            except (ValueError, KeyError, TypeError), e:
+                conn.sendall("ERROR %s\n" % e)
+            except (IOError, OSError), e:
+                conn.sendall("ERROR unable to write journal: %s\n" % e)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    # keeps one pooled NagiosServer per livestatus server
+    def _getServer(self, address, port):
+        if not self.servers.has_key((address, port)):
+            self.servers[(address, port)] = NagiosServer(address=address, port=port, keepalive=True)
+        return self.servers[(address, port)]
+
+    # re-enables notifications for every job that's due, in one batch per server.
+    # targets which fail are retried with a capped exponential backoff.
+    def _runDueJobs(self):
+        now = time.time()
+        due = {}
+        while len(self.jobs) > 0 and self.jobs[0][0] <= now:
+            (when, sequence, job) = heapq.heappop(self.jobs)
+            due.setdefault((job['address'], job['port']), []).append(job)
+        if len(due) < 1:
+            return
+
+        servers = []
+        cmds = {}
+        for (address, port) in due.keys():
+            server = self._getServer(address, port)
+            servers.append(server)
+            cmds[server.site] = {}
+            for job in due[(address, port)]:
+                for target in job['targets']:
+                    cmds[server.site][target] = [server.buildCommand(c, date=now) \
+                                                 for c in notificationCommands(target, True)]
+        results = NagiosSites(servers, deadline=self.send_deadline).fanOut(
+            lambda server: server.sendCommandBatch(cmds[server.site]))
+
+        # retries are journaled ahead of the 'done' records for the jobs they replace. none of
+        # this needs an fsync: if it's lost, the original jobs are simply replayed.
+        retries = []
+        records = []
+        for (address, port) in due.keys():
+            (ok, siteResults) = results[self._getServer(address, port).site]
+            for job in due[(address, port)]:
+                failed = [t for t in job['targets'] if not ok or not siteResults.get(t)]
+                if len(failed) > 0 and job['attempts'] + 1 >= self.max_attempts:
+                    syslog.syslog(syslog.LOG_WARNING, "giving up re-enabling notifications for %s on %s after %d attempts"
+                                  % (', '.join(failed), self._getServer(address, port).site, job['attempts'] + 1))
+                elif len(failed) > 0:
+                    backoff = min(self.max_backoff, self.min_backoff * (2 ** min(job['attempts'], 16)))
+                    retry = self._newJob(address, port, failed, time.time() + backoff, job['attempts'] + 1)
+                    retries.append(retry)
+                    record = dict(retry)
+                    record['op'] = 'add'
+                    records.append(record)
+        for jobs in due.values():
+            for job in jobs:
+                records.append({'op': 'done', 'id': job['id']})
+
+        for retry in retries:
+            self.addJob(retry)
         try:
-            while True:
-                os.kill(pid, SIGTERM)
-                time.sleep(0.1)
-        except OSError, err:
-            err = str(err)
-            if err.find("No such process") > 0:
-                if os.path.exists(self.pidfile):
-                    os.remove(self.pidfile)
-            else:
-                print str(err)
-                sys.exit(1)
- 
-    def restart(self):
-        self.stop()
-        self.start()
- 
+            self._journalAppend(records, False)
+            self._compactJournal()
+        except (IOError, OSError):
+            pass
+
     def run(self):
+        lastActivity = time.time()
+        try:
+            while True:
+                timeout = self.idle_timeout
+                if len(self.jobs) > 0:
+                    timeout = min(timeout, max(0, self.jobs[0][0] - time.time()))
+                try:
+                    (readable, w, x) = select.select([self.listener], [], [], timeout)
+                except select.error, e:
+                    if e[0] == errno.EINTR:
+                        continue
+                    raise
+                if len(readable) > 0:
+                    self._acceptJobs()
+                    lastActivity = time.time()
 
-        while True:
-            time.sleep(1)
+                if len(self.jobs) > 0 and self.jobs[0][0] <= time.time():
+                    self._runDueJobs()
+                    lastActivity = time.time()
+
+                if len(self.jobs) < 1 and (time.time() - lastActivity) >= self.idle_timeout:
+                    break
+        finally:
+            # the pidfile stays; it's the lock, and is released when we exit
+            os.remove(self.socket_path)
+            self.listener.close()
+            for server in self.servers.values():
+                server.close()
+            if self.journal is not None:
+                self._compactJournal(force=True)
+                self.journal.close()
+
+
+
+# checks that 'path' is a directory only we can get into, creating it if need be.
+# returns an error message, or None.
+def checkPrivateDirectory(path):
+    try:
+        if not os.path.lexists(path):
+            os.makedirs(path, 0700)
+        dirStat = os.lstat(path)
+    except OSError, e:
+        return "unable to create directory %s: %s" % (path, e.strerror)
+    if not stat.S_ISDIR(dirStat.st_mode):
+        return "%s is not a directory" % path
+    if dirStat.st_uid != os.getuid():
+        return "%s is not owned by uid %d" % (path, os.getuid())
+    if dirStat.st_mode & 077:
+        return "%s is accessible by other users (mode %o); chmod it 700" % (path, stat.S_IMODE(dirStat.st_mode))
+    return None
+
+# the scheduler's socket, pidfile & journal live in the cache directory: the journal has to
+# survive a reboot, and the socket & pidfile mustn't be somewhere other users can plant
+# symlinks, since the scheduler truncates & removes them.
+def getReenablerScheduler(options):
+    error = checkPrivateDirectory(options.cache_dir)
+    if error is not None:
+        sys.stderr.write("ERROR: can't run the re-enabler scheduler: %s\n" % error)
+        sys.exit(1)
+    return ReenablerScheduler(os.path.join(options.cache_dir, 'reenabler'),
+                              os.path.join(options.cache_dir, 'reenabler.journal'))
 
-            # check time difference, and re-enable alerts when time is right
-            if (timedelta(seconds=time.time()) - self.initialTime) >= self.reenable_delta:
-                status = 1
-                while status != 0:
-                    (status, output) = commands.getstatusoutput(self.job_str)
-                self.stop()
+# parses a comma-delimited list of livestatus endpoints ("host", "host:port", or
+# "unix:/path/to/socket")
+def parseEndpoints(addressList, defaultPort):
+    endpoints = []
+    for endpoint in addressList.split(','):
+        endpoint = endpoint.strip()
+        if endpoint == '':
+            continue
+        if endpoint.startswith('unix:'):
+            endpoints.append((endpoint, defaultPort))
+        elif ':' in endpoint:
+            (host, port) = endpoint.rsplit(':', 1)
+            endpoints.append((host, int(port)))
+        else:
+            endpoints.append((endpoint, defaultPort))
+    return endpoints
+
+# returns the "unix:" address of livestatus' socket, if we can use it, which skips
+# TCP and the xinetd/unixcat hop; otherwise returns ''.
+def localEndpoint(socketPath):
+    if socketPath == '':
+        return ''
+    try:
+        if stat.S_ISSOCK(os.stat(socketPath).st_mode) and os.access(socketPath, os.R_OK | os.W_OK):
+            if verbose: print "Using local livestatus socket %s" % socketPath
+            return 'unix:' + socketPath
+    except OSError:
+        pass
+    return ''
+
+# builds the quick-command strings which disable (or enable) all notifications for a host
+def notificationCommands(target, enable):
+    # we get the uid, then convert to a proper username because running this script from cron will 
+    # cause os.getlogin() to fail
+    user = pwd.getpwuid(os.getuid())[0]
+    if enable:
+        return ["ENABLE_HOST_SVC_NOTIFICATIONS;%s\n" % target,
+                "ENABLE_HOST_NOTIFICATIONS;%s\n" % target,
+                "ADD_HOST_COMMENT;%s;1;%s;Host and service notifications enabled from command line.\n" \
+                  % (target, user)]
+    return ["DISABLE_HOST_SVC_NOTIFICATIONS;%s\n" % target,
+            "DISABLE_HOST_NOTIFICATIONS;%s\n" % target,
+            "ADD_HOST_COMMENT;%s;1;%s;Host and service notifications disabled from command line.\n" \
+              % (target, user)]
 
+# prints the per-site results of a fan-out. returns 1 if any site failed, else 0
+def printSiteResults(results):
+    status = 0
+    for site in sorted(results.keys()):
+        (ok, resp) = results[site]
+        if not ok:
+            sys.stderr.write("ERROR: site %s: %s\n" % (site, resp))
+            status = 1
+        elif resp.lstrip().rstrip() != '':
+            print "%s;%s" % (site, resp.rstrip())
+    return status
 
 
 ##################################
@@ -276,11 +1252,34 @@ formatted Nagios command string, as defined in the Nagios external commands docu
 )
 optGroup = OptionGroup(parser, "General Options", "Options which affect all operations.")
 optGroup.add_option("-H", "--livestatus-host", type='string', dest='address', 
-                    help="The mk-livestatus/Nagios server to send commands to.",
+                    help="The mk-livestatus/Nagios server to send commands to. Multiple servers can be given as a \
+comma-delimited list of host[:port] or unix:/path/to/socket values, which are all queried concurrently.",
                     default='')
 optGroup.add_option("-p", "--livestatus-port", type='int', dest='port', 
                     help="The mk-livestatus port to connect to. (optional; default=6557)", 
-                    default=6557)
+                    default=None)
+optGroup.add_option("--local-socket", type='string', dest='local_socket',
+                    help="When no --livestatus-host or --livestatus-port is given, use livestatus' UNIX socket \
+at this path, if it exists. An explicit host is never replaced with the socket. (optional; \
+default=/var/lib/nagios/rw/live)", default='/var/lib/nagios/rw/live')
+optGroup.add_option("-k", "--keepalive", action='store_true', dest='keepalive',
+                    help="Reuse a small pool of persistent livestatus connections (KeepAlive: on) instead of \
+opening a new connection for every query/command.", default=False)
+optGroup.add_option("--pool-size", type='int', dest='pool_size',
+                    help="Max number of idle pooled connections to keep open with --keepalive. (optional; default=2)",
+                    default=2)
+optGroup.add_option("--cache-dir", type='string', dest='cache_dir',
+                    help="Directory to cache remote host inventories in. (optional; default=~/.mk-commander)",
+                    default=os.path.expanduser('~/.mk-commander'))
+optGroup.add_option("--cache-ttl", type='int', dest='cache_ttl',
+                    help="Max age (in seconds) of a cached host inventory; 0 disables the cache. (optional; default=300)",
+                    default=300)
+optGroup.add_option("--filter-limit", type='int', dest='filter_limit',
+                    help="Validate up to this many targets with a filtered livestatus query, instead of fetching \
+every host. (optional; default=50)", default=50)
+optGroup.add_option("--site-timeout", type='int', dest='site_timeout',
+                    help="With multiple --livestatus-host servers, the max time (in seconds) to wait for any one \
+server. (optional; default=10)", default=10)
 optGroup.add_option("-v", "--verbose", action='store_true', dest='verbose', default=False)
 parser.add_option_group(optGroup)
 
@@ -299,17 +1298,31 @@ optGroup.add_option("-t", "--targets", type='string', dest='target_servers',
 optGroup.add_option("-r", "--reenable-after", type='int', dest='reenable_after',
                     help="The time (in seconds) after which notifications will be automatically re-enabled. (optional)",
                     default=0)
+optGroup.add_option("-b", "--batch", action='store_true', dest='batch',
+                    help="Send the -d/-e commands for all targets in one batch, instead of one connection per command.",
+                    default=False)
+optGroup.add_option("--batch-connections", type='int', dest='batch_connections',
+                    help="Number of parallel connections to spread a --batch over. (optional; default=1)",
+                    default=1)
+optGroup.add_option("--start-reenabler", action='store_true', dest='start_reenabler',
+                    help="Start the notification re-enabler scheduler if it isn't running, replaying any pending \
+re-enables from its journal, and exit. (i.e. for an @reboot cron job)", default=False)
 optGroup.add_option("-L", "--list-remote-targets", action='store_true', dest='list_remote_targets',
                     help="Print a list of known targets on the remote Nagios/livestatus server and exit.",
                     default=False)
 parser.add_option_group(optGroup)
 
 optGroup = OptionGroup(parser, "Livestatus/Nagios Commands")
+optGroup.add_option("-s", "--stats", type='choice', dest='stats', choices=sorted(NagiosServer.stats_groups.keys()),
+                    help="Print counts of services in each state, grouped by one of: %s. (see also --json)" \
+                         % ', '.join(sorted(NagiosServer.stats_groups.keys())), default=None)
 optGroup.add_option("-l", "--list-mk-commands", action='store_true', dest='list_mk_commands', 
                     help="List available mk-livestatus commands and exit.", default=False)
 optGroup.add_option("-c", "--command", type='string', dest='command', 
                     help="The mk-livestatus command to send.", 
                     default='')
+optGroup.add_option("-j", "--json", action='store_true', dest='json',
+                    help="Print the results of a 'get_' --command as one json row per line.", default=False)
 optGroup.add_option("-n", "--nagios-command-string", type='string', dest='nagios_cmd_string', 
                     help='The custom Nagios command string to send. (i.e. "<NAGIOS_CMD>;<NAGIOS_CMD_OPTIONS>;\
 ...")', default='')
@@ -320,8 +1333,27 @@ try:
 except:
     sys.exit(1)
 
-nagios = NagiosServer(address=options.address, port=options.port)
 verbose = options.verbose
+defaultPort = options.port
+if defaultPort is None:
+    defaultPort = 6557
+endpoints = parseEndpoints(options.address, defaultPort)
+# with nowhere to connect to given, use the local livestatus socket, if there is one
+if len(endpoints) < 1 and options.port is None:
+    endpoints = [(localEndpoint(options.local_socket), defaultPort)]
+if len(endpoints) < 1:
+    endpoints = [('', defaultPort)]
+servers = []
+for (address, port) in endpoints:
+    server = NagiosServer(address=address, port=port,
+                          keepalive=options.keepalive, poolSize=options.pool_size,
+                          timeout=min(10, options.site_timeout), cacheDir=options.cache_dir,
+                          cacheTtl=options.cache_ttl, filterLimit=options.filter_limit)
+    atexit.register(server.close)
+    servers.append(server)
+nagios = servers[0]
+sites = NagiosSites(servers, deadline=options.site_timeout)
+multiSite = len(servers) > 1
 
 if options.list_mk_commands:
     print "Available mk-livestatus commands:"
@@ -329,11 +1361,58 @@ if options.list_mk_commands:
         print '\t', cmd
     sys.exit(0)
 
+if options.start_reenabler:
+    if getReenablerScheduler(options).submit([]):
+        sys.exit(0)
+    sys.exit(1)
+
 if nagios.address == '':
     sys.stderr.write("ERROR: You must specify a --livestatus-host. (-h for help)\n")
     parser.print_usage()
     sys.exit(1)
 
+# aggregate counts are computed by livestatus, so only a few rows come back
+if options.stats is not None:
+    query = nagios.buildStatsQuery(options.stats)
+    header = list(nagios.service_states)
+    if nagios.stats_groups[options.stats][1] is not None:
+        header.insert(0, options.stats)
+
+    errors = {}
+    if multiSite:
+        header.insert(0, 'site')
+        (rows, errors) = sites.queryRows(query)
+    else:
+        rows = nagios.queryRows(query)
+
+    if options.json:
+        print json.dumps(header)
+    else:
+        print ';'.join(header)
+    for row in rows:
+        if options.json:
+            print json.dumps(row)
+        else:
+            print ';'.join([str(value) for value in row])
+    for site in sorted(errors.keys()):
+        sys.stderr.write("ERROR: site %s: %s\n" % (site, errors[site]))
+    if len(errors) > 0:
+        sites.exit(1)
+    sites.exit(0)
+
+if options.list_remote_targets and multiSite:
+    status = 0
+    results = sites.fanOut(lambda server: server.listValidTargets())
+    for site in sorted(results.keys()):
+        (ok, targets) = results[site]
+        if not ok:
+            sys.stderr.write("ERROR: site %s: %s\n" % (site, targets))
+            status = 1
+            continue
+        print "Known targets on host %s:" % repr(site)
+        print ', '.join(targets)
+    sites.exit(status)
+
 if options.list_remote_targets:
     tmp = ''
     for target in nagios.listValidTargets():
@@ -343,20 +1422,37 @@ if options.list_remote_targets:
     sys.exit(0)
 
 if options.ack_problem:
-    problems = nagios.getCurrentProblems()
+    # problems are kept alongside the server they came from, so the ACK goes to the right site
+    problems = []
+    if multiSite:
+        results = sites.fanOut(lambda server: server.getCurrentProblems())
+        for server in servers:
+            (ok, siteProblems) = results[server.site]
+            if not ok:
+                sys.stderr.write("WARNING: skipping site %s: %s\n" % (server.site, siteProblems))
+                continue
+            for p in siteProblems:
+                problems.append((server, p))
+    else:
+        for p in nagios.getCurrentProblems():
+            problems.append((nagios, p))
     problemNum = 1
-    for p in problems:
-        print "(" + str(problemNum) + ") " + p.host + ": " + p.service
+    for (server, p) in problems:
+        if multiSite:
+            print "(" + str(problemNum) + ") " + server.site + ": " + p.host + ": " + p.service
+        else:
+            print "(" + str(problemNum) + ") " + p.host + ": " + p.service
         problemNum = problemNum + 1
     num = int(raw_input("Enter a problem number to ACK (0 to quit): "))
-    if num == 0: sys.exit(0)
-    tmp = "ACKNOWLEDGE_SVC_PROBLEM;" + problems[num-1].host + ";" + problems[num-1].service + ";2;1;1;" 
+    if num == 0: sites.exit(0)
+    (server, problem) = problems[num-1]
+    tmp = "ACKNOWLEDGE_SVC_PROBLEM;" + problem.host + ";" + problem.service + ";2;1;1;" 
     tmp = tmp + pwd.getpwuid(os.getuid())[0] 
     tmp = tmp + ";" + raw_input("Enter a short comment: ")
-    ret = nagios.sendCommand(nagios.buildCommand(tmp))
+    ret = server.sendCommand(server.buildCommand(tmp))
     if ret.lstrip().rstrip() != '':
         print ret
-    sys.exit(0)
+    sites.exit(0)
 
 # process the quick commands, if supplied
 if options.disable_all_notifications ^ options.enable_all_notifications:
@@ -367,40 +1463,102 @@ if options.disable_all_notifications ^ options.enable_all_notifications:
         sys.stderr.write("ERROR: you must specify --targets with this option. (-h for help)\n")
         sys.exit(1)
 
+    batchCmds = {}
+    exitStatus = 0
     targets = options.target_servers.rstrip().split(',')
-    for target in targets:
-        if not nagios.targetIsValid(target):
-            sys.stderr.write("WARNING: skipping invalid target %s. Target doesn't exist on server %s. (-h for help)\n" \
-                             % (repr(target), repr(options.address)))
-            continue
-    
-        # we get the uid, then convert to a proper username because running this script from cron will 
-        # cause os.getlogin() to fail
-        if options.disable_all_notifications:
-            tmpCmds = ["DISABLE_HOST_SVC_NOTIFICATIONS;%s\n" % target,
-                       "DISABLE_HOST_NOTIFICATIONS;%s\n" % target,
-                       "ADD_HOST_COMMENT;%s;1;%s;Host and service notifications disabled from command line.\n" \
-                         % (target, pwd.getpwuid(os.getuid())[0])]
-        elif options.enable_all_notifications:
-            tmpCmds = ["ENABLE_HOST_SVC_NOTIFICATIONS;%s\n" % target,
-                       "ENABLE_HOST_NOTIFICATIONS;%s\n" % target,
-                       "ADD_HOST_COMMENT;%s;1;%s;Host and service notifications enabled from command line.\n" \
-                         % (target, pwd.getpwuid(os.getuid())[0])]
-
-        # finally, run the commands
-        for c in tmpCmds:
-            ret = nagios.sendCommand(nagios.buildCommand(c))
-            if ret.lstrip().rstrip() != '':
-                print ret
-
-    # do this last, since it will exit this parent process upon daemonization
+
+    # host names successfully disabled on each server, in case they need re-enabling later
+    disabled = {}
+    serversBySite = dict([(server.site, server) for server in servers])
+
+    # with multiple sites, each site is sent the commands for the targets it knows about,
+    # as one batch with --batch, or else a connection per command
+    if multiSite:
+        def sendSiteCommands(server):
+            siteCmds = {}
+            siteTargets = server.validateTargets(targets)
+            for target in siteTargets.keys():
+                siteCmds[target] = [server.buildCommand(c) for c in \
+                                    notificationCommands(siteTargets[target], options.enable_all_notifications)]
+            if options.batch:
+                return server.sendCommandBatch(siteCmds, options.batch_connections)
+            siteResults = {}
+            for target in siteCmds.keys():
+                for c in siteCmds[target]:
+                    server.sendCommand(c)
+                siteResults[target] = True
+            return siteResults
+
+        found = {}
+        results = sites.fanOut(sendSiteCommands)
+        for site in sorted(results.keys()):
+            (ok, siteResults) = results[site]
+            if not ok:
+                sys.stderr.write("ERROR: site %s: %s\n" % (site, siteResults))
+                exitStatus = 1
+                continue
+            for target in sorted(siteResults.keys()):
+                found[target] = True
+                if siteResults[target]:
+                    print "%s: %s: OK" % (site, target)
+                    disabled.setdefault(site, []).append(serversBySite[site]._resolveTarget(target))
+                else:
+                    sys.stderr.write("ERROR: commands for target %s on site %s may not have been applied.\n" \
+                                     % (repr(target), site))
+                    exitStatus = 1
+        for target in targets:
+            if not found.has_key(target):
+                sys.stderr.write("WARNING: skipping invalid target %s. Target doesn't exist on any server. (-h for help)\n" \
+                                 % repr(target))
+    else:
+        validTargets = nagios.validateTargets(targets)
+        for target in targets:
+            if not validTargets.has_key(target):
+                sys.stderr.write("WARNING: skipping invalid target %s. Target doesn't exist on server %s. (-h for help)\n" \
+                                 % (repr(target), repr(options.address)))
+                continue
+            tmpCmds = notificationCommands(validTargets[target], options.enable_all_notifications)
+
+            # finally, run the commands (or queue them up, in batch mode)
+            if options.batch:
+                batchCmds[target] = [nagios.buildCommand(c) for c in tmpCmds]
+                continue
+            for c in tmpCmds:
+                ret = nagios.sendCommand(nagios.buildCommand(c))
+                if ret.lstrip().rstrip() != '':
+                    print ret
+            disabled.setdefault(nagios.site, []).append(validTargets[target])
+
+        if options.batch:
+            results = nagios.sendCommandBatch(batchCmds, options.batch_connections)
+            for target in sorted(results.keys()):
+                if results[target]:
+                    print "%s: OK" % target
+                    disabled.setdefault(nagios.site, []).append(validTargets[target])
+                else:
+                    sys.stderr.write("ERROR: commands for target %s may not have been applied.\n" % repr(target))
+                    exitStatus = 1
+
+    # hand the re-enables to the scheduler, which is started if it isn't already running
     if options.reenable_after > 0 and options.disable_all_notifications and __name__ == "__main__":
-        reenabler = ReenablerDaemon(os.path.abspath(sys.argv[0]), options, '/tmp/.nagios_alert_reenabler.pid')
-        reenabler.start()
+        jobs = []
+        due = time.time() + options.reenable_after
+        for site in sorted(disabled.keys()):
+            server = serversBySite[site]
+            jobs.append({'address': server.address, 'port': server.port, 'targets': disabled[site], 'due': due})
+        if len(jobs) > 0:
+            scheduler = getReenablerScheduler(options)
+            if scheduler.submit(jobs):
+                print "Notifications will be re-enabled in %d seconds." % options.reenable_after
+            else:
+                exitStatus = 1
 
-    sys.exit(0)
+    sites.exit(exitStatus)
 
 # process a custom nagios command, if supplied
+if options.nagios_cmd_string != '' and multiSite:
+    cmd = nagios.buildCommand(options.nagios_cmd_string)
+    sites.exit(printSiteResults(sites.fanOut(lambda server: server.sendCommand(cmd))))
 if options.nagios_cmd_string != '':
     print nagios.sendCommand(nagios.buildCommand(options.nagios_cmd_string))
     sys.exit(0)
@@ -417,8 +1575,25 @@ if options.command != '':
             else:
                 sys.stderr.write("ERROR: you must supply a --nagios-command-string with this command! (-h for help)\n")
                 sys.exit(1)
+        elif multiSite:
+            if options.json:
+                (rows, errors) = sites.queryRows(nagios.commands[options.command])
+                for row in rows:
+                    print json.dumps(row)
+            else:
+                (lines, errors) = sites.query(nagios.commands[options.command])
+                for line in lines:
+                    print line
+            for site in sorted(errors.keys()):
+                sys.stderr.write("ERROR: site %s: %s\n" % (site, errors[site]))
+            if len(errors) > 0:
+                sites.exit(1)
+        elif options.json:
+            for row in nagios.queryRows(nagios.commands[options.command]):
+                print json.dumps(row)
         else:
-            print nagios.sendCommand(nagios.commands[options.command])
+            for line in nagios.queryLines(nagios.commands[options.command]):
+                print line
     
         sys.exit(0)
     else:
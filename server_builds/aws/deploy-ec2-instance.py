@@ -9,13 +9,26 @@
 #       - DNS record auto-population
 #       - user-data instance configuration
 #
+#   Every instance ec2run launches (-n/--instance-count) is provisioned, through the
+#   stages discover_ip -> manifest -> cert_sign -> dns, --workers instances at a time,
+#   and how long each stage took is reported for each instance at the end. Puppet
+#   cert requests are polled for once for all the instances waiting on them, and the
+#   instances' IP addresses & subnets are looked up together too, with one describe
+#   call per poll, so launching 50 instances takes about as long as launching one.
+#
+#   The EC2 API is called through an Ec2CliClient, which runs the ec2-api-tools. With
+#   --fake-ec2, a FakeEc2Client is used instead, which launches nothing, so the launch
+#   & IP discovery can be tried out without touching AWS. As there are no real
+#   instances, it implies --skip-puppet-provisioning & --skip-dns-provisioning, and
+#   the puppetmaster isn't touched at all.
+#
 # Caveats:
 #   Sudo commands will fail if they require a password, since no tty present...
 #   Ensure the puppet server has a sudo config that allows NOPASSWD for these commands:
 #
 # Author: Devin Cherry <youshoulduseunix@gmail.com>
 #################################################################
-import paramiko, sys, time, commands, re
+import paramiko, sys, time, commands, re, threading, Queue, traceback, os
 from string import join
 from optparse import OptionParser, OptionGroup
 
@@ -65,6 +78,19 @@ ec2run_opts = {
   'secondary_private_ip_address_count': ('',''),
 }
 
+# the stages each launched instance is provisioned through, in order
+pipelineStages = ['discover_ip', 'manifest', 'cert_sign', 'dns']
+
+
+# raised when an instance can't be provisioned; the rest carry on without it
+class ProvisioningError(Exception):
+    pass
+
+
+# raised when an EC2 API call fails
+class Ec2ApiError(Exception):
+    pass
+
 
 # Ec2Instance: A class for functions/variables specific to EC2 instances
 class Ec2Instance:
@@ -78,19 +104,164 @@ class Ec2Instance:
 
     def __init__(self, instance_id=''):
         self.instance_id = instance_id
+        # seconds spent in each provisioning stage, and what went wrong, if anything
+        self.stage_times = {}
+        self.errors = []
+        self.failed = False
 ## End Class <Ec2Instance>
 
 
+# Ec2CliClient: Calls the EC2 API by running the ec2-api-tools commands, parsing their
+# output. Each call starts up a JVM, which takes seconds, so calls take as many ids as
+# they can at once.
+class Ec2CliClient:
+    interface_pattern = re.compile(r'^NETWORKINTERFACE\s', re.MULTILINE)
+    instance_pattern = re.compile(r'\s(i-[a-f0-9]{8,17})\b')
+    ip_pattern = re.compile(r'^PRIVATEIPADDRESS\s+(\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})', re.MULTILINE)
+    subnet_pattern = re.compile(r'\s(subnet\-[a-zA-Z0-9]+)', re.MULTILINE)
+
+    # runs an ec2run command-line, returning its output
+    def runInstances(self, cmd):
+        return self._run(cmd)
+
+
+    # gets the IP address & subnet of each of these instances, as a dictionary of
+    # (ip address, subnet id) tuples by instance id. instances without a network
+    # interface yet are left out.
+    def describeNetworkInterfaces(self, instanceIds):
+        cmd = "ec2-describe-network-interfaces"
+        for instanceId in instanceIds:
+            cmd = cmd + " --filter \"attachment.instance-id=" + instanceId + "\""
+        output = self._run(cmd)
+
+        interfaces = {}
+        for block in self.interface_pattern.split(output)[1:]:
+            ids = self.instance_pattern.findall(block)
+            ips = self.ip_pattern.findall(block)
+            subnets = self.subnet_pattern.findall(block)
+            # an instance may have more than one interface; its first is its address
+            if len(ids) > 0 and len(ips) > 0 and len(subnets) > 0 and ids[0] not in interfaces:
+                interfaces[ids[0]] = (ips[0], subnets[0])
+        return interfaces
+
+
+    # gets the availability zone of each of these subnets, by subnet id
+    def describeSubnets(self, subnetIds):
+        output = self._run("ec2-describe-subnets " + join(subnetIds, ' '))
+        zones = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) > 6 and fields[0] == 'SUBNET':
+                zones[fields[1]] = fields[6]
+        return zones
+
+
+    def _run(self, cmd):
+        if debug: sys.stderr.write("Executing: %s\n" % cmd)
+        (status, output) = commands.getstatusoutput(cmd)
+        if debug: sys.stderr.write("---\n%s\n---\n" % output)
+        if status != 0:
+            raise Ec2ApiError("%s exited with status %s. Output follows:\n---\n%s\n---"
+                              % (cmd.split()[0], status, output))
+        return output
+## End Class <Ec2CliClient>
+
+
+# FakeEc2Client: A local stand-in for Ec2CliClient, which launches nothing. Each instance
+# "launched" gets an IP address 'ipDelay' seconds later, every call takes 'latency'
+# seconds, as the real commands do, and the calls made are kept in 'calls'.
+class FakeEc2Client:
+    def __init__(self, ipDelay=5, latency=2, zone='us-east-1a'):
+        self.ip_delay = ipDelay
+        self.latency = latency
+        self.zone = zone
+        self.lock = threading.Lock()
+        # (launch time, subnet id) by instance id
+        self.launched = {}
+        self.calls = []
+
+
+    def runInstances(self, cmd):
+        self._call('runInstances', cmd)
+        count = re.search(r'\s(?:-n|--instance-count)\s+(?:\d+-)?(\d+)\s', cmd + ' ')
+        subnet = re.search(r'\s(?:-s|--subnet)\s+(subnet-[a-zA-Z0-9]+)', cmd)
+        if count is None:
+            count = 1
+        else:
+            count = int(count.group(1))
+        if subnet is None:
+            subnet = 'subnet-00000000'
+        else:
+            subnet = subnet.group(1)
+
+        output = ["RESERVATION\tr-fake%04x\t000000000000\tdefault" % os.getpid()]
+        self.lock.acquire()
+        try:
+            for i in range(count):
+                instanceId = 'i-%08x' % (len(self.launched) + 1)
+                self.launched[instanceId] = (time.time(), subnet)
+                output.append("INSTANCE\t%s\t%s\t\t\tpending" % (instanceId, cmd.split()[-1]))
+        finally:
+            self.lock.release()
+        return join(output, '\n')
+
+
+    def describeNetworkInterfaces(self, instanceIds):
+        self._call('describeNetworkInterfaces', instanceIds)
+        interfaces = {}
+        self.lock.acquire()
+        try:
+            for instanceId in instanceIds:
+                if instanceId in self.launched:
+                    (launchTime, subnet) = self.launched[instanceId]
+                    if time.time() - launchTime >= self.ip_delay:
+                        n = int(instanceId[len('i-'):], 16)
+                        interfaces[instanceId] = ("10.0.%d.%d" % (n / 256, n % 256), subnet)
+        finally:
+            self.lock.release()
+        return interfaces
+
+
+    def describeSubnets(self, subnetIds):
+        self._call('describeSubnets', subnetIds)
+        zones = {}
+        for subnetId in subnetIds:
+            zones[subnetId] = self.zone
+        return zones
+
+
+    def _call(self, name, args):
+        self.lock.acquire()
+        try:
+            self.calls.append((name, args))
+        finally:
+            self.lock.release()
+        time.sleep(self.latency)
+## End Class <FakeEc2Client>
+
+
 # PuppetMaster: A class for functions which are to be executed on a Puppet master server.
 class PuppetMaster:
     client = None
     is_connected = False
     connect_address = ''
     puppet_client_timeout = 0
+    # sshd refuses channels beyond MaxSessions (10 by default) on the one connection
+    max_channels = 8
 
     def __init__(self, address='', clientTimeout=900):
         self.connect_address = address
         self.puppet_client_timeout = clientTimeout
+        # instances are provisioned from many threads over the one connection, but
+        # the DNS data file is read & appended to, so only one may do that at a time.
+        # records waiting for it are queued, and all added together by whoever's next.
+        self.dns_lock = threading.Lock()
+        self.dns_queue_lock = threading.Lock()
+        self.dns_queue = []
+        self.hostclasses = None
+        # the worker threads & cert poller share the connection, so the number of
+        # channels open on it at once is kept under sshd's MaxSessions.
+        self.channels = threading.BoundedSemaphore(self.max_channels)
 
 
     # establish SSH connection to puppetmaster
@@ -124,86 +295,61 @@ class PuppetMaster:
             sys.stderr.write("WARNING: attempt to close non-existent SSH connection.\n")
 
 
-    # Gets a list of SSL certs waiting to be signed on the puppet-master
-    def signPuppetSslRequest(self, instanceName):
-        keepTrying = True
-        if not self.is_connected:
-            self.connect()
-
-         # start a timer for waiting for the client cert to appear on the puppetmaster
-        self.startTime = time.time()
-      
-        # keep looking for the client cert request until timeout is reached
-        if verbose: print "<%s> -- Searching for puppet client certificate request [%s]..." % (self.connect_address, instanceName),
-        while keepTrying:
-
-            # grab the list of certs to sign
-            stdin, stdout, stderr = self.client.exec_command('sudo /usr/bin/puppet cert list')
-            if verbose:
-                for line in stderr.readlines():
-                    if len(line.lstrip().rstrip()) > 0:
-                        sys.stderr.write("\n<%s> -- %s\n" % (self.connect_address, line))
-
-            output = stdout.readlines()
-            if debug:
-                for line in output:
-                    if len(line.lstrip().rstrip()) > 0:
-                        sys.stderr.write("\n<%s> -- %s\n" % (self.connect_address, line))
-        
-            # if there are cert reqs waiting; 
-            # search the list for instanceName;
-            # if there's a match, sign the certificate & logout.
-            if len(output) > 0:
-                certReqSigned = False
-                quotedInstanceName = '"' + instanceName + '"'
-
-                for req in output:
-                    tmpName = req.lstrip().split()[0]
-                    tmpFingerprint = req.lstrip().split()[1]
-                    if tmpName == quotedInstanceName:
-                        if verbose: print "\n<%s> -- Signing Cert Request: %s %s\n" % \
-                                          ( self.connect_address, tmpName, tmpFingerprint ),
-    
-                        stdin, stdout, stderr = self.client.exec_command('sudo /usr/bin/puppet cert sign ' + tmpName)
-                        if debug:
-                            print "<%s> -- %s" % (self.connect_address, stdout.readlines())
-                        if verbose:
-                            print "<%s> -- %s" % (self.connect_address, stderr.readlines())
-
-                        certReqSigned = True
-                        break
-    
-                if certReqSigned:
-                    break
-                else:
-                    ret = self.checkTime() 
-                    if ret == 0:
-                        continue
-                    else:
-                        keepTrying = False
+    # runs a command on the puppetmaster in a channel of its own, returning its output
+    # and error lines once it's finished & the channel is closed
+    def execCommand(self, cmd):
+        self.channels.acquire()
+        try:
+            stdin, stdout, stderr = self.client.exec_command(cmd)
+            try:
+                output = stdout.readlines()
+                errors = stderr.readlines()
+            finally:
+                stdout.channel.close()
+        finally:
+            self.channels.release()
+        return (output, errors)
 
-            # no output recv'd, check timeout and keep waiting
-            else:
-                ret = self.checkTime() 
-                if ret == 0:
-                    continue
-                else:
-                    keepTrying = False
 
+    # Gets the SSL certs waiting to be signed on the puppet-master, as a dictionary of
+    # fingerprints, by quoted name
+    def listCertRequests(self):
+        if not self.is_connected:
+            self.connect()
 
-    # checks elapsed time while waiting for new server to request a certificate from puppetmaster
-    def checkTime(self):
-        if verbose: 
-            sys.stdout.write(" .")
-            sys.stdout.flush()
+        # grab the list of certs to sign
+        (output, errors) = self.execCommand('sudo /usr/bin/puppet cert list')
+        if verbose:
+            for line in errors:
+                if len(line.lstrip().rstrip()) > 0:
+                    sys.stderr.write("\n<%s> -- %s\n" % (self.connect_address, line))
+
+        if debug:
+            for line in output:
+                if len(line.lstrip().rstrip()) > 0:
+                    sys.stderr.write("\n<%s> -- %s\n" % (self.connect_address, line))
+
+        requests = {}
+        for req in output:
+            fields = req.lstrip().split()
+            if len(fields) >= 2:
+                requests[fields[0]] = fields[1]
+        return requests
+
+
+    # signs waiting cert requests, given as a dictionary of fingerprints by quoted name,
+    # all with the one command
+    def signCertRequests(self, requests):
+        if verbose:
+            for quotedInstanceName in sorted(requests.keys()):
+                print "\n<%s> -- Signing Cert Request: %s %s\n" % \
+                      ( self.connect_address, quotedInstanceName, requests[quotedInstanceName] ),
 
-        elapsedTime = (time.time() - self.startTime)
-        if elapsedTime < self.puppet_client_timeout:
-            time.sleep(10)
-            return 0
-        else:
-            sys.stderr.write("\n<%s> -- WARNING: did not receive a certificate request from client.\n" % self.connect_address)
-            return -1
+        (output, errors) = self.execCommand('sudo /usr/bin/puppet cert sign ' + join(sorted(requests.keys())))
+        if debug:
+            print "<%s> -- %s" % (self.connect_address, output)
+        if verbose:
+            print "<%s> -- %s" % (self.connect_address, errors)
 
 
     # lists the available hostclass templates on the remote puppetmaster server
@@ -213,32 +359,34 @@ class PuppetMaster:
 
         # This assumes hostclass templates are named "<hostclass>.template".
         cmd = "for template in $(ls " + templates_dir + "); do echo $template | cut -f1 -d.; done"
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-        if len(stderr.readlines()) > 0:
-            return join(stderr.readlines())
-        return (' ' + join(stdout.readlines()))
+        (output, errors) = self.execCommand(cmd)
+        if len(errors) > 0:
+            return join(errors)
+        return (' ' + join(output))
+
+
+    # ensures the selected hostclass is available on the puppetmaster, exiting if not.
+    # the hostclasses are only listed once, however many instances are provisioned.
+    def checkHostclass(self, hostclass):
+        if self.hostclasses is None:
+            self.hostclasses = self.getAvailableHostclasses()
+        hc_pattern = r'^\s(' + re.escape(hostclass) + ')$'
+        reObj = re.compile(hc_pattern, re.MULTILINE)
+        if len(reObj.findall(self.hostclasses)) == 0:
+            self.errorExit("<%s> -- ERROR: hostclass <%s> not found!\n" \
+                           % (self.connect_address, hostclass))
 
 
-    # create a node manifest for the new instance, using pre-defined templates
+    # create a node manifest for the new instance, using pre-defined templates. the
+    # hostclass should have been checked with checkHostclass() first.
     def provisionNodeManifest(self, instanceDnsName, hostclass):
         if not self.is_connected:
             self.connect()
 
-        # First, ensure the selected hostclass is available on the puppetmaster
-        hc_pattern = r'^\s(' + hostclass + ')$'
-        reObj = re.compile(hc_pattern, re.MULTILINE)
-        hostclasses = self.getAvailableHostclasses()
-        try:
-            # get the hostclass from the cmd output
-            hc_match = reObj.findall(hostclasses)
-        except IndexError:
-            self.errorExit("<%s> -- ERROR: hostclass <%s> not found!\n" \
-                           % (self.connect_address, hostclass))
-        
-        # Then, ensure the manifests doesn't already exist (don't want to overwrite it!)
+        # First, ensure the manifests doesn't already exist (don't want to overwrite it!)
         cmd = "ls " + nodes_dir + "/" + instanceDnsName + ".pp"
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-        output = join(stdout.readlines())
+        (output, errors) = self.execCommand(cmd)
+        output = join(output)
         if len(output) > 0:
             m = re.search(nodes_dir + "/" + instanceDnsName + ".pp$", output)
             if m != None:
@@ -249,12 +397,12 @@ class PuppetMaster:
         # Now, copy the manifest template (safely)
         cmd = "cp -b " + templates_dir + "/" + hostclass + ".template " \
               + nodes_dir + "/" + instanceDnsName + ".pp"
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-        if len(stderr.readlines()) > 0:
+        (output, errors) = self.execCommand(cmd)
+        if len(errors) > 0:
             sys.stderr.write("<%s> -- WARNING: there was a problem creating the manifest:\n---\n%s\n---\n" 
-                             % (self.connect_address, join(stderr.readlines())))
+                             % (self.connect_address, join(errors)))
             return
-        if verbose: print ' ' + join(stdout.readlines())
+        if verbose: print ' ' + join(output)
 
         # Finally, substitute the placeholder text in the template with our instance DNS name,
         # and touch the main nodes.pp file so puppetd knows about the new manifest.
@@ -263,22 +411,52 @@ class PuppetMaster:
                      + instanceDnsName + ".pp"))
         cmds.append(("touch " + nodes_pp))
         for cmd in cmds:
-            stdin, stdout, stderr = self.client.exec_command(cmd)
-            if len(stderr.readlines()) > 0:
+            (output, errors) = self.execCommand(cmd)
+            if len(errors) > 0:
                 sys.stderr.write("<%s> -- WARNING: there was a problem creating the manifest:\n---\n%s\n---\n" 
-                                 % (self.connect_address, join(stderr.readlines())))
+                                 % (self.connect_address, join(errors)))
                 return
 
         if verbose:
             print "<%s> -- Created node manifest [%s/%s.pp]." % (self.connect_address, nodes_dir, instanceDnsName)
 
-    # create a DNS A record for this instance
+    # create a DNS A record for this instance. returns 1 if one already exists.
     def addDnsRecord(self, dnsName, ipAddr, dnsDataFile):
+        # [name, ip, result], where result is None until it's been added
+        record = [dnsName, ipAddr, None]
+        self.dns_queue_lock.acquire()
+        self.dns_queue.append((dnsDataFile, record))
+        self.dns_queue_lock.release()
+
+        self.dns_lock.acquire()
+        try:
+            # unless it was added along with another instance's while we waited
+            if record[2] is None:
+                self.dns_queue_lock.acquire()
+                (queue, self.dns_queue) = (self.dns_queue, [])
+                self.dns_queue_lock.release()
+                byFile = {}
+                for (dataFile, queued) in queue:
+                    byFile.setdefault(dataFile, []).append(queued)
+                for dataFile in byFile:
+                    self._addDnsRecords(byFile[dataFile], dataFile)
+        finally:
+            self.dns_lock.release()
+        return record[2]
+
+    # adds [name, ip, result] records to the DNS data file, with one read & one append,
+    # setting each one's result
+    def _addDnsRecords(self, records, dnsDataFile):
+        for record in records:
+            record[2] = 0
         dns_A_pattern = re.compile(r'^=[a-zA-Z0-9.-]+:(\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})', re.MULTILINE)
         dns_CNAME_pattern = re.compile(r'^C([a-zA-Z0-9.-]+):.*', re.MULTILINE)
         if not self.is_connected:
             self.connect()
 
+        dnsFile = None
+        sftp_client = None
+        self.channels.acquire()
         try:
             sftp_client = self.client.open_sftp()
 
@@ -290,31 +468,46 @@ class PuppetMaster:
             # If an A record exists with same IP, or if a CNAME which would match the hostname part of
             # the A record already exists, skip DNS provisioning. 
             # Else, create a new A record.
-            a_records = []
-            cname_records = []
+            a_records = set()
+            cname_records = set()
             for line in dnsData:
-                a_records = a_records + dns_A_pattern.findall(line.rstrip())
-            if ipAddr in a_records:
-                print "<%s> -- DNS A-record already exists for %s. Skipping..." % (self.connect_address, ipAddr)
-                return 1
-            if dnsName in cname_records:
-                print "<%s> -- DNS CNAME-record for %s already exists! Skipping..." % (self.connect_address, dnsName)
-                return 1
-
-            newRecord = "\n# autogenerated entry follows.\n"
-            newRecord = newRecord + "=" + dnsName + ":" + ipAddr + "\n"
+                a_records.update(dns_A_pattern.findall(line.rstrip()))
+            newRecords = []
+            for record in records:
+                (dnsName, ipAddr) = (record[0], record[1])
+                if ipAddr in a_records:
+                    print "<%s> -- DNS A-record already exists for %s. Skipping..." % (self.connect_address, ipAddr)
+                    record[2] = 1
+                    continue
+                if dnsName in cname_records:
+                    print "<%s> -- DNS CNAME-record for %s already exists! Skipping..." % (self.connect_address, dnsName)
+                    record[2] = 1
+                    continue
+                a_records.add(ipAddr)
+                newRecords.append(record)
+            if len(newRecords) == 0:
+                return
+
+            newRecord = ''
+            for (dnsName, ipAddr, result) in newRecords:
+                newRecord = newRecord + "\n# autogenerated entry follows.\n"
+                newRecord = newRecord + "=" + dnsName + ":" + ipAddr + "\n"
             dnsFile.write(newRecord)
             dnsFile.flush()
             print "\n<%s> -- DNS File Modified: %s" % (self.connect_address, dnsDataFile)
-            print "<%s> -- Provisioned new DNS A-record: \"=%s:%s\"" % (self.connect_address, dnsName, ipAddr)
+            for (dnsName, ipAddr, result) in newRecords:
+                print "<%s> -- Provisioned new DNS A-record: \"=%s:%s\"" % (self.connect_address, dnsName, ipAddr)
         except IOError, e:
             sys.stderr.write("<%s> -- ERROR: IOError on file [%s]!\n" % (self.connect_address, dnsDataFile))
             sys.stderr.write("<%s> -- error=\"%s\", errno=%s\n" % (self.connect_address, e, e.errno))
         except Exception, e:
             sys.stderr.write("<%s> -- ERROR: Failed to provision DNS record! %s\n" % (self.connect_address, e))
         finally:
-            dnsFile.close()
-        return 0
+            if dnsFile is not None:
+                dnsFile.close()
+            if sftp_client is not None:
+                sftp_client.close()
+            self.channels.release()
 
     # print an error message and exit
     def errorExit(self, msg):
@@ -324,6 +517,282 @@ class PuppetMaster:
 ## END CLASS <PuppetMaster>
 
 
+# CertSigner: Signs puppet client cert requests for many instances at once. Each instance
+# waiting for its cert is registered with sign(), and one thread polls the puppetmaster's
+# cert requests for all of them, rather than each instance polling on its own.
+class CertSigner:
+    def __init__(self, puppetMaster, pollInterval=10):
+        self.puppet_master = puppetMaster
+        self.poll_interval = pollInterval
+        self.lock = threading.Lock()
+        # Events to set when each (quoted) name's cert is signed
+        self.waiting = {}
+        self.thread = None
+
+
+    # waits up to 'timeout' seconds for the instance's cert request, and signs it.
+    # returns True if it was signed.
+    def sign(self, instanceName, timeout):
+        quotedInstanceName = '"' + instanceName + '"'
+        signed = threading.Event()
+        self.lock.acquire()
+        try:
+            self.waiting[quotedInstanceName] = signed
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._poll)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+        if verbose: print "<%s> -- Searching for puppet client certificate request [%s]..." \
+                          % (self.puppet_master.connect_address, instanceName)
+        signed.wait(timeout)
+        self.lock.acquire()
+        try:
+            del self.waiting[quotedInstanceName]
+        finally:
+            self.lock.release()
+        if not signed.isSet():
+            sys.stderr.write("<%s> -- WARNING: did not receive a certificate request from client [%s].\n"
+                             % (self.puppet_master.connect_address, instanceName))
+        return signed.isSet()
+
+
+    # polls for cert requests while any instance is waiting for one
+    def _poll(self):
+        while True:
+            self.lock.acquire()
+            waiting = self.waiting.copy()
+            self.lock.release()
+
+            if len(waiting) > 0:
+                try:
+                    requests = self.puppet_master.listCertRequests()
+                    toSign = {}
+                    for quotedInstanceName in waiting:
+                        if quotedInstanceName in requests:
+                            toSign[quotedInstanceName] = requests[quotedInstanceName]
+                    if len(toSign) > 0:
+                        self.puppet_master.signCertRequests(toSign)
+                        for quotedInstanceName in toSign:
+                            waiting[quotedInstanceName].set()
+                except Exception, e:
+                    sys.stderr.write("<%s> -- WARNING: failed to check for certificate requests: %s\n"
+                                     % (self.puppet_master.connect_address, e))
+            time.sleep(self.poll_interval)
+## END CLASS <CertSigner>
+
+
+# InstanceWatcher: Finds launched instances' IP addresses, subnets & availability zones.
+# Each instance waiting for them is registered with waitFor(), and one thread looks them
+# all up with a single describe call per poll. Polls back off while nothing turns up,
+# and each subnet's availability zone is only looked up once.
+class InstanceWatcher:
+    def __init__(self, ec2Client, minInterval=2, maxInterval=30):
+        self.ec2 = ec2Client
+        self.min_interval = minInterval
+        self.max_interval = maxInterval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # (Ec2Instance, Event to set when its details are in) by instance id
+        self.waiting = {}
+        self.new_waiters = False
+        self.subnet_zones = {}
+        self.last_error = None
+        self.thread = None
+
+
+    # waits up to 'timeout' seconds for the instance's IP address, subnet & availability
+    # zone, and fills them in. returns True if they were found.
+    def waitFor(self, instance, timeout):
+        found = threading.Event()
+        self.lock.acquire()
+        try:
+            self.waiting[instance.instance_id] = (instance, found)
+            self.new_waiters = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._poll)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.wakeup.notify()
+        finally:
+            self.lock.release()
+
+        found.wait(timeout)
+        self.lock.acquire()
+        try:
+            del self.waiting[instance.instance_id]
+        finally:
+            self.lock.release()
+        return found.isSet()
+
+
+    # looks up the IP addresses & subnets of these instances, and the availability zones
+    # of any subnets not seen before. returns (ip address, subnet id, availability zone)
+    # tuples by instance id, for the instances found.
+    def lookup(self, instanceIds):
+        interfaces = self.ec2.describeNetworkInterfaces(instanceIds)
+        newSubnets = []
+        for (ipAddress, subnetId) in interfaces.values():
+            if subnetId not in self.subnet_zones and subnetId not in newSubnets:
+                newSubnets.append(subnetId)
+        if len(newSubnets) > 0:
+            self.subnet_zones.update(self.ec2.describeSubnets(newSubnets))
+
+        found = {}
+        for (instanceId, (ipAddress, subnetId)) in interfaces.items():
+            if subnetId in self.subnet_zones:
+                found[instanceId] = (ipAddress, subnetId, self.subnet_zones[subnetId])
+        return found
+
+
+    # looks up the waiting instances while there are any. new ones are looked up right
+    # away; otherwise the interval doubles each poll nothing's found, up to max_interval.
+    def _poll(self):
+        interval = self.min_interval
+        while True:
+            self.lock.acquire()
+            try:
+                while len(self.waiting) == 0:
+                    self.wakeup.wait()
+                instanceIds = self.waiting.keys()
+                self.new_waiters = False
+            finally:
+                self.lock.release()
+
+            try:
+                found = self.lookup(instanceIds)
+                self.last_error = None
+            except Exception, e:
+                found = {}
+                # the last line of a failed command's output is usually what went wrong
+                lines = [l.strip() for l in str(e).splitlines() if l.strip() not in ('', '---')]
+                self.last_error = (lines or [repr(e)])[-1]
+                sys.stderr.write("WARNING: failed to look up instances' IP addresses: %s\n" % e)
+
+            self.lock.acquire()
+            try:
+                for (instanceId, details) in found.items():
+                    # the instance may have given up on its details in the meantime
+                    if instanceId in self.waiting:
+                        (instance, event) = self.waiting[instanceId]
+                        (instance.ip_address, instance.subnet_id, instance.availability_zone) = details
+                        event.set()
+                if len(found) > 0 or self.new_waiters:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 2, self.max_interval)
+                if not self.new_waiters:
+                    if verbose and len(instanceIds) > len(found):
+                        print "NOTICE: could not get IP address and subnet for %d instances. Retrying in %ds..." \
+                              % (len(instanceIds) - len(found), interval)
+                    self.wakeup.wait(interval)
+            finally:
+                self.lock.release()
+## END CLASS <InstanceWatcher>
+
+
+# LaunchPipeline: Provisions launched instances through each of pipelineStages, 'workers'
+# instances at a time, timing each stage. a failed stage stops that instance, but not
+# the others.
+class LaunchPipeline:
+    def __init__(self, options, ec2Client, puppetMaster=None, workers=50):
+        self.options = options
+        self.puppet_master = puppetMaster
+        self.workers = workers
+        self.watcher = InstanceWatcher(ec2Client)
+        self.cert_signer = None
+        if puppetMaster is not None:
+            self.cert_signer = CertSigner(puppetMaster)
+
+
+    # provisions the instances with these ids (launched from 'amiId'), returning their
+    # Ec2Instances, in the same order
+    def run(self, instanceIds, amiId):
+        instanceQueue = Queue.Queue()
+        resultQueue = Queue.Queue()
+        for instanceId in instanceIds:
+            instanceQueue.put(instanceId)
+        threads = []
+        for i in range(min(self.workers, len(instanceIds))):
+            instanceQueue.put(None)
+            t = threading.Thread(target=self._worker, args=(instanceQueue, resultQueue, amiId))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        instances = {}
+        while len(instances) < len(instanceIds):
+            # with a timeout, so ctrl-c still works
+            try:
+                instance = resultQueue.get(True, 1)
+            except Queue.Empty:
+                continue
+            instances[instance.instance_id] = instance
+        for t in threads:
+            t.join()
+        return [instances[instanceId] for instanceId in instanceIds]
+
+
+    # provisions instances from the queue until it gets a None
+    def _worker(self, instanceQueue, resultQueue, amiId):
+        instanceId = instanceQueue.get()
+        while instanceId is not None:
+            resultQueue.put(self.provision(instanceId, amiId))
+            instanceId = instanceQueue.get()
+
+
+    # runs each stage for one instance
+    def provision(self, instanceId, amiId):
+        instance = Ec2Instance(instanceId)
+        instance.hostclass = self.options.hostclass
+        instance.ami_id = amiId
+        stages = [('discover_ip', self.discoverIp)]
+        if self.puppet_master is not None:
+            if not self.options.skip_puppet_provisioning:
+                stages.append(('manifest', self.provisionManifest))
+                stages.append(('cert_sign', self.signCert))
+            if not self.options.skip_dns_provisioning:
+                stages.append(('dns', self.addDnsRecord))
+
+        for (stage, func) in stages:
+            startTime = time.time()
+            try:
+                func(instance)
+            except Exception, e:
+                instance.errors.append("%s: %s" % (stage, e))
+                instance.failed = True
+                if debug and not isinstance(e, ProvisioningError):
+                    traceback.print_exc()
+            instance.stage_times[stage] = time.time() - startTime
+            if instance.failed:
+                sys.stderr.write("ERROR: instance %s failed to provision at stage %s. %s\n"
+                                 % (instance.instance_id, stage, instance.errors[-1]))
+                break
+        return instance
+
+
+    def discoverIp(self, instance):
+        getInstance(instance, self.watcher)
+        print "Created EC2 Instance: %s, %s, %s" % (instance.instance_id, instance.dns_name, instance.ip_address)
+
+    def provisionManifest(self, instance):
+        print "<%s> -- Executing Puppet provisioning tasks for %s..." % (self.options.puppetmaster, instance.dns_name)
+        self.puppet_master.provisionNodeManifest(instance.dns_name, instance.hostclass)
+
+    # a cert that's never requested doesn't stop DNS provisioning, as it may still be
+    # signed by hand
+    def signCert(self, instance):
+        if not self.cert_signer.sign(instance.dns_name, self.puppet_master.puppet_client_timeout):
+            instance.errors.append("cert_sign: no certificate request within %ds" % self.puppet_master.puppet_client_timeout)
+
+    def addDnsRecord(self, instance):
+        print "<%s> -- Executing DNS provisioning tasks for %s..." % (self.options.puppetmaster, instance.dns_name)
+        self.puppet_master.addDnsRecord(instance.dns_name, instance.ip_address, self.options.djbdns_datafile)
+## END CLASS <LaunchPipeline>
+
+
 # make sure we're using at least Python 2.6
 def checkEnv():
     if sys.hexversion < 0x02060000:
@@ -337,59 +806,29 @@ def ec2_help_callback(option, opt, value, parser):
     (status, output) = commands.getstatusoutput(tmpCmd)
     print output
 
-# build the instance FQDN from ec2run options
-def getInstance(options, ec2runOutput):
-    id_pattern = re.compile(r'^INSTANCE\s+(i-[a-f0-9]{8})', re.MULTILINE)
-    ip_pattern = re.compile(r'^PRIVATEIPADDRESS\s+(\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})', re.MULTILINE)
-    subnet_pattern = re.compile(r'\s(subnet\-[a-zA-Z0-9]+)', re.MULTILINE)
-    instance = Ec2Instance()
-    instance.hostclass = options.hostclass
-
-    # first get instance_id
-    try:
-        instance.instance_id = id_pattern.findall(ec2runOutput)[0].rstrip().lstrip()
-    except IndexError:
+# get the ids of every instance ec2run launched
+def getInstanceIds(ec2runOutput):
+    id_pattern = re.compile(r'^INSTANCE\s+(i-[a-f0-9]{8,17})', re.MULTILINE)
+    instanceIds = []
+    for instanceId in id_pattern.findall(ec2runOutput):
+        if instanceId not in instanceIds:
+            instanceIds.append(instanceId)
+    if len(instanceIds) == 0:
         sys.stderr.write("ERROR: ec2run failed to provide an instance ID! ec2run output follows:\n")
         sys.stderr.write("---\n%s\n---\n" % ec2runOutput)
         sys.exit(1)
-
-    # Now get ip_address & subnet_id. ec2run doesn't always give this info in the output, so
-    # we have to look for it explicitly, for up to 60 seconds.
-    startTime = time.time()
-    timeDiff = 0
-    while timeDiff < 60:
-        try:
-            cmd = "ec2-describe-network-interfaces --filter \"attachment.instance-id=" + instance.instance_id + "\""
-            (cmd_status, output) = commands.getstatusoutput(cmd)
-            if cmd_status == 0:
-                instance.ip_address = ip_pattern.findall(output, re.MULTILINE)[0].rstrip().lstrip()
-                instance.subnet_id = subnet_pattern.findall(output, re.MULTILINE)[0].rstrip().lstrip()
-
-                # got our ip & subnet, so let's bail
-                break
-            else:
-                sys.stderr.write("ERROR: ec2-describe-network-interfaces exited with status %s. Output follows:" % status)
-                sys.stderr.write("\n---\n%s\n---\n" % output)
-                sys.exit(1)
-        except IndexError:
-            if options.debug:
-                sys.stderr.write("WARNING: ec2run output failed to provide IP_ADDRESS and/or SUBNET_ID. Output follows.")
-                sys.stderr.write("\n---\n" + ec2runOutput + "\n---\n")
-            if options.verbose:
-                print "NOTICE: could not get IP address and subnet. Retrying..."
-        time.sleep(5)
-        timeDiff = time.time() - startTime
-
-    # get az from subnet description
-    tmpCmd = "ec2-describe-subnets " + instance.subnet_id
-    (status, output) = commands.getstatusoutput(tmpCmd)
-    try:
-        if status == 0:
-            instance.availability_zone = output.split()[6]   
-    except IndexError:
-        sys.stderr.write("ERROR: ec2-describe-subnets exited with status %s. Output follows:" % status)
-        sys.stderr.write("\n---\n" + output + "\n---\n")
-        sys.exit(1)
+    return instanceIds
+
+# build the instance FQDN from ec2run options, once the watcher has found the instance's
+# details. raises a ProvisioningError if they can't be found.
+def getInstance(instance, watcher, timeout=60):
+    # ec2run doesn't always give the ip_address & subnet_id in its output, so we have to
+    # look for them explicitly, for up to 60 seconds.
+    if not watcher.waitFor(instance, timeout):
+        msg = "no IP address & subnet for %s after %d seconds" % (instance.instance_id, timeout)
+        if watcher.last_error is not None:
+            msg = msg + " (%s)" % watcher.last_error
+        raise ProvisioningError(msg)
 
     # build proper DNS name from instance properties (i.e. foo-10-0-0-254.us-east-1a.foo.bar)
     ip_dashed = instance.ip_address.replace(".", "-")
@@ -417,8 +856,35 @@ def ec2opt_callback(option, opt, value, parser):
         ec2run_opts[option.dest] = (opt, '')
 
 
+# prints how long each stage took for each instance, and the slowest of each stage.
+# returns the number of instances which failed.
+def reportPipeline(instances, elapsed):
+    failed = [i for i in instances if i.failed]
+    print "\nProvisioned %d of %d instances in %.1f seconds:" % (len(instances) - len(failed), len(instances), elapsed)
+    print "  %-20s %-48s" % ('instance', 'dns name') + ''.join(["%12s" % stage for stage in pipelineStages])
+    for instance in instances:
+        times = []
+        for stage in pipelineStages:
+            if stage in instance.stage_times:
+                times.append("%11.1fs" % instance.stage_times[stage])
+            else:
+                times.append("%12s" % '-')
+        print "  %-20s %-48s" % (instance.instance_id, instance.dns_name) + ''.join(times)
+        for error in instance.errors:
+            print "      %s" % error.splitlines()[0]
+    slowest = []
+    for stage in pipelineStages:
+        times = [i.stage_times[stage] for i in instances if stage in i.stage_times]
+        if len(times) > 0:
+            slowest.append("%11.1fs" % max(times))
+        else:
+            slowest.append("%12s" % '-')
+    print "  %-69s" % 'slowest' + ''.join(slowest)
+    return len(failed)
+
+
 # run ec2run command with specified options
-def execute_ec2run(instance):
+def execute_ec2run(ec2, instance):
     ec2run_cmd = "ec2run"
 
     if len(ec2run_opts['debug'][0]) > 1:
@@ -439,14 +905,12 @@ def execute_ec2run(instance):
 
     # finally, execute the ec2run command-line
     print "Executing: %s" % ec2run_cmd
-    (status, output) = commands.getstatusoutput(ec2run_cmd)
-    if status != 0:
-        sys.stderr.write("ERROR: ec2run exited with status %s. Output follows.\n---\n" % status)
-        sys.stderr.write(output + "\n---\n")
+    try:
+        return ec2.runInstances(ec2run_cmd)
+    except Ec2ApiError, e:
+        sys.stderr.write("ERROR: %s\n" % e)
         sys.exit(1)
 
-    return output
-
 
 
 ###################################
@@ -563,6 +1027,12 @@ optGroup.add_option('--djbdns-data-file', type='string', dest='djbdns_datafile',
                     help='The path to the DJBDNS data file on the puppetmaster.')
 optGroup.add_option('--skip-dns-provisioning', action='store_true', dest='skip_dns_provisioning', 
                     help='Do not perform DNS provisioning on the puppetmaster.', default=False)
+optGroup.add_option('--workers', type='int', dest='workers', default=50,
+                    help='The number of launched instances to provision at once; most of the time is spent'
+                         + ' waiting on the instances, not working. (default 50)')
+optGroup.add_option('--fake-ec2', action='store_true', dest='fake_ec2', default=False,
+                    help='Launch nothing; use a local fake of the EC2 API instead, to try out launching.'
+                         + ' Implies --skip-puppet-provisioning and --skip-dns-provisioning.')
 parser.add_option_group(optGroup)
 parser.disable_interspersed_args()
 try:
@@ -583,6 +1053,13 @@ try:
         sys.exit(1)
     if options.exit:
         sys.exit(1)
+    if options.workers < 1:
+        sys.stderr.write("ERROR: --workers must be at least 1.\n")
+        sys.exit(1)
+    # fake instances mustn't get real manifests, certs or DNS records
+    if options.fake_ec2:
+        options.skip_puppet_provisioning = True
+        options.skip_dns_provisioning = True
     verbose = options.verbose
     debug = options.debug
 except Exception as e:
@@ -601,31 +1078,40 @@ else:
 #       and based on input to this utility, we could dynamically generate a userdata script.
 #       Optionally, we can build AMIs up to the point that they wouldn't need this script...
 
-ec2runOutput = execute_ec2run(instance)
-if options.verbose: print "ec2run output:\n---\n" + ec2runOutput + "\n---\n"
-
-# Create a DNS name for the instance based on parsed instance attributes.
-# (also, handle common issue where ec2run doesn't provide an IP in output...)
-instance = getInstance(options, ec2runOutput)
-print "Created EC2 Instance: %s, %s, %s" % (instance.instance_id, instance.dns_name, instance.ip_address)
+if options.fake_ec2:
+    ec2 = FakeEc2Client()
+else:
+    ec2 = Ec2CliClient()
 
-# run the puppetmaster tasks, if user asked for it.
-if options.puppetmaster != '':
+# connect to the puppetmaster first, so a bad hostclass is caught before anything's launched
+puppetMaster = None
+if options.fake_ec2:
+    print "--fake-ec2 specified; skipping Puppet & DNS provisioning..."
+elif options.puppetmaster != '':
     puppetMaster = PuppetMaster(address=options.puppetmaster, clientTimeout=options.puppet_client_timeout)
     puppetMaster.connect()
     if not options.skip_puppet_provisioning:
-        print "<%s> -- Executing Puppet provisioning tasks..." % options.puppetmaster
-        puppetMaster.provisionNodeManifest(instance.dns_name, instance.hostclass)
-        puppetMaster.signPuppetSslRequest(instance.dns_name)
-
-    if not options.skip_dns_provisioning:
-        print "<%s> -- Executing DNS provisioning tasks..." % options.puppetmaster
-        puppetMaster.addDnsRecord(instance.dns_name, instance.ip_address, options.djbdns_datafile)
-    puppetMaster.disconnect()
+        puppetMaster.checkHostclass(options.hostclass)
 else:
     print "--puppetmaster not specified; skipping Puppet & DNS provisioning..."
 
-if options.verbose: print "Completed provisioning for instance: %s" % instance.dns_name
+startTime = time.time()
+ec2runOutput = execute_ec2run(ec2, instance)
+if options.verbose: print "ec2run output:\n---\n" + ec2runOutput + "\n---\n"
+
+# Create a DNS name for each instance based on parsed instance attributes, and run the
+# puppetmaster tasks, if user asked for it.
+# (also, handle common issue where ec2run doesn't provide an IP in output...)
+instanceIds = getInstanceIds(ec2runOutput)
+pipeline = LaunchPipeline(options, ec2, puppetMaster, options.workers)
+instances = pipeline.run(instanceIds, instance.ami_id)
+if puppetMaster is not None:
+    puppetMaster.disconnect()
+
+failed = reportPipeline(instances, time.time() - startTime)
+if options.verbose: print "Completed provisioning for instances: %s" % join([i.dns_name for i in instances if not i.failed], ', ')
+if failed > 0:
+    sys.exit(1)
 
 # TODO: Add SSH_KNOWN_HOSTS & clusterit.conf management?
 #       SSH host keys are available as facter variables, so maybe puppet should handle this?
@@ -4,9 +4,39 @@
 # This utility does a simple system audit on the local host, printing 
 # relevant information about system security. 
 #
+# authorized_keys entries are fingerprinted in-process, the same as 'ssh-keygen -l'
+# would (-E/--fingerprint-hash picks md5 or sha256), and only key types it doesn't
+# know are handed to ssh-keygen, all in a single run.
+#
+# With -i/--inventory, it audits a fleet instead: this script is piped to each host
+# in the inventory over ssh, many hosts at a time, and each host's results are printed
+# as a json line as they come back, followed by who can log in where across the fleet.
+#   ssh-login-audit.py -i hosts.txt -j 100 > audit.json
+#
+# With --cache, what's parsed from each file is kept between runs, so a rerun only
+# re-reads files which have changed, and reports what's changed since the last run;
+# cheap enough to run from cron every few minutes:
+#   */5 * * * * ssh-login-audit.py --cache /var/cache/ssh-login-audit.json --changes-only
+#
+# sshd_config is read the way sshd reads it (see SshdConfig): Include, Match blocks,
+# AuthorizedKeysFile and sshd's defaults are all taken into account, for each user.
+# Match Address/Host blocks apply to the --source-address/--source-host given.
+#
+# With --user-db getent, users, groups & passwords are streamed from NSS, so directory
+# (sssd/LDAP) accounts are audited too, without holding the whole directory at once:
+#   ssh-login-audit.py --user-db getent
+#
+# Results can be printed as text, a json object, json lines or csv (-f/--format), with
+# a record per user (see userResult), and the 'diff' subcommand compares two sets of
+# results (json lines, or --json/fleet output), i.e. for alerting on what's changed:
+#   ssh-login-audit.py -i hosts.txt -f jsonl > today.jsonl
+#   ssh-login-audit.py -f jsonl diff yesterday.jsonl today.jsonl
+#
 # Author: Devin Cherry <devincherry@gmail.com>
 ##
-import re, os, sys, commands, tempfile
+import re, os, sys, commands, tempfile, base64, hashlib, struct, glob, binascii
+import json, socket, shlex, subprocess, threading, time, Queue, signal, csv, pipes
+from optparse import OptionParser
 
 
 # flags for capabilities logic
@@ -19,25 +49,74 @@ USER_PASSWD_VALID = 32
 USER_PASSWD_BLANK = 64
 USER_SSH_PUBKEY_EXISTS = 128
 
+# the flags' names, for results
+loginFlagNames = [
+    (SSH_ROOT_LOGIN_ENABLED,    'ssh_root_login_enabled'),
+    (SSH_PUBKEY_ENABLED,        'ssh_pubkey_enabled'),
+    (SSH_EMPTY_PASSWD_ENABLED,  'ssh_empty_passwd_enabled'),
+    (SSH_ALLOWED_USER,          'ssh_allowed_user'),
+    (USER_SHELL_VALID,          'user_shell_valid'),
+    (USER_PASSWD_VALID,         'user_passwd_valid'),
+    (USER_PASSWD_BLANK,         'user_passwd_blank'),
+    (USER_SSH_PUBKEY_EXISTS,    'user_ssh_pubkey_exists'),
+]
+
+# the fields of a user's result record, and of a change record from diffRecords(), in
+# the order they're written as csv columns
+resultFields = ['host', 'name', 'can_login', 'login_flags', 'flags', 'keys']
+changeFields = ['host', 'name', 'change', 'old', 'new']
+
+# sshd's defaults (as of OpenSSH 7.0) for the settings the audit looks at
+sshdDefaults = {
+    'authorizedkeysfile':       ['.ssh/authorized_keys', '.ssh/authorized_keys2'],
+    'permitemptypasswords':     ['no'],
+    'permitrootlogin':          ['prohibit-password'],
+    'pubkeyauthentication':     ['yes'],
+}
+
+# key types fingerprinted in-process: type -> (ssh-keygen's name for it, bits, or None
+# if they're read from the key)
+sshKeyTypes = {
+    'ssh-rsa':                              ('RSA', None),
+    'ssh-dss':                              ('DSA', None),
+    'ecdsa-sha2-nistp256':                  ('ECDSA', 256),
+    'ecdsa-sha2-nistp384':                  ('ECDSA', 384),
+    'ecdsa-sha2-nistp521':                  ('ECDSA', 521),
+    'ssh-ed25519':                          ('ED25519', 256),
+    'sk-ecdsa-sha2-nistp256@openssh.com':   ('ECDSA-SK', 256),
+    'sk-ssh-ed25519@openssh.com':           ('ED25519-SK', 256),
+}
+
 
 if sys.version_info < (2, 6): 
     sys.stderr.write("ERROR: this script requires python 2.6+!\n")
     sys.exit(1)
 
-if os.geteuid() != 0:
-    sys.stderr.write("ERROR: you must run this script as root!\n")
-    sys.exit(1)
 
+# holds details about a user on the system. there's one for every account, which
+# with a directory can be tens of thousands, so it has __slots__ rather than a
+# __dict__, and users with no keys share an empty tuple.
+class LocalUser(object):
+    __slots__ = ('name', 'shell', 'home', 'password', 'uid', 'groups', 'ssh_authorized_keys',
+                 'authorized_keys_files', 'login_flags')
 
-# holds details about a user on the system
-class LocalUser:
-    def __init__(self, username="", password="", home="", shell=""):
+    def __init__(self, username="", password="", home="", shell="", uid=None, groups=(), loginFlags=0x0000):
         self.name = username
         self.shell = shell
         self.home = home
         self.password = password
-        self.ssh_authorized_keys = []
-        self.login_flags = 0x0000
+        self.uid = uid
+        self.groups = groups
+        self.ssh_authorized_keys = ()
+        # where sshd looks for the user's keys, once sshd_config has been read
+        self.authorized_keys_files = None
+        self.login_flags = loginFlags
+
+    def addAuthorizedKey(self, key):
+        if len(self.ssh_authorized_keys) == 0:
+            self.ssh_authorized_keys = []
+        self.ssh_authorized_keys.append(key)
+        self.login_flags = self.login_flags | USER_SSH_PUBKEY_EXISTS
 
     def canLogin(self):
         # special case for root login; test this first
@@ -58,6 +137,638 @@ class LocalUser:
         return False
 
 
+# an authorized_keys entry's key, as 'ssh-keygen -l' describes it
+class AuthorizedKey:
+    def __init__(self, keyType, bits, comment, md5=None, sha256=None):
+        self.key_type = keyType
+        self.bits = bits
+        self.comment = comment
+        self.md5 = md5
+        self.sha256 = sha256
+
+    # formats the key like 'ssh-keygen -l -E <hashName>'. keys fingerprinted by an old
+    # ssh-keygen may only have an md5 fingerprint, whatever 'hashName' is.
+    def fingerprint(self, hashName='sha256'):
+        if (hashName == 'md5' and self.md5 is not None) or self.sha256 is None:
+            fingerprint = 'MD5:' + self.md5
+        else:
+            fingerprint = 'SHA256:' + self.sha256
+        return "%d %s %s (%s)" % (self.bits, fingerprint, self.comment, self.key_type)
+
+
+# splits an authorized_keys line into a tuple of (key type, base64 key, comment),
+# skipping any options before the key. returns None if there's no key on the line.
+def splitAuthorizedKey(line):
+    fields = line.strip().split(None, 2)
+    # a key blob starts with its type's length as a 32-bit int, so always encodes to
+    # 'AAAA'; if the second field isn't one, the line starts with options
+    if len(fields) > 1 and not fields[1].startswith('AAAA'):
+        line = line.strip()
+        inQuotes = False
+        i = 0
+        while i < len(line) and (inQuotes or not line[i].isspace()):
+            if line[i] == '\\' and inQuotes:
+                i = i + 1
+            elif line[i] == '"':
+                inQuotes = not inQuotes
+            i = i + 1
+        fields = line[i:].split(None, 2)
+    if len(fields) < 2:
+        return None
+    if len(fields) < 3:
+        fields.append('no comment')
+    return tuple(fields)
+
+
+# reads an SSH wire-format string (a 32-bit length, then that many bytes) from 'blob'
+# at 'offset'. returns a tuple of (string, offset after it)
+def readSshString(blob, offset):
+    if offset + 4 > len(blob):
+        raise ValueError("truncated key")
+    (length,) = struct.unpack('>I', blob[offset:offset + 4])
+    if offset + 4 + length > len(blob):
+        raise ValueError("truncated key")
+    return (blob[offset + 4:offset + 4 + length], offset + 4 + length)
+
+
+# the number of significant bits in an SSH mpint
+def mpintBits(value):
+    value = value.lstrip('\x00')
+    if value == '':
+        return 0
+    return (len(value) - 1) * 8 + len(bin(ord(value[0]))) - 2
+
+
+# fingerprints a key the way 'ssh-keygen -l' does: the fingerprints are hashes of the
+# decoded key blob, and the bits are its modulus' (RSA, DSA) or its curve's. returns
+# an AuthorizedKey, or None for key types only ssh-keygen knows (certificates & such).
+# raises ValueError for keys ssh-keygen would reject.
+def parseKey(keyType, encoded, comment):
+    if keyType not in sshKeyTypes:
+        return None
+    if not re.match(r'^[A-Za-z0-9+/]+={0,2}$', encoded):
+        raise ValueError("key isn't base64")
+    try:
+        blob = base64.b64decode(encoded)
+    except TypeError:
+        raise ValueError("key isn't base64")
+    (blobType, offset) = readSshString(blob, 0)
+    if blobType != keyType:
+        raise ValueError("%s key holds a %s key" % (keyType, repr(blobType)))
+
+    (name, bits) = sshKeyTypes[keyType]
+    if keyType == 'ssh-rsa':
+        (exponent, offset) = readSshString(blob, offset)
+        (modulus, offset) = readSshString(blob, offset)
+        bits = mpintBits(modulus)
+    elif keyType == 'ssh-dss':
+        (prime, offset) = readSshString(blob, offset)
+        bits = mpintBits(prime)
+    md5 = ':'.join(['%02x' % ord(c) for c in hashlib.md5(blob).digest()])
+    sha256 = base64.b64encode(hashlib.sha256(blob).digest()).rstrip('=')
+    return AuthorizedKey(name, bits, comment, md5, sha256)
+
+
+# fingerprints the keys parseKey() doesn't know with a single ssh-keygen run over all
+# of them, rather than one per key. 'keys' is a list of (key type, base64 key,
+# comment); each is written out with its index as its comment, to match ssh-keygen's
+# output back up to it. returns a dict of index -> AuthorizedKey, of the keys
+# ssh-keygen could read.
+def fingerprintWithSshKeygen(keys, hashName):
+    outputRegex = re.compile(r'^(?P<bits>\d+) (?:(?P<hash>MD5|SHA256):)?(?P<fingerprint>\S+) (?P<index>\d+) \((?P<type>[^)]+)\)$')
+    tmpFile = tempfile.NamedTemporaryFile()
+    for i in range(len(keys)):
+        tmpFile.write("%s %s %d\n" % (keys[i][0], keys[i][1], i))
+    tmpFile.flush()
+    (status, output) = commands.getstatusoutput("ssh-keygen -l -E %s -f %s" % (hashName, tmpFile.name))
+    if status != 0:
+        # ssh-keygen before OpenSSH 6.8 has no -E, and only does md5
+        (status, output) = commands.getstatusoutput("ssh-keygen -l -f %s" % tmpFile.name)
+    tmpFile.close()
+
+    fingerprinted = {}
+    for line in output.splitlines():
+        m = outputRegex.match(line.strip())
+        if not m or int(m.group('index')) >= len(keys):
+            continue
+        i = int(m.group('index'))
+        key = AuthorizedKey(m.group('type'), int(m.group('bits')), keys[i][2])
+        if m.group('hash') == 'SHA256':
+            key.sha256 = m.group('fingerprint')
+        else:
+            key.md5 = m.group('fingerprint')
+        fingerprinted[i] = key
+    return fingerprinted
+
+
+# converts the unicode strings json decodes to utf-8 strs, like the files they came from
+def encodeStrings(obj):
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [encodeStrings(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict([(encodeStrings(k), encodeStrings(v)) for (k, v) in obj.items()])
+    return obj
+
+
+# the state of a file, as [inode, size, mtime in ns], or None if it doesn't exist
+def fileState(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # python 2 has no st_mtime_ns; the float st_mtime is still finer than a microsecond
+    return [st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1000000000))]
+
+
+# Keeps what was parsed from each file the audit reads between runs, keyed by the
+# file's state, so a rerun only re-parses the files which have changed. the last run's
+# results are kept too, to report what's changed since. password hashes are never
+# cached; only whether each user's password is valid or blank.
+class AuditCache:
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        # path -> {'state': file state, 'data': what was parsed from it}
+        self.files = {}
+        # the last run's {'time', 'fingerprint_hash', 'users'}
+        self.previous = None
+        # the files read this run
+        self.seen = {}
+        self.hits = 0
+        self.parsed = 0
+        try:
+            data = encodeStrings(json.load(open(path, 'r')))
+            if data.get('version') == self.version:
+                self.files = data['files']
+                self.previous = data['results']
+        except IOError:
+            pass
+        except (ValueError, KeyError, AttributeError):
+            sys.stderr.write("WARNING: cache [%s] is unreadable; ignoring it.\n" % path)
+
+    # returns what was parsed from 'path' last time, or None if it's changed since (or
+    # wasn't cached). the file is stat()ed before it's read, so if it changes while
+    # it's being parsed, it's just parsed again next run.
+    def get(self, path):
+        state = fileState(path)
+        entry = self.files.get(path)
+        if state is not None and entry is not None and entry['state'] == state:
+            self.seen[path] = entry
+            self.hits = self.hits + 1
+            return entry['data']
+        self.seen[path] = {'state': state}
+        return None
+
+    # caches what was parsed from 'path', after a get() of it missed
+    def put(self, path, data):
+        self.seen[path]['data'] = data
+        self.parsed = self.parsed + 1
+
+    # saves this run's files & results, replacing the cache file atomically. files
+    # which weren't read this run are dropped.
+    def save(self, results):
+        files = {}
+        for (path, entry) in self.seen.items():
+            if 'data' in entry:
+                files[path] = entry
+        tmpName = self.path + '.tmp'
+        f = os.fdopen(os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w')
+        # json.dumps() encodes in C, where json.dump() to a file doesn't
+        f.write(json.dumps({'version': self.version, 'files': files, 'results': results}))
+        f.close()
+        os.rename(tmpName, self.path)
+
+
+# returns parse(path), or what it returned last time if the file hasn't changed since
+def cachedParse(cache, path, parse):
+    if cache is None:
+        return parse(path)
+    data = cache.get(path)
+    if data is None:
+        data = parse(path)
+        cache.put(path, data)
+    return data
+
+
+# yields [name, uid, gid, home, shell] for each passwd line
+def passwdEntries(lines):
+    for line in lines:
+        splitData = line.split(":")
+        if len(splitData) >= 7:
+            yield [splitData[0], splitData[2], splitData[3], splitData[5], splitData[6].strip()]
+
+
+# yields [name, gid, [members]] for each group line
+def groupEntries(lines):
+    for line in lines:
+        splitData = line.strip().split(":")
+        if len(splitData) >= 4:
+            yield [splitData[0], splitData[2], [m for m in splitData[3].split(',') if m != '']]
+
+
+# yields (user, 'blank' or 'valid') for each shadow line with a blank or usable
+# password (the hashes themselves aren't kept)
+def shadowEntries(lines):
+    nonPasswords = re.compile(r'^[\!\*]+.*')
+    for line in lines:
+        splitData = line.split(":")
+        if len(splitData) < 2:
+            continue
+        m = nonPasswords.match(splitData[1])
+        if not m:
+            if splitData[1] == '': yield (splitData[0], 'blank')
+            else: yield (splitData[0], 'valid')
+
+
+# reads /etc/passwd, as a list of [name, uid, gid, home, shell]
+def parsePasswd(path):
+    f = open(path, 'r')
+    try:
+        return list(passwdEntries(f))
+    finally:
+        f.close()
+
+
+# reads /etc/group, as a list of [name, gid, [members]]
+def parseGroup(path):
+    f = open(path, 'r')
+    try:
+        return list(groupEntries(f))
+    finally:
+        f.close()
+
+
+# reads /etc/shadow, as a dict of user -> 'blank' or 'valid' for each user who has a
+# blank or usable password
+def parseShadow(path):
+    f = open(path, 'r')
+    try:
+        return dict(shadowEntries(f))
+    finally:
+        f.close()
+
+
+# runs 'getent <database>' (i.e. passwd, group or shadow, from every NSS source, like
+# sssd/LDAP), yielding its output a line at a time as it's read. raises OSError if
+# getent can't be run, or fails.
+def getentLines(database):
+    proc = subprocess.Popen(['getent', database], stdout=subprocess.PIPE, bufsize=-1, close_fds=True)
+    try:
+        line = proc.stdout.readline()
+        while line != '':
+            yield line
+            line = proc.stdout.readline()
+    finally:
+        proc.stdout.close()
+        # 3 is that the database can't be enumerated
+        if proc.wait() not in (0, 3):
+            raise OSError("getent %s failed, with exit status %d" % (database, proc.returncode))
+
+
+# reads one sshd_config file (not what it includes) into a list of [keyword, args],
+# split the way sshd does: 'Keyword args' or 'Keyword=args', with keywords in any case,
+# args optionally quoted, and everything from an unquoted '#' on ignored. keywords are
+# lowercased.
+def tokenizeSshdConfig(path):
+    keywordRegex = re.compile(r'^([^\s=]+)\s*=?\s*(.*)$')
+    directives = []
+    f = open(path, 'r')
+    for line in f:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        (keyword, rest) = keywordRegex.match(line).groups()
+        if '"' in rest or "'" in rest or '\\' in rest:
+            try:
+                args = shlex.split(rest, True)
+            except ValueError:
+                # unbalanced quotes; sshd wouldn't start with this config either
+                args = rest.split()
+        else:
+            args = rest.split()
+            for i in range(len(args)):
+                if args[i].startswith('#'):
+                    args = args[:i]
+                    break
+        directives.append([keyword.lower(), args])
+    f.close()
+    return directives
+
+
+# compiles an sshd pattern ('*' & '?' wildcards) into a regex
+def compilePattern(pattern, ignoreCase=False):
+    regex = '^' + re.escape(pattern).replace('\\*', '.*').replace('\\?', '.') + '$'
+    if ignoreCase:
+        return re.compile(regex, re.IGNORECASE)
+    return re.compile(regex)
+
+
+# compiles an sshd pattern list ('web*,!web9,db?') into a list of (negated, regex,
+# pattern), for matchPatternList()
+def compilePatternList(patterns, ignoreCase=False):
+    compiled = []
+    for pattern in patterns.split(','):
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        compiled.append((negated, compilePattern(pattern, ignoreCase), pattern))
+    return compiled
+
+
+# true if 'address' is in the network 'cidr' (i.e. 10.0.0.0/8, or an IPv6 one)
+def addressInNetwork(address, cidr):
+    (network, bits) = cidr.split('/', 1)
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            (a, n) = (socket.inet_pton(family, address), socket.inet_pton(family, network))
+        except (socket.error, ValueError):
+            continue
+        size = len(a) * 8
+        try:
+            mask = ((1 << size) - 1) ^ ((1 << (size - int(bits))) - 1)
+        except ValueError:
+            return False
+        return (long(binascii.hexlify(a), 16) & mask) == (long(binascii.hexlify(n), 16) & mask)
+    return False
+
+
+# matches names against a compiled pattern list, like sshd does: false if any name
+# matches a negated pattern, otherwise true if any matches another. address patterns
+# may also be networks.
+def matchPatternList(names, compiled, isAddress=False):
+    found = False
+    for name in names:
+        for (negated, regex, pattern) in compiled:
+            if regex.match(name) or (isAddress and '/' in pattern and addressInNetwork(name, pattern)):
+                if negated:
+                    return False
+                found = True
+    return found
+
+
+# The settings sshd uses for a connection, as merged by SshdConfig. settings which
+# aren't set are sshd's defaults. 'accessLists' is shared by all the SshdSettings
+# of a config, so an Allow/Deny list they have in common is only compiled once.
+class SshdSettings:
+    def __init__(self, values, accessLists=None):
+        self.values = values
+        if accessLists is None:
+            accessLists = {}
+        self.access_lists = accessLists
+        # the compiled Allow/Deny lists, the flags & the AuthorizedKeysFile templates,
+        # once they're needed
+        self.access = None
+        self.login_flags = None
+        self.key_files = None
+
+    def get(self, keyword):
+        return self.values.get(keyword, sshdDefaults.get(keyword, []))
+
+    def isYes(self, keyword):
+        args = self.get(keyword)
+        return len(args) > 0 and args[0].lower() in ('yes', 'true')
+
+    # the login flags these settings give any user they apply to (root's, and whether
+    # the user's allowed, are up to the caller)
+    def loginFlags(self):
+        if self.login_flags is None:
+            self.login_flags = 0x0000
+            if self.isYes('permitemptypasswords'):
+                self.login_flags = self.login_flags | SSH_EMPTY_PASSWD_ENABLED
+            if self.isYes('pubkeyauthentication'):
+                self.login_flags = self.login_flags | SSH_PUBKEY_ENABLED
+        return self.login_flags
+
+    # the user's authorized keys files, with %h, %u, %U & %% expanded, relative to
+    # their home directory. each path is turned into a format string once, as a tuple
+    # of (format string, or the path if it has no tokens, and whether it has tokens).
+    def authorizedKeysFiles(self, user):
+        if self.key_files is None:
+            self.key_files = []
+            tokens = {'%%': '%%', '%h': '%(h)s', '%u': '%(u)s', '%U': '%(U)s'}
+            for path in self.get('authorizedkeysfile'):
+                if path.lower() == 'none':
+                    continue
+                parts = re.split(r'(%[%hUu])', path)
+                if len(parts) == 1:
+                    self.key_files.append((path, False))
+                    continue
+                for i in range(len(parts)):
+                    parts[i] = tokens.get(parts[i], parts[i].replace('%', '%%'))
+                self.key_files.append((''.join(parts), True))
+
+        files = []
+        for (path, hasTokens) in self.key_files:
+            if hasTokens:
+                path = path % {'h': user.home, 'u': user.name, 'U': user.uid}
+            if not path.startswith('/'):
+                path = user.home + '/' + path
+            files.append(path)
+        return files
+
+    # compiles an Allow/Deny list into a tuple of (set of plain names, list of (name
+    # regex, host pattern list or None)), so plain names are a single lookup
+    def _compileAccessList(self, entries):
+        names = set()
+        patterns = []
+        for entry in entries:
+            (name, host) = (entry, None)
+            if '@' in entry:
+                (name, host) = entry.split('@', 1)
+                host = compilePatternList(host, True)
+            if host is None and '*' not in name and '?' not in name:
+                names.add(name)
+            else:
+                patterns.append((compilePattern(name), host))
+        return (names, patterns)
+
+    # true if any of 'names' is in a compiled Allow/Deny list. a 'user@host' entry
+    # matches if 'source' (an (address, hostname) tuple) does; with no source, the
+    # audit is asking whether the user can log in from anywhere, so it only matches
+    # in an Allow list.
+    def _inAccessList(self, names, accessList, source, isAllow):
+        (plainNames, patterns) = accessList
+        for name in names:
+            if name in plainNames:
+                return True
+            for (regex, host) in patterns:
+                if not regex.match(name):
+                    continue
+                if host is None:
+                    return True
+                if source is None:
+                    if isAllow:
+                        return True
+                    continue
+                (address, hostname) = source
+                if (hostname is not None and matchPatternList([hostname.lower()], host)) or \
+                        (address is not None and matchPatternList([address], host, True)):
+                    return True
+        return False
+
+    # true if DenyUsers, AllowUsers, DenyGroups & AllowGroups let the user in, checked
+    # in that order like sshd does
+    def allows(self, user, groups, source=None):
+        if self.access is None:
+            self.access = {}
+            for keyword in ('denyusers', 'allowusers', 'denygroups', 'allowgroups'):
+                if keyword in self.values:
+                    entries = self.values[keyword]
+                    # keyed by the list itself, which is kept to keep the id unique
+                    if id(entries) not in self.access_lists:
+                        self.access_lists[id(entries)] = (entries, self._compileAccessList(entries))
+                    self.access[keyword] = self.access_lists[id(entries)][1]
+        if 'denyusers' in self.access and self._inAccessList([user], self.access['denyusers'], source, False):
+            return False
+        if 'allowusers' in self.access and not self._inAccessList([user], self.access['allowusers'], source, True):
+            return False
+        if 'denygroups' in self.access and self._inAccessList(groups, self.access['denygroups'], None, False):
+            return False
+        if 'allowgroups' in self.access and not self._inAccessList(groups, self.access['allowgroups'], None, True):
+            return False
+        return True
+
+
+# Reads sshd_config the way sshd does, to work out the settings for each user's
+# connections. the global settings (where the first value given for a keyword wins,
+# apart from the Allow/Deny lists, which add up) are overridden by those of every
+# Match block a connection matches (where the first matching block to set a keyword
+# wins). Includes are resolved once, as the config is loaded, and each file is only
+# tokenized once (or not at all, if it's unchanged in the AuditCache).
+#
+# the settings for each distinct set of matching blocks are merged once, however many
+# users share them, and blocks which can only match listed users are indexed by user,
+# so thousands of users against thousands of 'Match User' blocks stays linear.
+class SshdConfig:
+    list_keywords = set(['allowusers', 'denyusers', 'allowgroups', 'denygroups'])
+    max_include_depth = 16
+
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.cache = cache
+        self.settings = {}
+        # each Match block, as (criteria, settings)
+        self.blocks = []
+        # the blocks which can only match certain users, by user, and all the others
+        self.blocks_by_user = {}
+        self.other_blocks = []
+        # SshdSettings, by the tuple of blocks they were merged from, and the Allow/Deny
+        # lists they've compiled
+        self.merged = {}
+        self.access_lists = {}
+
+        self._load(path, None, 0)
+        for i in range(len(self.blocks)):
+            users = self._listedUsers(self.blocks[i][0])
+            if users is None:
+                self.other_blocks.append(i)
+            else:
+                for user in users:
+                    self.blocks_by_user.setdefault(user, []).append(i)
+
+    # adds a directive to a settings dictionary
+    def _set(self, settings, keyword, args):
+        if keyword in self.list_keywords:
+            settings.setdefault(keyword, []).extend(args)
+        elif keyword not in settings:
+            settings[keyword] = args
+
+    # reads a config file's directives into the global settings, or those of the Match
+    # block 'block'. a Match block in an included file ends with that file.
+    def _load(self, path, block, depth):
+        for (keyword, args) in cachedParse(self.cache, path, tokenizeSshdConfig):
+            if keyword == 'include':
+                if depth >= self.max_include_depth:
+                    raise ValueError("Includes nested more than %d deep at [%s]" % (self.max_include_depth, path))
+                for pattern in args:
+                    if not pattern.startswith('/'):
+                        pattern = os.path.join(os.path.dirname(self.path), pattern)
+                    for includePath in sorted(glob.glob(pattern)):
+                        try:
+                            self._load(includePath, block, depth + 1)
+                        except IOError:
+                            sys.stderr.write("WARNING: file [%s] included by [%s] could not be opened! Results may not be accurate!\n"
+                                             % (includePath, path))
+            elif keyword == 'match':
+                block = len(self.blocks)
+                self.blocks.append((self._parseCriteria(args, path), {}))
+            elif block is None:
+                self._set(self.settings, keyword, args)
+            else:
+                self._set(self.blocks[block][1], keyword, args)
+
+    # parses a Match line's criteria into a list of (criterion, compiled pattern list)
+    def _parseCriteria(self, args, path):
+        criteria = []
+        i = 0
+        while i < len(args):
+            criterion = args[i].lower()
+            if criterion == 'all':
+                i = i + 1
+                continue
+            if i + 1 >= len(args):
+                raise ValueError("'Match %s' in [%s] has no patterns" % (args[i], path))
+            criteria.append((criterion, compilePatternList(args[i + 1], criterion == 'host')))
+            i = i + 2
+        return criteria
+
+    # the users a block's criteria can match, if it has a 'User' criterion of just
+    # plain names, otherwise None
+    def _listedUsers(self, criteria):
+        for (criterion, compiled) in criteria:
+            if criterion == 'user':
+                users = []
+                for (negated, regex, pattern) in compiled:
+                    if negated or '*' in pattern or '?' in pattern:
+                        return None
+                    users.append(pattern)
+                return users
+        return None
+
+    # true if a connection by 'user' from 'source' (an (address, hostname) tuple, or
+    # None) matches a block's criteria. the audit doesn't know the local address, port
+    # or routing domain a connection would use, so those criteria never match.
+    def _matches(self, criteria, user, groups, source):
+        (address, hostname) = source or (None, None)
+        for (criterion, compiled) in criteria:
+            if criterion == 'user':
+                matched = matchPatternList([user], compiled)
+            elif criterion == 'group':
+                matched = matchPatternList(groups, compiled)
+            elif criterion == 'host':
+                matched = hostname is not None and matchPatternList([hostname.lower()], compiled)
+            elif criterion == 'address':
+                matched = address is not None and matchPatternList([address], compiled, True)
+            else:
+                matched = False
+            if not matched:
+                return False
+        return True
+
+    # the SshdSettings for a connection by 'user' (in 'groups') from 'source'
+    def effective(self, user, groups, source=None):
+        candidates = self.blocks_by_user.get(user, [])
+        if len(self.other_blocks) > 0:
+            candidates = sorted(candidates + self.other_blocks)
+        matched = tuple([i for i in candidates if self._matches(self.blocks[i][0], user, groups, source)])
+
+        settings = self.merged.get(matched)
+        if settings is None:
+            values = {}
+            for i in matched:
+                for (keyword, args) in self.blocks[i][1].items():
+                    self._set(values, keyword, args)
+            for (keyword, args) in self.settings.items():
+                if keyword not in values:
+                    values[keyword] = args
+            settings = SshdSettings(values, self.access_lists)
+            self.merged[matched] = settings
+        return settings
+
+
 # the local host we're running on
 class Host:
     # constructor
@@ -70,160 +781,778 @@ class Host:
         pass
 
 
-    # parses specific values from sshd_config, to see if users can login
-    def getSshdConfig(self, usersList, localSystem):
-        allowusers_line_found = False
-        configLinesRegex = {}
-        configLinesRegex['AllowUsers'] = re.compile(r'^AllowUsers\s(?P<users>.*)$')
-        configLinesRegex['PermitRootLogin'] = re.compile(r'^PermitRootLogin\s(?P<root>.*)$')
-        configLinesRegex['PermitEmptyPasswords'] = re.compile(r'^PermitEmptyPasswords\s(?P<empty>.*)$')
-        configLinesRegex['PubkeyAuthentication'] = re.compile(r'^PubkeyAuthentication\s(?P<pubkey>.*)$')
-    
+    # works out each user's sshd settings from sshd_config, to see if users can login.
+    # 'source' is an (address, hostname) tuple (either may be None) for Match
+    # Address/Host blocks & 'user@host' Allow/Deny entries; without one, it's whether
+    # users can login from anywhere not singled out by a Match block.
+    def getSshdConfig(self, usersList, localSystem, cache=None, source=None):
         try:
-            fSsh = open("/etc/ssh/sshd_config", 'r')
-        except:
+            config = SshdConfig("/etc/ssh/sshd_config", cache)
+        except IOError:
             sys.stderr.write("WARNING: file [/etc/ssh/sshd_config] doesn't exist or could not be opened! Results may not be accurate!\n")
             return 1
+        except ValueError, e:
+            sys.stderr.write("WARNING: %s! Results may not be accurate!\n" % e)
+            return 1
     
-        # get SSH config lines
-        sshdData = fSsh.readlines()
-        for line in sshdData:
-            for regexName in sorted(configLinesRegex.keys()):
-                m = configLinesRegex[regexName].match(line)
-    
-                # if user is one of the AllowUsers
-                if m and regexName == 'AllowUsers':
-                    allowusers_line_found = True
-                    tmpUsers = m.group('users').split()
-                    for user in tmpUsers:
-                        try:
-                            # handle 'user@host' form
-                            (u, h) = user.split("@")
-                            if usersList.has_key(u):
-                                usersList[u].login_flags = usersList[u].login_flags | SSH_ALLOWED_USER
-                        except:
-                            if usersList.has_key(user):
-                                usersList[user].login_flags = usersList[user].login_flags | SSH_ALLOWED_USER
-   
-                # if root login permitted, toggle login flag
-                elif m and regexName == 'PermitRootLogin':
-                    if usersList.has_key('root'):
-                        usersList['root'].login_flags = usersList['root'].login_flags | SSH_ROOT_LOGIN_ENABLED
-                        if m.group('root').lower().strip() == 'yes' or m.group('root').lower().strip() == 'true':
-                            usersList['root'].login_flags = usersList['root'].login_flags | SSH_ALLOWED_USER
-
-                # if empty passwords enabled, toggle flag for all users 
-                elif m and regexName == 'PermitEmptyPasswords':
-                    if m.group('empty').lower().strip() == 'yes' or m.group('empty').lower().strip() == 'true':
-                        for u in usersList:
-                            usersList[u].login_flags = usersList[u].login_flags | SSH_EMPTY_PASSWD_ENABLED
-                 
-                # if SSH public key auth is permitted
-                elif m and regexName == 'PubkeyAuthentication':
-                    if m.group('pubkey').lower().strip() == 'yes' or m.group('pubkey').lower().strip() == 'true':
-                        for u in usersList:
-                            usersList[u].login_flags = usersList[u].login_flags | SSH_PUBKEY_ENABLED
-        fSsh.close()
-
-        ## no AllowUsers line found in config, so all are allowed
-        if not allowusers_line_found:
-            for u in usersList:
-                usersList[u].login_flags = usersList[u].login_flags | SSH_ALLOWED_USER
+        for name in usersList:
+            user = usersList[name]
+            settings = config.effective(name, user.groups, source)
+
+            # if root login permitted, in any form, toggle login flag
+            if name == 'root' and settings.get('permitrootlogin')[:1] != ['no']:
+                user.login_flags = user.login_flags | SSH_ROOT_LOGIN_ENABLED
+
+            # if empty passwords or SSH public key auth are permitted
+            user.login_flags = user.login_flags | settings.loginFlags()
+
+            # if the Allow/Deny lists let the user in
+            if settings.allows(name, user.groups, source):
+                user.login_flags = user.login_flags | SSH_ALLOWED_USER
+
+            user.authorized_keys_files = settings.authorizedKeysFiles(user)
  
 
-    # looks for users with valid shells/passwords, checks for SSH login ability, 
-    # and populates the database info for the users.
-    def getUserData(self, usersList):
-        f = open("/etc/passwd", 'r')
-        fs = open("/etc/shadow", 'r')
+    # looks for users with valid shells/passwords, and populates the database info for
+    # the users, with their groups. 'userDb' is where from: 'files' reads /etc/passwd,
+    # /etc/group & /etc/shadow (through the cache), 'getent' streams them from NSS,
+    # directory users & all.
+    #
+    # groups & passwords are read first, so each user's record is built, flags and
+    # all, in the one pass over the passwd entries, and nothing else is kept per user.
+    def getUserData(self, usersList, cache=None, userDb='files'):
         nonShells = re.compile(r'^[\S\/]+(false|nologin|sync)$')
-        nonPasswords = re.compile(r'^[\!\*]+.*')
-        
-        # get users with valid shells
-        passwdData = f.readlines()
-        for line in passwdData: 
-            splitData = line.split(":")
-    
-            usersList[splitData[0]] = LocalUser(splitData[0], "", splitData[5], splitData[6].strip())
-            
-            m = nonShells.match(splitData[6])
-            if not m:
-                usersList[splitData[0]].login_flags = usersList[splitData[0]].login_flags | USER_SHELL_VALID 
-        
+
+        if userDb == 'getent':
+            sources = {'group': "getent group", 'shadow': "getent shadow", 'passwd': "getent passwd"}
+            groups = groupEntries(getentLines('group'))
+            shadow = lambda: dict(shadowEntries(getentLines('shadow')))
+            passwd = passwdEntries(getentLines('passwd'))
+        else:
+            sources = {'group': "/etc/group", 'shadow': "/etc/shadow", 'passwd': "/etc/passwd"}
+            groups = None
+            shadow = lambda: cachedParse(cache, "/etc/shadow", parseShadow)
+            passwd = None
+
+        # get each group's name, and the groups each user is a member of
+        groupNames = {}
+        memberships = {}
+        try:
+            if groups is None:
+                groups = cachedParse(cache, "/etc/group", parseGroup)
+            for (group, gid, members) in groups:
+                groupNames.setdefault(gid, group)
+                for member in members:
+                    memberships.setdefault(member, []).append(group)
+        except (IOError, OSError):
+            sys.stderr.write("WARNING: [%s] could not be read! Results may not be accurate!\n" % sources['group'])
+
         # get users with valid passwords
-        shadowData = fs.readlines()
-        for line in shadowData: 
-            splitData = line.split(":")
-            m = nonPasswords.match(splitData[1])
-            if not m:
-                if usersList.has_key(splitData[0]):
-                    usersList[splitData[0]].password = splitData[1]
-                    if splitData[1] == '': usersList[splitData[0]].login_flags = usersList[splitData[0]].login_flags | USER_PASSWD_BLANK
-                    else: usersList[splitData[0]].login_flags = usersList[splitData[0]].login_flags | USER_PASSWD_VALID
-        f.close()
-        fs.close()
+        try:
+            passwords = shadow()
+        except (IOError, OSError):
+            sys.stderr.write("WARNING: [%s] could not be read! Results may not be accurate!\n" % sources['shadow'])
+            passwords = {}
+        passwordFlags = {'blank': USER_PASSWD_BLANK, 'valid': USER_PASSWD_VALID}
+
+        # most users share a handful of shells & sets of groups, so each is only
+        # checked (or stored) once
+        shells = {}
+        groupSets = {}
+        try:
+            if passwd is None:
+                passwd = cachedParse(cache, "/etc/passwd", parsePasswd)
+            for (name, uid, gid, home, shell) in passwd:
+                known = shells.get(shell)
+                if known is None:
+                    flags = 0x0000
+                    if not nonShells.match(shell):
+                        flags = USER_SHELL_VALID
+                    known = (shell, flags)
+                    shells[shell] = known
+                (shell, flags) = known
+                flags = flags | passwordFlags.get(passwords.get(name), 0x0000)
+
+                userGroups = []
+                if gid in groupNames:
+                    userGroups.append(groupNames[gid])
+                for group in memberships.get(name, ()):
+                    if group not in userGroups:
+                        userGroups.append(group)
+                userGroups = tuple(userGroups)
+                userGroups = groupSets.setdefault(userGroups, userGroups)
+
+                usersList[name] = LocalUser(name, "", home, shell, uid, userGroups, flags)
+        except (IOError, OSError), e:
+            sys.stderr.write("ERROR: [%s] could not be read: %s\n" % (sources['passwd'], e))
+            sys.exit(1)
         
     
-    # looks for users' SSH keys, and checks authorized_keys entries
-    # TODO: handle AuthorizedKeysFile line in config
-    def getSshAuthorizedKeys(self, usersList):
-        authKeysPaths = []    
+    # looks for users' SSH keys, and checks authorized_keys entries. keys are
+    # fingerprinted in-process, apart from any parseKey() doesn't know, which are
+    # fingerprinted by one ssh-keygen run at the end.
+    def getSshAuthorizedKeys(self, usersList, hashName='sha256', cache=None):
         commentReg = re.compile("^[\S]{0,}#+")
+        # the same keys tend to be in many users' files, so each is only parsed once
+        parsedKeys = {}
+        # keys for ssh-keygen
+        otherKeys = []
+        # the files read this run, as (user, path, entries), where each entry is an
+        # AuthorizedKey or the index of a key in otherKeys
+        readFiles = []
     
         for user in usersList.keys():
-            authKeysPaths.append(usersList[user].home + "/.ssh/authorized_keys")
-            authKeysPaths.append(usersList[user].home + "/.ssh/authorized_keys2")
-            for path in authKeysPaths:
+            paths = usersList[user].authorized_keys_files
+            if paths is None:
+                # sshd_config couldn't be read, so assume sshd's defaults
+                paths = SshdSettings({}).authorizedKeysFiles(usersList[user])
+            for path in paths:
+                if cache is not None:
+                    cached = cache.get(path)
+                    if cached is not None:
+                        for (keyType, bits, comment, md5, sha256) in cached:
+                            usersList[user].addAuthorizedKey(AuthorizedKey(keyType, bits, comment, md5, sha256))
+                        continue
                 try:
                     f = open(path, 'r')
-            
-                    keys = f.readlines(512)
-                    for key in keys:
-                        # ignore comment lines
-                        match = commentReg.match(key)
-                        if match:
-                            continue
-                        tmpFile = tempfile.NamedTemporaryFile()
-                        tmpFile.write(key)
-                        tmpFile.flush()
-                        tmpCommand = "ssh-keygen -l -f %s" % tmpFile.name
-                        (status, fingerprint) = commands.getstatusoutput(tmpCommand)
-                        if status == 0:
-                            usersList[user].ssh_authorized_keys.append(fingerprint)
-                            usersList[user].login_flags = usersList[user].login_flags | USER_SSH_PUBKEY_EXISTS
-                        tmpFile.close()
-            
+                    keys = f.readlines()
                     f.close()
                 except IOError:
-                    pass
-                authKeysPaths = []
+                    continue
+
+                entries = []
+                readFiles.append((user, path, entries))
+                for line in keys:
+                    # ignore comment lines
+                    match = commentReg.match(line)
+                    if match:
+                        continue
+                    fields = splitAuthorizedKey(line)
+                    if fields is None:
+                        continue
+                    (keyType, encoded, comment) = fields
+                    try:
+                        parsed = parsedKeys.get(encoded)
+                        if parsed is None:
+                            parsed = parseKey(keyType, encoded, comment)
+                            parsedKeys[encoded] = parsed
+                    except ValueError:
+                        # ssh-keygen wouldn't accept it either
+                        continue
+                    if parsed is None:
+                        entries.append(len(otherKeys))
+                        otherKeys.append(fields)
+                        continue
+                    entries.append(AuthorizedKey(parsed.key_type, parsed.bits, comment, parsed.md5, parsed.sha256))
+
+        fingerprinted = {}
+        if len(otherKeys) > 0:
+            fingerprinted = fingerprintWithSshKeygen(otherKeys, hashName)
+        for (user, path, entries) in readFiles:
+            keys = []
+            for entry in entries:
+                if isinstance(entry, int):
+                    # ssh-keygen couldn't read it either
+                    if entry not in fingerprinted:
+                        continue
+                    entry = fingerprinted[entry]
+                keys.append(entry)
+                usersList[user].addAuthorizedKey(entry)
+            if cache is not None:
+                cache.put(path, [[key.key_type, key.bits, key.comment, key.md5, key.sha256] for key in keys])
+
+
+
+# Audits many hosts at once, by running this script on each of them with --json,
+# 'jobs' hosts at a time. 'command' is the command to run the script on a host with
+# (i.e. an ssh command line), as a list with '%(host)s' in place of the host; the
+# script is piped to its stdin, and the script's arguments are added to the end (so
+# they have to be quoted already, if the command runs them through a shell).
+class Fleet:
+    def __init__(self, command, scriptArgs, jobs=50, timeout=120):
+        self.command = command
+        self.script = open(os.path.abspath(__file__), 'r').read()
+        self.script_args = scriptArgs
+        self.jobs = jobs
+        self.timeout = timeout
+
+    # audits a single host, returning its results as a dict. errors are returned in
+    # the results too, so one bad host doesn't stop the rest.
+    def auditHost(self, host):
+        startTime = time.time()
+        result = {'host': host}
+        command = [arg % {'host': host} for arg in self.command] + self.script_args
+        try:
+            # in its own process group, so anything it starts is killed with it
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        except OSError, e:
+            result['error'] = "unable to run %s: %s" % (command[0], e.strerror)
+            result['seconds'] = time.time() - startTime
+            return result
+
+        # kills the audit if it's still running after the timeout
+        killed = []
+        timer = threading.Timer(self.timeout, self._kill, (proc, killed))
+        timer.start()
+        (output, errors) = proc.communicate(self.script)
+        timer.cancel()
+        timer.join()
+
+        if len(killed) > 0:
+            result['error'] = "no response within %ds" % self.timeout
+        elif proc.returncode != 0:
+            errors = errors.strip().splitlines()
+            if len(errors) > 0:
+                result['error'] = errors[-1]
+            else:
+                result['error'] = "exited with status %d" % proc.returncode
+        else:
+            try:
+                result.update(json.loads(output))
+            except ValueError:
+                result['error'] = "unreadable results: %s" % repr(output[:80])
+        result['seconds'] = time.time() - startTime
+        return result
+
+    def _kill(self, proc, killed):
+        killed.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    # audits hosts from the queue until it gets a None
+    def _worker(self, hostQueue, resultQueue):
+        while True:
+            host = hostQueue.get()
+            if host is None:
+                return
+            resultQueue.put(self.auditHost(host))
+
+    # audits every host in 'hosts', yielding each host's results as it finishes
+    def audit(self, hosts):
+        hostQueue = Queue.Queue()
+        resultQueue = Queue.Queue()
+        threads = []
+        for host in hosts:
+            hostQueue.put(host)
+        for i in range(max(1, min(self.jobs, len(hosts)))):
+            hostQueue.put(None)
+            t = threading.Thread(target=self._worker, args=(hostQueue, resultQueue))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for i in range(len(hosts)):
+            yield resultQueue.get()
+        for t in threads:
+            t.join()
+
+
+# reads a host inventory: one host per line, ignoring blank lines & '#' comments, and
+# anything on a line after the host name
+def readInventory(path):
+    if path == '-':
+        f = sys.stdin
+    else:
+        f = open(path, 'r')
+    hosts = []
+    for line in f:
+        fields = line.split('#', 1)[0].split()
+        if len(fields) > 0 and fields[0] not in hosts:
+            hosts.append(fields[0])
+    f.close()
+    return hosts
+
+
+# audits the local host, re-using what's in 'cache' (an AuditCache) for any files which
+# haven't changed. returns a dictionary of its LocalUsers, by name
+def auditLocalHost(hashName, cache=None, source=None, userDb='files'):
+    if os.geteuid() != 0:
+        sys.stderr.write("ERROR: you must run this script as root!\n")
+        sys.exit(1)
+
+    # holds all the info about discovered users
+    usersList = {}
+    localSystem = Host('localhost')
+
+    localSystem.getUserData(usersList, cache, userDb)
+    localSystem.getSshdConfig(usersList, localSystem, cache, source)
+    localSystem.getSshAuthorizedKeys(usersList, hashName, cache)
+    return usersList
 
 
+# the names of the flags set in 'loginFlags'
+def decodeLoginFlags(loginFlags):
+    return [name for (flag, name) in loginFlagNames if loginFlags & flag]
+
+
+# a user's result record: a dict of resultFields, with canLogin() worked out once, the
+# flags decoded, and their keys' fingerprints
+def userResult(host, user, hashName):
+    return {'host': host, 'name': user.name, 'can_login': user.canLogin(), 'login_flags': user.login_flags,
+            'flags': decodeLoginFlags(user.login_flags),
+            'keys': [key.fingerprint(hashName) for key in user.ssh_authorized_keys]}
+
+
+# the local host's users' result records, sorted by name
+def auditResults(usersList, hashName, host=None):
+    return [userResult(host, usersList[user], hashName) for user in sorted(usersList.keys())]
+
+
+# compares one user's old & new result records (either may be None, if the user was
+# added or removed), returning a change record (a dict of changeFields) for each
+# difference: a user 'added' or 'removed', who 'can_login' or 'cannot_login' now,
+# whose 'login_flags' changed otherwise, or with a 'key_added' or 'key_removed'.
+def compareRecords(old, new, compareKeys=True):
+    if new is None:
+        return [{'host': old.get('host'), 'name': old['name'], 'change': 'removed', 'old': old['can_login'], 'new': None}]
+
+    changes = []
+    (host, name) = (new.get('host'), new['name'])
+    if old is None:
+        changes.append({'host': host, 'name': name, 'change': 'added', 'old': None, 'new': new['can_login']})
+        old = {'can_login': new['can_login'], 'login_flags': new['login_flags'], 'keys': []}
+    if old['can_login'] != new['can_login']:
+        change = 'cannot_login'
+        if new['can_login']:
+            change = 'can_login'
+        changes.append({'host': host, 'name': name, 'change': change, 'old': old['login_flags'], 'new': new['login_flags']})
+    elif old['login_flags'] != new['login_flags']:
+        changes.append({'host': host, 'name': name, 'change': 'login_flags', 'old': old['login_flags'], 'new': new['login_flags']})
+    if compareKeys and old['keys'] != new['keys']:
+        (oldKeys, newKeys) = (set(old['keys']), set(new['keys']))
+        for key in new['keys']:
+            if key not in oldKeys:
+                changes.append({'host': host, 'name': name, 'change': 'key_added', 'old': None, 'new': key})
+        for key in old['keys']:
+            if key not in newKeys:
+                changes.append({'host': host, 'name': name, 'change': 'key_removed', 'old': key, 'new': None})
+    return changes
+
+
+# compares two lists of result records, each sorted by host & name (or just by name,
+# if not 'byHost'), by merging them in a single pass. returns a list of change records.
+def diffRecords(old, new, compareKeys=True, byHost=True):
+    if byHost:
+        oldOrder = [(r.get('host'), r['name']) for r in old]
+        newOrder = [(r.get('host'), r['name']) for r in new]
+    else:
+        oldOrder = [r['name'] for r in old]
+        newOrder = [r['name'] for r in new]
+
+    changes = []
+    (i, j) = (0, 0)
+    while i < len(old) or j < len(new):
+        if j >= len(new) or (i < len(old) and oldOrder[i] < newOrder[j]):
+            changes.extend(compareRecords(old[i], None, compareKeys))
+            i = i + 1
+        elif i >= len(old) or newOrder[j] < oldOrder[i]:
+            changes.extend(compareRecords(None, new[j], compareKeys))
+            j = j + 1
+        else:
+            changes.extend(compareRecords(old[i], new[j], compareKeys))
+            i = i + 1
+            j = j + 1
+    return changes
+
+
+# describes a change record as a line of text
+def describeChange(change):
+    who = change['name']
+    if change.get('host') is not None:
+        who = "%s@%s" % (change['name'], change['host'])
+    if change['change'] == 'added':
+        if change['new']: return "+ [%s] added, and can log in" % who
+        return "+ [%s] added" % who
+    elif change['change'] == 'removed':
+        return "- [%s] removed" % who
+    elif change['change'] == 'can_login':
+        return "+ [%s] can now log in" % who
+    elif change['change'] == 'cannot_login':
+        return "- [%s] can no longer log in" % who
+    elif change['change'] == 'login_flags':
+        return "~ [%s] login flags changed from 0x%04x to 0x%04x" % (who, change['old'], change['new'])
+    elif change['change'] == 'key_added':
+        return "+ [%s] key %s" % (who, change['new'])
+    return "- [%s] key %s" % (who, change['old'])
+
+
+# compares the users from this run with the last run's (an AuditCache's 'previous').
+# returns a list of change records, and a list of notes on what couldn't be compared.
+def diffResults(previous, users, hashName):
+    compareKeys = (previous['fingerprint_hash'] == hashName)
+    changes = diffRecords(previous['users'], users, compareKeys, False)
+    for change in changes:
+        change['host'] = None
+    notes = []
+    if not compareKeys:
+        notes.append("(keys weren't compared, as the last run used %s fingerprints)" % previous['fingerprint_hash'])
+    return (changes, notes)
+
+
+# Reads a file of results (or '-' for stdin) a json line at a time, where each line is
+# either a user's record (-f jsonl) or a host's results (--json, or fleet mode's
+# output). lines are only decoded when asked for their records.
+class ResultLines:
+    def __init__(self, path):
+        self.path = path
+        self.file = sys.stdin
+        if path != '-':
+            self.file = open(path, 'r')
+        self.line_number = 0
+        # the hosts which weren't audited
+        self.failed = set()
+        # the hash the first fingerprinted key read uses (i.e. 'SHA256')
+        self.fingerprint_hash = None
+        self.line = None
+        self.records = None
+        self.next()
+
+    # moves on to the next (non-blank) line; 'line' is None at the end of the file
+    def next(self):
+        self.records = None
+        self.line = self.file.readline()
+        self.line_number = self.line_number + 1
+        while self.line.strip() == '' and self.line != '':
+            self.line = self.file.readline()
+            self.line_number = self.line_number + 1
+        if self.line == '':
+            self.line = None
+            if self.file is not sys.stdin:
+                self.file.close()
+
+    # the current line's user records, decoded
+    def decode(self):
+        if self.records is not None:
+            return self.records
+        try:
+            result = json.loads(self.line)
+        except ValueError, e:
+            raise ValueError("line %d of [%s] isn't json: %s" % (self.line_number, self.path, e))
+        if 'error' in result:
+            self.failed.add(result.get('host'))
+            self.records = []
+        elif 'users' in result:
+            # fleet mode's results are by the host's name in the inventory
+            host = result.get('host', result.get('hostname'))
+            for user in result['users']:
+                user['host'] = host
+            self.records = result['users']
+        else:
+            self.records = [result]
+        if self.fingerprint_hash is None:
+            for record in self.records:
+                if len(record['keys']) > 0:
+                    # an old ssh-keygen's md5 fingerprints have no 'MD5:' prefix
+                    hashName = record['keys'][0].split()[1].split(':')[0]
+                    if hashName not in ('MD5', 'SHA256'):
+                        hashName = 'MD5'
+                    self.fingerprint_hash = hashName
+                    break
+        return self.records
+
+    # where the current line sorts, by its first record's host & name
+    def order(self):
+        records = self.decode()
+        if len(records) == 0:
+            return (None, '')
+        return (records[0].get('host'), records[0]['name'])
+
+
+# compares two result files, writing the changes (sorted by host & name) with
+# 'writer', or as text if it's None. returns the number of changes.
+#
+# results from one run to the next are mostly the same, and in the same order, so the
+# files are merged a line at a time: identical lines are skipped without being
+# decoded, and the records on lines which differ are paired up by host & name. while
+# the files are sorted (as this script writes them) a record that isn't paired
+# straight away has no partner, but in case they're not (i.e. fleet mode's output, in
+# the order hosts finished), unpaired records are kept to be paired later on.
+def diffFiles(oldPath, newPath, writer=None):
+    (old, new) = (ResultLines(oldPath), ResultLines(newPath))
+    # unpaired records, by (host, name), and the changes, as ((host, name), change)
+    (oldPending, newPending) = ({}, {})
+    changes = []
+
+    def pair(records, pending, otherPending, isOld):
+        for record in records:
+            order = (record.get('host'), record['name'])
+            other = otherPending.pop(order, None)
+            if other is None:
+                pending[order] = record
+                continue
+            if isOld:
+                (other, record) = (record, other)
+            for change in compareRecords(other, record):
+                changes.append((order, change))
+
+    while old.line is not None or new.line is not None:
+        if old.line == new.line:
+            old.next()
+            new.next()
+        elif new.line is None or (old.line is not None and old.order() < new.order()):
+            pair(old.decode(), oldPending, newPending, True)
+            old.next()
+        elif old.line is None or new.order() < old.order():
+            pair(new.decode(), newPending, oldPending, False)
+            new.next()
+        else:
+            pair(old.decode(), oldPending, newPending, True)
+            pair(new.decode(), newPending, oldPending, False)
+            old.next()
+            new.next()
+
+    for (order, record) in oldPending.items():
+        changes.extend([(order, change) for change in compareRecords(record, None)])
+    for (order, record) in newPending.items():
+        changes.extend([(order, change) for change in compareRecords(None, record)])
+
+    # users on hosts which couldn't be audited aren't gone (or new), just unknown
+    unaudited = old.failed | new.failed
+    if len(unaudited) > 0:
+        changes = [c for c in changes if c[0][0] not in unaudited]
+    notes = []
+    for host in sorted(unaudited):
+        notes.append("(host [%s] wasn't audited in both, so wasn't compared)" % host)
+    (oldHash, newHash) = (old.fingerprint_hash, new.fingerprint_hash)
+    if oldHash is not None and newHash is not None and oldHash != newHash:
+        changes = [c for c in changes if c[1]['change'] not in ('key_added', 'key_removed')]
+        notes.append("(keys weren't compared, as the results use %s & %s fingerprints)" % (oldHash, newHash))
+
+    # stable, so each user's changes stay in order
+    changes.sort(key=lambda c: c[0])
+    for (order, change) in changes:
+        if writer is None:
+            print describeChange(change)
+        else:
+            writer.write(change)
+    for note in notes:
+        sys.stderr.write(note + "\n")
+    return len(changes)
+
+
+# writes records as json lines ('jsonl'), or 'csv' rows of 'fields' (with lists
+# joined by ';'), a line at a time
+class RecordWriter:
+    def __init__(self, fileObj, outputFormat, fields):
+        self.file = fileObj
+        self.format = outputFormat
+        self.fields = fields
+        self.csv = None
+        if outputFormat == 'csv':
+            self.csv = csv.writer(fileObj)
+            self.csv.writerow(fields)
+
+    def write(self, record):
+        if self.csv is None:
+            self.file.write(json.dumps(record) + "\n")
+            return
+        # csv has nowhere to put errors; they're warned about anyway
+        if 'error' in record:
+            return
+        row = []
+        for field in self.fields:
+            value = record.get(field)
+            if value is None:
+                value = ''
+            elif isinstance(value, bool):
+                value = str(value).lower()
+            elif isinstance(value, list):
+                value = ';'.join(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        self.csv.writerow(row)
+
+
+# audits every host in the inventory, printing each host's results as a json line (or
+# each user's record, with 'writer'), then (to stderr, so stdout stays machine
+# readable) who can log in where. returns the number of hosts which couldn't be
+# audited.
+def auditFleet(fleet, hosts, writer=None):
+    startTime = time.time()
+    failed = 0
+    # who can log in where: user -> hosts
+    access = {}
+    for result in fleet.audit(hosts):
+        if writer is None:
+            print json.dumps(result)
+        elif 'error' in result:
+            writer.write({'host': result['host'], 'error': result['error']})
+        else:
+            for user in result['users']:
+                user['host'] = result['host']
+                writer.write(user)
+        sys.stdout.flush()
+        if 'error' in result:
+            failed = failed + 1
+            sys.stderr.write("WARNING: unable to audit [%s]: %s\n" % (result['host'], result['error']))
+            continue
+        for user in result['users']:
+            if user['can_login']:
+                access.setdefault(user['name'], []).append(result['host'])
+
+    sys.stderr.write("Audited %d of %d hosts in %.1f seconds.\n" % (len(hosts) - failed, len(hosts), time.time() - startTime))
+    sys.stderr.write("Valid Accounts with SSH Privileges, by number of hosts:\n")
+    for user in sorted(access.keys(), key=lambda u: (-len(access[u]), u)):
+        loginHosts = sorted(access[user])
+        if len(loginHosts) > 5:
+            loginHosts = loginHosts[:5] + ['...']
+        sys.stderr.write("\t%-16s %6d  %s\n" % (user, len(access[user]), ', '.join(loginHosts)))
+    return failed
+
 
 #########################
 ###  BEGIN EXECUTION  ###
 #########################
 
-# holds all the info about discovered users
-usersList = {}
-localSystem = Host('localhost')
+parser = OptionParser(description="Audits which local users can log in over SSH, and with which keys.")
+parser.add_option("-E", "--fingerprint-hash", type='choice', dest='fingerprint_hash', choices=['md5', 'sha256'],
+                  default='sha256', help="The hash to print key fingerprints with, md5 or sha256. (default=sha256)")
+parser.add_option("-f", "--format", type='choice', dest='format', choices=['text', 'json', 'jsonl', 'csv'],
+                  default='text', help="Print results as 'text', a 'json' object (per host), 'jsonl' (a json line \
+per user, or per change with diff & --changes-only) or 'csv'. (default=text)")
+parser.add_option("--json", action='store_const', dest='format', const='json',
+                  help="The same as --format json (this is what fleet mode runs on each host).")
+parser.add_option("-i", "--inventory", type='string', dest='inventory', default=None,
+                  help="Audit every host in this file (one per line; '-' for stdin) instead of the local host.")
+parser.add_option("-j", "--jobs", type='int', dest='jobs', default=50,
+                  help="fleet: the number of hosts to audit at once. (default=50)")
+parser.add_option("-t", "--timeout", type='int', dest='timeout', default=120,
+                  help="fleet: seconds to wait for each host's audit. (default=120)")
+parser.add_option("--ssh-command", type='string', dest='ssh_command',
+                  default="ssh -T -o BatchMode=yes -o ConnectTimeout=10 %(host)s sudo python",
+                  help="fleet: the command to run this script on a host with, which is piped to it. \
+(default='%default')")
+parser.add_option("--local", action='store_true', dest='local', default=False,
+                  help="fleet: run each host's audit as a local subprocess instead of over ssh (for testing).")
+parser.add_option("--cache", type='string', dest='cache', default=None,
+                  help="Keep what's parsed from each file in this file between runs, only re-reading what's \
+changed, and report what's changed since the last run.")
+parser.add_option("--source-address", type='string', dest='source_address', default=None,
+                  help="Audit logins from this address, for sshd_config's Match Address blocks & user@host entries.")
+parser.add_option("--source-host", type='string', dest='source_host', default=None,
+                  help="Audit logins from this hostname, for sshd_config's Match Host blocks & user@host entries.")
+parser.add_option("--user-db", type='choice', dest='user_db', choices=['files', 'getent'], default='files',
+                  help="Where to read users, groups & passwords from: 'files' (/etc/passwd, /etc/group & \
+/etc/shadow), or 'getent', for every NSS source (i.e. sssd/LDAP directory users too). (default=files)")
+parser.add_option("--changes-only", action='store_true', dest='changes_only', default=False,
+                  help="With --cache, only print what's changed since the last run (i.e. nothing, if nothing has).")
+(options, args) = parser.parse_args()
+
+if options.inventory is not None:
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    try:
+        hosts = readInventory(options.inventory)
+    except IOError, e:
+        parser.error("unable to read inventory [%s]: %s" % (options.inventory, e.strerror))
+    command = shlex.split(options.ssh_command)
+    if options.local:
+        command = [sys.executable]
+    scriptArgs = ['-', '--json', '-E', options.fingerprint_hash, '--user-db', options.user_db]
+    if options.source_address is not None:
+        scriptArgs.extend(['--source-address', options.source_address])
+    if options.source_host is not None:
+        scriptArgs.extend(['--source-host', options.source_host])
+    # ssh joins its arguments with spaces, and the remote shell splits them again
+    if not options.local:
+        scriptArgs = [pipes.quote(arg) for arg in scriptArgs]
+    fleet = Fleet(command, scriptArgs, options.jobs, options.timeout)
+    writer = None
+    if options.format in ('jsonl', 'csv'):
+        writer = RecordWriter(sys.stdout, options.format, resultFields)
+    if auditFleet(fleet, hosts, writer) > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+if len(args) > 0:
+    if args[0] != 'diff' or len(args) != 3:
+        parser.error("unknown subcommand: %s (the only one is 'diff OLD NEW')" % ' '.join(args))
+    writer = None
+    if options.format in ('jsonl', 'csv'):
+        writer = RecordWriter(sys.stdout, options.format, changeFields)
+    try:
+        count = diffFiles(args[1], args[2], writer)
+    except (IOError, ValueError, KeyError), e:
+        sys.stderr.write("ERROR: unable to compare results: %s\n" % e)
+        sys.exit(2)
+    # like diff(1): 1 if there are differences
+    if count > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+if options.changes_only and options.cache is None:
+    parser.error("--changes-only needs a --cache")
+
+cache = None
+if options.cache is not None:
+    cache = AuditCache(options.cache)
+source = None
+if options.source_address is not None or options.source_host is not None:
+    source = (options.source_address, options.source_host)
+usersList = auditLocalHost(options.fingerprint_hash, cache, source, options.user_db)
 
-localSystem.getUserData(usersList)
-localSystem.getSshdConfig(usersList, localSystem)
-localSystem.getSshAuthorizedKeys(usersList)
+hostname = socket.gethostname()
+users = auditResults(usersList, options.fingerprint_hash, hostname)
+
+changes = None
+notes = []
+if cache is not None:
+    if cache.previous is not None:
+        (changes, notes) = diffResults(cache.previous, users, options.fingerprint_hash)
+    try:
+        cache.save({'time': time.time(), 'fingerprint_hash': options.fingerprint_hash, 'users': users})
+    except (IOError, OSError), e:
+        sys.stderr.write("WARNING: unable to save cache [%s]: %s\n" % (options.cache, e))
+
+if options.format == 'json':
+    results = {'hostname': hostname, 'users': users}
+    if changes is not None:
+        results['changes'] = [describeChange(change) for change in changes] + notes
+    print json.dumps(results)
+    sys.exit(0)
+
+if options.format in ('jsonl', 'csv'):
+    if options.changes_only:
+        writer = RecordWriter(sys.stdout, options.format, changeFields)
+        for change in changes or []:
+            change['host'] = hostname
+            writer.write(change)
+    else:
+        writer = RecordWriter(sys.stdout, options.format, resultFields)
+        for user in users:
+            writer.write(user)
+    sys.exit(0)
+
+if options.changes_only:
+    for line in [describeChange(change) for change in changes or []] + notes:
+        print line
+    sys.exit(0)
 
 # print users who can login
 print "Valid Accounts with SSH Privileges:"
-for user in sorted(usersList.keys()):
-    if usersList[user].canLogin():
-        print "\t" + usersList[user].name 
+for user in users:
+    if user['can_login']:
+        print "\t" + user['name']
 print ""
 
 # print keys for users
-for user in sorted(usersList.keys()):
-    if usersList[user].canLogin() and ((usersList[user].login_flags & USER_SSH_PUBKEY_EXISTS) == USER_SSH_PUBKEY_EXISTS):
-        print "Found SSH authorized_keys for user [%s]..." % user
-        for key in usersList[user].ssh_authorized_keys:
+for user in users:
+    if user['can_login'] and len(user['keys']) > 0:
+        print "Found SSH authorized_keys for user [%s]..." % user['name']
+        for key in user['keys']:
             print "\t" + key
 print "\n"
 
+if cache is not None:
+    if changes is None:
+        print "No previous run in the cache to compare with."
+    elif len(changes) == 0 and len(notes) == 0:
+        print "No changes since the last run, at %s." % time.ctime(cache.previous['time'])
+    else:
+        print "Changes since the last run, at %s:" % time.ctime(cache.previous['time'])
+        for line in [describeChange(change) for change in changes] + notes:
+            print "\t" + line
+